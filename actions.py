@@ -4,8 +4,8 @@ import os
 from dotenv import load_dotenv
 import base64
 import re
-import time
 import random
+import graph_api
 
 load_dotenv(override=True)
 
@@ -21,28 +21,27 @@ def _preprocess_markdown_links(text):
     processed_text = re.sub(markdown_link_pattern, r'\1 \2', text)
     return processed_text
 
+# Define a more comprehensive emoji character class including multiple Unicode ranges
+EMOJI_CLASS = r'[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F1E6-\U0001F1FF\U00002700-\U000027BF\U0001F900-\U0001F9FF\U0001FA70-\U0001FAFF\U00002600-\U000026FF]'
+
+# Regex revised to handle spaces between punctuation and emojis, using the broader EMOJI_CLASS.
+# 1. Match URLs: (?:https?://|ftps?://|www\.)[^\s]+
+# 2. OR Match content .+? ending in one of:
+#    a. Punctuation [.!?] followed by (whitespace NOT followed by emoji `\s+(?!{EMOJI_CLASS})`) OR end-of-string `$`.
+#    b. Punctuation [.!?] followed by optional spaces `\s*` and emoji(s) `{EMOJI_CLASS}+`, which are then followed by whitespace `\s+` or end-of-string `$`.
+#    c. A newline (\n).
+#    Uses non-greedy .+? which consumes up to and including the matched ending.
+# 3. Fallback: Match any remaining characters using .+
+CHUNK_PATTERN = re.compile(rf'(?:https?://|ftps?://|www\.)[^\s]+|.+?(?:[.!?](?=\s+(?!{EMOJI_CLASS})|$)|[.!?]\s*{EMOJI_CLASS}+(?=\s+|$)|\n)|.+')
+
 def _split_message_into_chunks(message_text):
     """Helper function to split text based on sentence terminators or newlines,
     keeping punctuation attached to subsequent emojis, even with spaces."""
     # Preprocess to handle Markdown links first
     processed_text = _preprocess_markdown_links(message_text)
 
-    # Define a more comprehensive emoji character class including multiple Unicode ranges
-    EMOJI_CLASS = r'[\U0001F600-\U0001F64F\U0001F300-\U0001F5FF\U0001F680-\U0001F6FF\U0001F1E6-\U0001F1FF\U00002700-\U000027BF\U0001F900-\U0001F9FF\U0001FA70-\U0001FAFF\U00002600-\U000026FF]'
-
-    # Regex revised to handle spaces between punctuation and emojis, using the broader EMOJI_CLASS.
-    # 1. Match URLs: (?:https?://|ftps?://|www\.)[^\s]+
-    # 2. OR Match content .+? ending in one of:
-    #    a. Punctuation [.!?] followed by (whitespace NOT followed by emoji `\s+(?!{EMOJI_CLASS})`) OR end-of-string `$`.
-    #    b. Punctuation [.!?] followed by optional spaces `\s*` and emoji(s) `{EMOJI_CLASS}+`, which are then followed by whitespace `\s+` or end-of-string `$`.
-    #    c. A newline (\n).
-    #    Uses non-greedy .+? which consumes up to and including the matched ending.
-    # 3. Fallback: Match any remaining characters using .+
-    pattern = rf'(?:https?://|ftps?://|www\.)[^\s]+|.+?(?:[.!?](?=\s+(?!{EMOJI_CLASS})|$)|[.!?]\s*{EMOJI_CLASS}+(?=\s+|$)|\n)|.+'
-
-
     # Find all matches based on the pattern using the processed text
-    matches = re.finditer(pattern, processed_text)
+    matches = CHUNK_PATTERN.finditer(processed_text)
 
     # Create chunks, stripping leading/trailing whitespace
     message_chunks = [match.group(0).strip() for match in matches]
@@ -74,18 +73,8 @@ def _combine_short_chunks(chunks, min_length):
 
     return combined_chunks
 
-def send_text_message(recipient_id, message_text):
-    """
-    Sends a text message to a recipient using the Instagram Graph API, splitting the message
-    into smaller chunks and combining short chunks for a more natural flow.
-    Includes a random delay between sending chunks.
-
-    Args:
-        recipient_id (str): The ID of the recipient
-        message_text (str): The text message to send
-    """
-    access_token = os.environ.get("long_access_token")
-
+def prepare_chunks(message_text):
+    """Splits a reply into the chunks that are sent as separate Instagram messages."""
     # Preprocess markdown links before splitting and combining
     processed_message_text = _preprocess_markdown_links(message_text)
 
@@ -93,16 +82,58 @@ def send_text_message(recipient_id, message_text):
     initial_chunks = _split_message_into_chunks(processed_message_text)
 
     # Step 2: Combine short chunks
-    final_chunks = _combine_short_chunks(initial_chunks, SHORT_CHUNK_THRESHOLD)
+    return _combine_short_chunks(initial_chunks, SHORT_CHUNK_THRESHOLD)
 
-    # If no final chunks were created, return
-    if not final_chunks:
-        print("No valid message chunks to send after combining.")
-        return None
+class ChunkStream:
+    """
+    prepare_chunks for text that arrives in pieces (streamed model output). feed() returns
+    the chunks that can no longer change; flush() returns the rest once the text is
+    complete. Together they yield the same chunks as prepare_chunks on the whole text.
+    """
 
-    responses = []
-    # API endpoint for sending messages
-    url = "https://graph.instagram.com/v12.0/me/messages"
+    def __init__(self):
+        self._buffer = ""
+        self._short = None # a short chunk waiting to be combined with the next one
+
+    def _combine(self, chunk):
+        """Applies _combine_short_chunks one final chunk at a time."""
+        if self._short is not None:
+            combined, self._short = (self._short + " " + chunk).strip(), None
+            return [combined]
+        if len(chunk) < SHORT_CHUNK_THRESHOLD:
+            self._short = chunk
+            return []
+        return [chunk]
+
+    def feed(self, text):
+        self._buffer = _preprocess_markdown_links(self._buffer + text)
+        matches = [match for match in CHUNK_PATTERN.finditer(self._buffer) if match.group(0).strip()]
+        # The last piece may still grow (or be followed by an emoji that belongs to it)
+        ready = []
+        for match in matches[:-1]:
+            ready.extend(self._combine(match.group(0).strip()))
+        if len(matches) > 1:
+            self._buffer = self._buffer[matches[-1].start():]
+        return ready
+
+    def flush(self):
+        chunks = _split_message_into_chunks(self._buffer)
+        if self._short is not None:
+            chunks.insert(0, self._short)
+        self._buffer, self._short = "", None
+        return _combine_short_chunks(chunks, SHORT_CHUNK_THRESHOLD)
+
+    def discard(self):
+        """Drops the text that was not returned yet."""
+        self._buffer, self._short = "", None
+
+def typing_delay():
+    """Random pause before a chunk to simulate typing, in seconds."""
+    return random.uniform(0.5, 3.0)
+
+def send_chunk(recipient_id, chunk):
+    """Sends one prepared chunk through the Instagram Graph API. Returns the response, or None on error."""
+    access_token = os.environ.get("long_access_token")
 
     # Request headers
     headers = {
@@ -110,50 +141,55 @@ def send_text_message(recipient_id, message_text):
         "Content-Type": "application/json"
     }
 
-    # Send each final chunk as a separate message
-    for chunk in final_chunks:
-        # Construct message payload
-        payload = {
-            "recipient": {
-                "id": recipient_id
-            },
-            "message": {
-                "text": chunk
-            }
+    # Construct message payload
+    payload = {
+        "recipient": {
+            "id": recipient_id
+        },
+        "message": {
+            "text": chunk
         }
+    }
 
-        # --- Add Delay Before Sending ---
-        # Pause for a short, random time to simulate typing
-        delay_seconds = random.uniform(0.5, 3.0) # Delay between 0.5 and 1.5 seconds
-        print(f"Pausing for {delay_seconds:.2f} seconds...")
-        time.sleep(delay_seconds)
-        # --------------------------------
+    # Send POST request
+    print(f"Sending chunk: {chunk}")
+    try:
+        response = graph_api.client.post(
+            "me/messages",
+            "send_message",
+            headers=headers,
+            json=payload
+        )
 
-        # Send POST request
-        print(f"Sending chunk: {chunk}")
-        try:
-            response = requests.post(
-                url,
-                headers=headers,
-                json=payload
-            )
+        # Log response details
+        print(f"Response Status Code: {response.status_code}")
 
-            # Log response details
-            print(f"Response Status Code: {response.status_code}")
+        try:
+            print(f"Response Body: {response.json()}")
+        except requests.exceptions.JSONDecodeError:
+            print(f"Failed to decode JSON response. Raw response: {response.text}")
 
-            try:
-                print(f"Response Body: {response.json()}")
-            except requests.exceptions.JSONDecodeError:
-                print(f"Failed to decode JSON response. Raw response: {response.text}")
+        # Check if request was successful
+        response.raise_for_status()
+        return response
 
-            # Check if request was successful
-            response.raise_for_status()
-            responses.append(response)
+    except requests.exceptions.RequestException as e:
+        print(f"Error sending message chunk: {str(e)}")
+        return None
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending message chunk: {str(e)}")
+def send_text_message(recipient_id, message_text):
+    """
+    Sends a text message to a recipient using the Instagram Graph API, splitting the message
+    into smaller chunks and combining short chunks for a more natural flow.
+    Returns immediately: the chunks are sent by the outbound scheduler (outbound.py), in
+    order and with a random typing pause before each, without holding this thread.
 
-    return responses if responses else None
+    Args:
+        recipient_id (str): The ID of the recipient
+        message_text (str): The text message to send
+    """
+    import outbound # outbound sends through this module
+    outbound.deliver(recipient_id, message_text)
 
 def image_to_base64(image_url):
     response = requests.get(image_url)
@@ -170,13 +206,12 @@ def send_text_messages(recipient_id, messages):
 def get_conversations(access_token):
 
     # access_token = os.environ.get("long_access_token")
-    url = f"https://graph.instagram.com/v22.0/me/conversations"
     payload = {
         "platform": "instagram",
         "fields":  "participants,message,messages{created_time,from,message,reactions,shares,attachments}",
         "access_token": access_token
         }
-    response = requests.get(url, params=payload)
+    response = graph_api.client.get("me/conversations", "conversations", params=payload)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -189,8 +224,7 @@ def get_user_conversation(user_id):
         print("Error: Long-lived access token not found in environment variables.")
         return None
 
-    # Use the latest API version you have access to, v22.0 seems current based on your example
-    url = f"https://graph.instagram.com/v22.0/me/conversations"
+    # The API version is set once, in graph_api.py
     payload = {
         "platform": "instagram",
         "fields": "participants,message,messages{created_time,from,message,reactions,shares,attachments}", # Fetch necessary fields
@@ -200,7 +234,7 @@ def get_user_conversation(user_id):
 
     print(f"Fetching conversation for user_id: {user_id}")
     try:
-        response = requests.get(url, params=payload)
+        response = graph_api.client.get("me/conversations", "conversations", params=payload)
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         data = response.json()
 
@@ -234,12 +268,11 @@ def get_user_conversation(user_id):
 
 def get_profile(_id):
     access_token = os.environ.get("long_access_token")
-    url = f"https://graph.instagram.com/v22.0/{_id}"
     payload = {
         "fields": "name,username",
         "access_token": access_token
         }
-    response = requests.get(url, params=payload)
+    response = graph_api.client.get(str(_id), "profile", params=payload)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -247,7 +280,6 @@ def get_profile(_id):
 def send_post(receiver_id,post_id,owner_id):
 
     access_token = os.environ.get("long_access_token")
-    url = f"https://graph.instagram.com/v22.0/{owner_id}/messages"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
@@ -266,13 +298,12 @@ def send_post(receiver_id,post_id,owner_id):
         }
     }
 
-    response = requests.post(url,headers=headers,data=json.dumps(data))
+    response = graph_api.client.post(f"{owner_id}/messages","send_post",headers=headers,data=json.dumps(data))
     print(response.json())
 
 def send_entrance_image(receiver_id):
     access_token = os.environ.get("long_access_token")
     image_url = "https://media-hosting.imagekit.io/e7ea7d1a0e2f462f/photo_2025-05-06_19-22-43.jpg?Expires=1841310388&Key-Pair-Id=K2ZIVPTIP2VGHC&Signature=z8G3NXKZaOS8YC3FSeuOBoRmBqONo-FR9MXVUjlav-j5eMf0MBOQQoMk5uRk3-MiH8sr31ZICz3Qm2hjxmAoH~pGkzMoFLa9r~XcYB8H1h9F2oB-bYLswGtOVjlzEmD2JSdSi~YBZC5dChm5pbuj6dH30fRDJaCJXQrqNSG1AhshZ2eXV1QzVyKSdHL44fluwFBWHZKizJv-BAGZviWhtNodV9-UU~Z~O4Ozh2tjsqOfxn0rwppdRICuIae7MOF~SqFAxhPquJ9AUlxTlAJ2XVVxTnkyJ1zvlsK6QzO~7coP~ycMI76thqK1UEeKX1hje6nFfrz3-Ld0DVRbhA2PTw__"
-    url = f"https://graph.instagram.com/v12.0/me/messages"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
@@ -291,7 +322,7 @@ def send_entrance_image(receiver_id):
            }
     }
 
-    response = requests.post(url,headers=headers,data=json.dumps(data))
+    response = graph_api.client.post("me/messages","send_image",headers=headers,data=json.dumps(data))
     print(response.json())
 
 
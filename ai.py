@@ -8,357 +8,613 @@ from dotenv import load_dotenv
 import traceback
 import anthropic 
 import google_docs_helper 
-from types import SimpleNamespace 
 import actions
 import functions
+import metrics
+import context
+import tool_registry
+import owner_config
+import retry
+import usage
+from cancellation import Cancelled, CancellationToken
 load_dotenv(override=True)
 ModelName = os.getenv('ModelName')
 Temperature = float(os.environ.get('Temperature'))
 API_KEY = os.getenv("AI_API_KEY")
+# Provider-side prompt caching of the static prefix (tools + system instruction) and of the
+# conversation so far; cached input is billed at a fraction of the normal rate
+PROMPT_CACHING = os.getenv("PROMPT_CACHING", "true").lower() == "true"
+PROMPT_CACHE_HISTORY = os.getenv("PROMPT_CACHE_HISTORY", "true").lower() == "true"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", ModelName) # model that folds old turns into the rolling summary
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 500)) # length budget of the rolling summary
 # ModelUrl = os.getenv("ModelUrl") # Not typically used with Anthropic SDK client
 today = datetime.date.today().isoformat()
 
-tools = [
+# --- Tools ---
+# Each tool is registered with its schema, handler, concurrency, timeout and cache policy
+# (see tool_registry.py); `tools` below, sent to the model, is generated from the registry.
+# Handlers take the validated arguments, the customer's id and the owner's id and return
+# the text given back to the model.
+
+def _get_information(args, _id, owner_id):
+    return str(functions.get_information(args["info"], _id, owner_id))
+
+def _check_availablity(args, _id, owner_id):
+    if args["service"] in ["eye brow","EMSculpt"]:
+        # Staff handle these themselves: the bot steps back for this customer
+        database.set_user_active(_id, False, owner_id)
+        return "this service is handled by our staff personally. tell the user a team member will contact them shortly."
+    available_on = functions.availablity(args["date"])
+    return f"this are the times we are available suggest the user the earliest time:\n{available_on}"
+
+def _book_appointment(args, _id, owner_id):
+    ap = args
+    ap["payment_confirmed"] = False
+    notification = {}
+    detail = {}
+    notification["type"] = "book appointment"
+    detail["Service"] = args.get("service")
+    detail["Appointment date"] = args.get("booked_datetime")
+    detail["Deposit amount"] = args.get("deposit_amount")
+    detail["Deal price"] = args.get("deal_price")
+    detail["Phone number"] = args.get("phone_number")
+    notification["Note"] = args.get("note")
+    notification["details"] = detail
+
+    response,appointment_id = functions.book_appointment(_id,ap,owner_id)
+    ap["appointment_id"] = appointment_id
+    google_docs_helper.add_appointment_to_google_doc(ap)
+    database.send_notification(_id,notification,owner_id)
+    return "appointment booked"
+
+def _get_user_appointments(args, _id, owner_id):
+    return str(database.get_user_appointments(_id,owner_id,phone_number=args.get("phone_number")))
+
+def _reschedule_appointment(args, _id, owner_id):
+    date_time = args["date_time"]
+    appointment_id = args["appointment_id"]
+    notification = {}
+    notification["Note"] = args.get("note")
+    notification["type"] = "reschedule appointment"
+    details = {}
+    details["Original date"] = args.get("previous_date")
+    details["Rescheduled to"] = date_time
+    notification["details"] = details
+    available_on = json.loads(functions.availablity(date_time[:10]))
+
+    if not functions.is_time_available(date_time, available_on):
+        return "error: specified date is not available"
+    try:
+        database.reschedule_appointment(appointment_id,date_time)
+    except Exception as e:
+        print("error while saving reschedule:",e)
+    try:
+        functions.reschedule_appointment(args["client_id"],appointment_id,date_time,args.get("duration","60"))
+    except Exception as e:
+        print("error while reschudling in schedulista:",e)
+    google_docs_helper.reschedule_appointment(appointment_id,date_time)
+    database.send_notification(_id,notification,owner_id)
+    return "appointment rescheduled!"
+
+def _cancel_appointment(args, _id, owner_id):
+    appointment_id = args["appointment_id"]
+    notification = {"type": "cancel appointment", "Note": args.get("note"), "details": {}}
+    database.cancel_appointment(appointment_id)
+    functions.cancel_appointment(appointment_id)
+    google_docs_helper.cancel_appointment(appointment_id)
+    database.send_notification(_id,notification,owner_id)
+    return "appointment has been cancelled! contact @fiinnessey for refund!"
+
+def _get_examples(args, _id, owner_id):
+    return f"send the user one of those link: {functions.send_example(args['service'],owner_id)}"
+
+def _send_entrance_image(args, _id, owner_id):
+    actions.send_entrance_image(_id)
+    return "entrance image has been sent to the user! you can pretend you sent it and continue the conversation"
+
+tool_registry.register(
+    "get_information",
+    "this function gives any information you need to answer users questions.",
     {
-            "name": "get_information",
-            "description": "this function gives any information you need to answer users questions.",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "info": {
-                        "type": "string",
-                        "enum": ["businessDescription", "booking","services","training","policy","payment_informations","contact"],
-                        "description": 'you specify what information you want to get. you must choose one of this ["businessDescription", "booking","services","training","policy","payment_informations","contact"] use businessDescription for general info.'
-                    },
-                },
-            "required": ["info"]
-        }
+        "type": "object",
+        "properties": {
+            "info": {
+                "type": "string",
+                "enum": ["businessDescription", "booking","services","training","policy","payment_informations","contact"],
+                "description": 'you specify what information you want to get. you must choose one of this ["businessDescription", "booking","services","training","policy","payment_informations","contact"] use businessDescription for general info.'
+            },
+        },
+        "required": ["info"]
     },
+    # Not cached: the services price depends on the customer's appointments, which a booking changes
+    _get_information, read_only=True, timeout=15,
+)
+tool_registry.register(
+    "check_availablity",
+    f"This function lets you check availability within a specified date. The date can be provided as a specific date (YYYY-MM-DD) or as a weekday name (e.g., 'Monday', 'next Tuesday'). If a weekday name is provided, it will be interpreted as the next occurrence of that weekday. today is {today}",
     {
-            "name": "check_availablity",
-            "description": f"This function lets you check availability within a specified date. The date can be provided as a specific date (YYYY-MM-DD) or as a weekday name (e.g., 'Monday', 'next Tuesday'). If a weekday name is provided, it will be interpreted as the next occurrence of that weekday. today is {today}",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "date": {
-                        "type": "string",
-                        "description": "The date for checking availability. Can be a specific date in YYYY-MM-DD format or a weekday name (e.g., 'Monday', 'next Friday', 'Tue','today'.'tomorrow','general').'examples': ['2025-03-10', 'Monday', 'next wednesday','today','tomorrow','general'] you can use 'general' for next week it will return available dates with in current month you should use this often!",
-                    },
-                    "service":{
-                        "type":"string",
-                        "enum": ["eye lash","eye brow","EMSculpt"],
-                        "description":"the service the user wants to get"
-                        },
-                },
-            "required": ["date","service"]
-        }
+        "type": "object",
+        "properties": {
+            "date": {
+                "type": "string",
+                "description": "The date for checking availability. Can be a specific date in YYYY-MM-DD format or a weekday name (e.g., 'Monday', 'next Friday', 'Tue','today'.'tomorrow','general').'examples': ['2025-03-10', 'Monday', 'next wednesday','today','tomorrow','general'] you can use 'general' for next week it will return available dates with in current month you should use this often!",
+            },
+            "service":{
+                "type":"string",
+                "enum": ["eye lash","eye brow","EMSculpt"],
+                "description":"the service the user wants to get"
+            },
+        },
+        "required": ["date","service"]
     },
+    # Not read-only: it pauses the bot for services staff handle themselves, which other
+    # calls of the turn would observe. Not cached: availability must be current when a booking follows
+    _check_availablity,
+)
+tool_registry.register(
+    "book_appointment",
+    "This function lets you book an appointment for the user",
     {
-            "name": "book_appointment",
-            "description": "This function lets you book an appointment for the user",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "service": {
-                        "type": "string",
-                        "description": "The name of the service booked.",
-                    },
-                    "deposit_amount": {
-                        "type": "number",
-                        "description": "deposit that the user made in the screenshot for lock the appointment",
-                    },
-                    "deal_price": {
-                        "type": "number",
-                        "description": "The acutally serivce price you got from get_information function.",
-                    },
-                    "booked_datetime": {
-                        "type": "string",
-                        "description": "The date of the appointment.YYYY-MM-DD'T'HH:mm:ss format!",
-                    },
-                    "name": {
-                        "type": "string",
-                        "description": "The customer's full name.",
-                    },
-                    "phone_number": {
-                        "type": "string",
-                        "description": "The customer's phone number. it should be atleast 10 digit.",
-                    },
-                    "email":{
-                        "type":"string",
-                        "description": "email of the customer",
-                        },
-                    "note":{
-                        "type": "string",
-                        "description": "discription about the appointment. should include service name,day and time (in human readable format),user name, deposit_amount,deal_price",
-                    }
-                },
-                         "required": ["service", "deposit_amount","deal_price", "booked_datetime", "name","email", "phone_number","note"]
-        }
+        "type": "object",
+        "properties": {
+            "service": {
+                "type": "string",
+                "description": "The name of the service booked.",
+            },
+            "deposit_amount": {
+                "type": "number",
+                "description": "deposit that the user made in the screenshot for lock the appointment",
+            },
+            "deal_price": {
+                "type": "number",
+                "description": "The acutally serivce price you got from get_information function.",
+            },
+            "booked_datetime": {
+                "type": "string",
+                "description": "The date of the appointment.YYYY-MM-DD'T'HH:mm:ss format!",
+            },
+            "name": {
+                "type": "string",
+                "description": "The customer's full name.",
+            },
+            "phone_number": {
+                "type": "string",
+                "description": "The customer's phone number. it should be atleast 10 digit.",
+            },
+            "email":{
+                "type":"string",
+                "description": "email of the customer",
+            },
+            "note":{
+                "type": "string",
+                "description": "discription about the appointment. should include service name,day and time (in human readable format),user name, deposit_amount,deal_price",
+            }
+        },
+        "required": ["service", "deposit_amount","deal_price", "booked_datetime", "name","email", "phone_number","note"]
     },
+    _book_appointment,
+)
+tool_registry.register(
+    "get_user_appointments",
+    "This function returns list of user appointments. phone_number is not required the system knows the user",
     {
-            "name": "get_user_appointments",
-            "description": "This function returns list of user appointments. phone_number is not required the system knows the user",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "phone_number": {
-                        "type": "string",
-                        "description": "phone_number is not required to call this function"
-                },
-            }
+        "type": "object",
+        "properties": {
+            "phone_number": {
+                "type": "string",
+                "description": "phone_number is not required to call this function"
+            },
         }
     },
+    _get_user_appointments, read_only=True, timeout=15,
+)
+tool_registry.register(
+    "reschedule_appointment",
+    "This function lets you reschedule appointment. it takes appointment_id of the appointment and date time. dont not ask the user for an id you should call get_user_appointments function first. availablity must be checked before calling this function",
     {
-            "name": "reschedule_appointment",
-            "description": "This function lets you reschedule appointment. it takes appointment_id of the appointment and date time. dont not ask the user for an id you should call get_user_appointments function first. availablity must be checked before calling this function",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "appointment_id": {
-                        "type": "string",
-                        "description": "the appointment_id of the appointment fetched from get_user_appointments function"
-                    },
-                    "client_id": {
-                        "type": "string",
-                        "description": "client_id fetched from get_user_appointments function"
-                    },
-                    "previous_date": {
-                        "type": "string",
-                        "description": "the old date"
-                    },
-                    "date_time": {
-                        "type": "string",
-                        "description": "date time of the new rescheduled appointment in YYYY-MM-DD'T'HH:mm format!"
-                    },
-                    "note": {
-                        "type": "string",
-                        "description": "discription about the client and rescheduled appointment include user info like name, phone number and service name"
-                    },
-                },
-            "required": ["appointment_id","client_id","date_time","note"]
-        }
+        "type": "object",
+        "properties": {
+            "appointment_id": {
+                "type": "string",
+                "description": "the appointment_id of the appointment fetched from get_user_appointments function"
+            },
+            "client_id": {
+                "type": "string",
+                "description": "client_id fetched from get_user_appointments function"
+            },
+            "previous_date": {
+                "type": "string",
+                "description": "the old date"
+            },
+            "date_time": {
+                "type": "string",
+                "description": "date time of the new rescheduled appointment in YYYY-MM-DD'T'HH:mm format!"
+            },
+            "note": {
+                "type": "string",
+                "description": "discription about the client and rescheduled appointment include user info like name, phone number and service name"
+            },
+        },
+        "required": ["appointment_id","client_id","date_time","note"]
     },
+    _reschedule_appointment,
+)
+tool_registry.register(
+    "cancel_appointment",
+    "This function lets you cancel an appointment",
     {
-            "name": "cancel_appointment",
-            "description": "This function lets you cancel an appointment",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "appointment_id": {
-                        "type": "string",
-                        "description": "the appointment_id of the appointment fetched from get_user_appointments function"
-                    },
-                    "note": {
-                        "type": "string",
-                        "description": "discription about the client and cancelled appointment. include user info like name, phone number and service name"
-                    },
-                    "date": {
-                        "type": "string",
-                        "description": "cancelled date"
-                    },
-                },
-            "required": ["appointment_id","note"]
-        }
+        "type": "object",
+        "properties": {
+            "appointment_id": {
+                "type": "string",
+                "description": "the appointment_id of the appointment fetched from get_user_appointments function"
+            },
+            "note": {
+                "type": "string",
+                "description": "discription about the client and cancelled appointment. include user info like name, phone number and service name"
+            },
+            "date": {
+                "type": "string",
+                "description": "cancelled date"
+            },
+        },
+        "required": ["appointment_id","note"]
     },
+    _cancel_appointment,
+)
+tool_registry.register(
+    "get_examples",
+    "This function allows you to get images of specific services as an example so you can sent the link to the customers",
     {
-            "name": "get_examples",
-            "description": "This function allows you to get images of specific services as an example so you can sent the link to the customers",
-        "input_schema": {
-                "type": "object",
-                "properties": {
-                    "service": {
-                        "type": "string",
-                        "enum": ["classic", "hybrid","mega","training","policy","payment_informations","contact"],
-                        "description": "service you want to send example"
-                    },
-                },
-            "required": ["service"]
-        }
+        "type": "object",
+        "properties": {
+            "service": {
+                "type": "string",
+                "enum": ["classic", "hybrid","mega","training","policy","payment_informations","contact"],
+                "description": "service you want to send example"
+            },
+        },
+        "required": ["service"]
     },
+    # Read from the owner's dataset, so as stale as owner_config may be and no more
+    _get_examples, read_only=True, timeout=15,
+    cache=tool_registry.CachePolicy(ttl=owner_config.OWNER_CONFIG_TTL, per_user=False),
+)
+tool_registry.register(
+    "send_entrance_image",
+    "this function allows you to send our building entrance image for the customers to get in easy",
     {
-        "name": "send_entrance_image",
-        "description": "this function allows you to send our building entrance image for the customers to get in easy",
-        "input_schema": {
-                "type": "object",
-                "properties": {},
-        }
-    }
+        "type": "object",
+        "properties": {},
+    },
+    _send_entrance_image,
+)
+
+tools = tool_registry.schemas()
+
+CACHE_BREAKPOINT = {"type": "ephemeral"}
 
-]
+def _with_breakpoint(message):
+    """A copy of message whose last content block ends a cached prefix."""
+    content = message.get("content")
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    if not content:
+        return message
+    return {**message, "content": content[:-1] + [{**content[-1], "cache_control": CACHE_BREAKPOINT}]}
+
+SUMMARY_PROMPT = (
+    "You keep the running summary of an Instagram conversation between a beauty salon's assistant "
+    "and one customer. Rewrite the summary so it also covers the new messages. Keep everything the "
+    "assistant needs later: the customer's name and phone number, services asked about, dates and times "
+    "offered, appointments booked, rescheduled or cancelled, payments, preferences, complaints and open "
+    "questions. Drop greetings and small talk. Reply with the summary only."
+)
+
+_client = None
+_client_pid = None
+
+def anthropic_client():
+    """
+    The process-wide Anthropic client. It is thread-safe and keeps its connections alive,
+    so batches reuse warm TLS connections instead of opening a pool each. Created once
+    per process (a forked worker gets its own).
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        # Retries are retry.py's job (shared backoff, rate limits, circuit breaker)
+        _client = anthropic.Anthropic(api_key=API_KEY, max_retries=0)
+        _client_pid = os.getpid()
+    return _client
+
+def summarize(previous_summary, transcript, turn=None):
+    """
+    Folds a transcript of older turns into the previous rolling summary and returns the new one.
+    Its tokens are accounted to `turn` (a usage.Turn) if given.
+    """
+    started = time.time()
+    response = retry.call(lambda: anthropic_client().messages.create(
+        model=SUMMARY_MODEL,
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0,
+        system=SUMMARY_PROMPT,
+        messages=[{
+            "role": "user",
+            "content": f"Current summary:\n{previous_summary or '(none yet)'}\n\nNew messages:\n{transcript}"
+        }],
+    ), tokens=len(transcript) // 4)
+    metrics.observe("llm.summary_seconds", time.time() - started)
+    if turn is not None:
+        turn.add_call(response.usage, time.time() - started)
+    return "".join(block.text for block in response.content if block.type == "text").strip()
 
 class llm:
+    prompt_cache = PROMPT_CACHING
+    cache_history = PROMPT_CACHE_HISTORY
+    turn = None # usage.Turn of the turn being processed, if any
+
     def __init__(self,owner_id):
         self.owner_id = owner_id
         self.responseType = "text"
         self.tools = tools
-        self.instruction = database.get_instruction(owner_id)
-        # Initialize Anthropic client
-        self.client = anthropic.Anthropic(
-            api_key=API_KEY, # Uses the existing environment variable
-        )
+        self.instruction = owner_config.get(owner_id).instruction
+        self.client = anthropic_client()
 
-    def function_call(self,response,_id,owner_id):
-        function_name = response.function.name
-        function_args = json.loads(response.function.arguments)
-        print(function_name)
-        print(function_args)
-    
-        if function_name == "get_information": 
-            info = function_args.get("info")
-            
-            if info:
-                returned_info = functions.get_information(info,_id,owner_id)
-                return {"function_response":str(returned_info),"image":None}
-                
-            else:
-                return {"function_response":"information type is required","image":None}
-
-        if function_name == "check_availablity":
-            date = function_args.get("date")
-            service = function_args.get("service")
-            if service in ["eye brow","EMSculpt"]:
-                database.set_user_active(_id,False,owner_id)
-                return
-            if date:
-                available_on = functions.availablity(date)
-                return {"function_response":f"this are the times we are available suggest the user the earliest time:\n{available_on}","image":None}
-
-        if function_name == "book_appointment": 
-            ap = function_args 
-            name = function_args.get("name")
-            ap["payment_confirmed"] = False
-            note = function_args.get("note")
-            notification = {}
-            detail = {}
-            notification["type"] = "book appointment"
-            detail["Service"] = function_args.get("service")
-            detail["Appointment date"] = function_args.get("booked_datetime")
-            detail["Deposit amount"] = function_args.get("deposit_amount")
-            detail["Deal price"] = function_args.get("deal_price")
-            detail["Phone number"] = function_args.get("phone_number")
-            notification["Note"] = function_args.get("note")
-            notification["details"] = detail
-
-            response,appointment_id = functions.book_appointment(_id,ap,owner_id)
-            ap["appointment_id"] = appointment_id
-            google_docs_helper.add_appointment_to_google_doc(ap)
-            notification = database.send_notification(_id,notification,owner_id)
-            
-            # return {"function_response":str(response),"image":None}
-            return {"function_response":"appointment booked","image":None}
-
-        if function_name == "get_user_appointments":
-            phone_number = function_args.get("phone_number",None)
-            user_appointments = database.get_user_appointments(_id,owner_id,phone_number=phone_number)
-            return {"function_response":str(user_appointments),"image":None}
-
-        if function_name == "reschedule_appointment":
-            date_time = function_args.get("date_time")
-            previous_date = function_args.get("previous_date")
-            appointment_id = function_args.get("appointment_id")
-            client_id = function_args.get("client_id")
-            duration = function_args.get("duration","60")
-            date = date_time[:10]
-            notification = {}
-            notification["Note"] = function_args.get("note")
-            notification["type"] = "reschedule appointment"
-            details = {}
-            details["Original date"] = previous_date
-            details["Rescheduled to"] = date_time
-            notification["details"] = details
-            available_on = json.loads(functions.availablity(date))
-
-            if functions.is_time_available(date_time, available_on):
-                try:
-                    user_appointments = database.reschedule_appointment(appointment_id,date_time)
-                except Exception as e:
-                    print("error while saving reschedule:",e)
-                try:
-                    reschedule_appointment = functions.reschedule_appointment(client_id,appointment_id,date_time,duration)
-                except Exception as e:
-                    print("error while reschudling in schedulista:",e)
-                google_docs_helper.reschedule_appointment(appointment_id,date_time)
-                database.send_notification(_id,notification,owner_id)
-                return {"function_response":"appointment rescheduled!","image":None}
-            return {"function_response":"error: specified date is not available","image":None}
-
-        if function_name == "cancel_appointment":
-            appointment_id = function_args.get("appointment_id")
-            notification = {}
-            note = function_args.get("note")
-            notification["type"] = "cancel appointment"
-            notification["Note"] = note
-            details = {}
-            notification["details"] = details
-            user_appointments = database.cancel_appointment(appointment_id)
-            schedulista = functions.cancel_appointment(appointment_id)
-            google_docs_helper.cancel_appointment(appointment_id)
-            notification = database.send_notification(_id,notification,owner_id)
-            return {"function_response":f"appointment has been cancelled! contact @fiinnessey for refund!","image":None}
-
-        if function_name == "get_examples":
-            query = function_args.get("service")
-            result = functions.send_example(query,owner_id)
-            return {"function_response": f"send the user one of those link: {result}","image":None}
-
-        if function_name == "send_entrance_image":
-            actions.send_entrance_image(_id)
-
-            return {"function_response":f"entrance image has been sent to the user! you can pretend you sent it and continue the conversation"}
-    def generate_response(self,_id,messages,owner_id):
-        max_retries = 3
-        retry_delay = 3 # seconds
-
-        for attempt in range(max_retries):
+    def request_kwargs(self, messages):
+        """Arguments for messages.create, shared by the threaded and the asyncio clients."""
+        kwargs = {
+            "model": ModelName,
+            "max_tokens": 1024,
+            "temperature": Temperature,
+            "system": self.instruction,
+            "messages": messages,
+            "tools": self.tools,
+            "tool_choice": {"type": "auto"},
+        }
+        if self.prompt_cache:
+            self.mark_cache_breakpoints(kwargs)
+        return kwargs
+
+    def mark_cache_breakpoints(self, kwargs):
+        """
+        Marks where cached prefixes end. The prefix is tools, then system, then messages, so
+        one breakpoint after the instruction covers both static parts; a second one on the
+        last message lets the next call of a tool loop (and the next turn) reuse the whole
+        conversation so far. Messages are copied, never modified in place.
+        """
+        if self.instruction:
+            kwargs["system"] = [{"type": "text", "text": self.instruction, "cache_control": CACHE_BREAKPOINT}]
+        elif self.tools:
+            kwargs["tools"] = self.tools[:-1] + [{**self.tools[-1], "cache_control": CACHE_BREAKPOINT}]
+        if self.cache_history and kwargs["messages"]:
+            kwargs["messages"] = kwargs["messages"][:-1] + [_with_breakpoint(kwargs["messages"][-1])]
+
+    def record_usage(self, response, started):
+        """Tracks call latency and token usage; aborted calls estimate their savings from these."""
+        elapsed = time.time() - started
+        metrics.observe("llm.call_seconds", elapsed)
+        response_usage = getattr(response, "usage", None)
+        if response_usage is not None:
+            tokens = usage.tokens_of(response_usage)
+            metrics.observe("llm.input_tokens", tokens["input_tokens"])
+            metrics.observe("llm.output_tokens", tokens["output_tokens"])
+            # input_tokens excludes both of these: read is billed at ~0.1x, write at ~1.25x
+            metrics.observe("llm.cache_read_tokens", tokens["cache_read_tokens"])
+            metrics.observe("llm.cache_write_tokens", tokens["cache_write_tokens"])
+        if self.turn is not None:
+            self.turn.add_call(response_usage, elapsed)
+
+    def record_abort(self, started, streamed_chars=0):
+        """Counts an aborted call and estimates the latency and output tokens it saved."""
+        elapsed = time.time() - started
+        metrics.incr("llm.aborted_calls")
+        if self.turn is not None:
+            self.turn.add_call(None, elapsed) # Its tokens are not reported for an aborted stream
+        metrics.observe("llm.abort_after_seconds", elapsed)
+        typical_seconds = metrics.mean("llm.call_seconds")
+        if typical_seconds is not None:
+            metrics.incr("llm.abort_saved_seconds", max(0, typical_seconds - elapsed))
+        typical_tokens = metrics.mean("llm.output_tokens")
+        if typical_tokens is not None:
+            # Roughly four characters per token for what was already streamed
+            metrics.incr("llm.abort_saved_output_tokens", max(0, typical_tokens - streamed_chars / 4))
+
+    def stream_response(self, messages, cancel_token, reply=None):
+        """
+        Streams one model call so cancel_token can abort it mid-generation. Raises Cancelled.
+        With a reply (an outbound.ReplyStream) text is delivered while it is generated.
+        """
+        started = time.time()
+        streamed_chars = 0
+        first_block_seen = False
+        cancel_token.raise_if_cancelled()
+        if reply is not None:
+            reply.start()
+        with self.client.messages.stream(**self.request_kwargs(messages)) as stream:
+            # Closing the response from the cancelling thread interrupts a blocked read
+            stop_watching = cancel_token.on_cancel(stream.close)
             try:
-                # Use Anthropic's client.messages.create
-                response = self.client.messages.create(
-                    model=ModelName,
-                    max_tokens=1024, 
-                    temperature=Temperature,
-                    system=self.instruction, 
-                    messages=messages, 
-                    tools=self.tools,
-                    tool_choice={"type": "auto"} 
-                )
-                # print("Anthropic response:", response) 
-                return response # Success, return the response
-            except Exception as e: 
-                print(f"Attempt {attempt + 1} failed with error during Anthropic API call: {e}")
-                if attempt < max_retries - 1:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                else:
-                    print("Max retries reached. Raising the error.")
-                    traceback.print_exc() # Print traceback for debugging the final error
-                    raise # Re-raise the exception after the last attempt
+                for event in stream:
+                    if cancel_token.is_cancelled():
+                        break
+                    if event.type == "content_block_start" and not first_block_seen:
+                        # The first text or tool_use block: time to first token
+                        first_block_seen = True
+                        metrics.observe("llm.first_token_seconds", time.time() - started)
+                    if event.type == "text":
+                        streamed_chars += len(event.text)
+                        if reply is not None:
+                            reply.feed(event.text)
+                    elif event.type == "content_block_stop" and event.content_block.type == "text" and reply is not None:
+                        reply.end_text()
+                if not cancel_token.is_cancelled():
+                    response = stream.get_final_message()
+                    self.record_usage(response, started)
+                    if reply is not None:
+                        reply.finish()
+                    return response
+            except Exception:
+                if not cancel_token.is_cancelled():
+                    raise
+            finally:
+                stop_watching()
+        self.record_abort(started, streamed_chars)
+        raise Cancelled(cancel_token.reason)
+
+    def generate_response(self,_id,messages,owner_id,cancel_token=None,reply=None):
+        """
+        One model call with retries (see retry.call): fatal errors are raised at once, and
+        waits too long to sleep through raise retry.RetryLater for the batch to be re-armed.
+        """
+        def attempt():
+            if cancel_token is not None or reply is not None:
+                return self.stream_response(messages, cancel_token or CancellationToken(), reply)
+            # Use Anthropic's client.messages.create
+            started = time.time()
+            response = self.client.messages.create(**self.request_kwargs(messages))
+            self.record_usage(response, started)
+            # print("Anthropic response:", response) 
+            return response # Success, return the response
+
+        try:
+            return retry.call(attempt, tokens=context.estimate_tokens(messages), cancel_token=cancel_token)
+        except (Cancelled, retry.RetryLater):
+            raise
+        except Exception as e:
+            print(f"Anthropic API call failed for {_id}: {e}")
+            traceback.print_exc() # Print traceback for debugging the final error
+            raise
+
+    def build_assistant_message(self, _id, response):
+        """
+        Converts a model response into the assistant message to store.
+        Returns (assistant_msg, tool_use_blocks, should_save_messages).
+        """
+        # --- Construct Assistant Message ---
+        # Start with role, get text content later
+        assistant_message_content = []
+
+        # Extract text content if present
+        text_content = "".join([block.text for block in response.content if block.type == 'text'])
+        if text_content:
+            assistant_message_content.append({"type": "text", "text": text_content})
+
+        # Store the full assistant message structure (including potential tool_use later)
+        assistant_msg_to_save = {
+            "role": "assistant",
+            "content": assistant_message_content # Start with text, add tool_use if needed
+        }
+
+        # --- Check for Tool Use ---
+        tool_use_blocks = [block for block in response.content if block.type == 'tool_use']
+        # Flag to determine if messages related to this tool call should be saved
+        should_save_messages = False
+        # Add the raw tool_use blocks to the assistant message content
+        for tool_use in tool_use_blocks:
+             func_call = {
+                 "type": "tool_use",
+                 "id": tool_use.id,
+                 "name": tool_use.name,
+                 "input": tool_use.input
+             }
+             assistant_message_content.append(func_call)
+             print(tool_use.name)
+             # Set flag if 'check_availablity' is used
+             if tool_use.name in ["check_availablity","book_appointment","reschedule_appointment","cancel_appointment","get_user_appointments"]:
+                 should_save_messages = True # Rename flag for clarity
+        return assistant_msg_to_save, tool_use_blocks, should_save_messages
+
+    def run_tool(self, tool_use, _id, owner_id):
+        """Executes one requested tool and returns its tool_result block."""
+        print(f"Calling function: {tool_use.name} with input: {tool_use.input}")
+        started = time.time()
+        content, is_error = tool_registry.dispatch(tool_use.name, tool_use.input, _id, owner_id)
+        metrics.observe(f"tools.{tool_use.name}.seconds", time.time() - started)
+        print(f"Extracted function response content: '{content}'")
 
-    def process_query(self,_id,messages,owner_id):
+        # The result in Anthropic's tool_result format
+        result = {
+            "type": "tool_result",
+            "tool_use_id": tool_use.id,
+            "content": content
+        }
+        if is_error:
+            result["is_error"] = True
+        return result
+
+    def skip_tool(self, tool_use):
+        """The tool_result of a tool that was not run because the turn was cancelled."""
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use.id,
+            "content": "not run: the customer sent a newer message",
+            "is_error": True
+        }
+
+    def run_tools(self, tool_use_blocks, _id, owner_id, cancel_token=None):
+        """
+        Executes the requested tools and returns the user message carrying their tool_result
+        blocks, in the order of the tool_use blocks. Consecutive read-only tools run
+        concurrently; side-effecting ones run alone, in the order the model asked for them.
+        Once cancel_token fires, the tools that have not started are skipped (see skip_tool).
+        """
+        if self.turn is not None:
+            self.turn.add_tool_iteration()
+        tool_results_content = tool_registry.run(
+            tool_use_blocks, lambda tool_use: self.run_tool(tool_use, _id, owner_id), lambda tool_use: tool_use.name,
+            cancel_token, self.skip_tool
+        )
+
+        # Create the user message containing all tool results
+        return {
+            "role": "user", # Use 'user' role for tool results per Anthropic spec
+            "content": tool_results_content
+        }
+
+    def process_query(self,_id,messages,owner_id,cancel_token=None,reply=None):
+        """
+        Runs the model/tool loop for one turn. With a cancel_token the turn stops with
+        Cancelled as soon as the token fires: the current model call is aborted and tools
+        that have not started are skipped. A tool (or set of concurrent read-only tools)
+        that has started always runs to completion, since tools like bookings have side
+        effects; the results of the tools that ran are saved as usual before Cancelled is
+        raised.
+        With a reply (outbound.ReplyStream) the text is sent to the customer as it streams.
+        Tokens and latency of the turn are rolled up per owner and customer (see usage.py).
+        """
+        self.turn = usage.Turn(owner_id, _id)
+        completed = False
+        try:
+            new_messages = self.run_turn(_id, messages, owner_id, cancel_token, reply)
+            completed = True
+            return new_messages
+        finally:
+            self.record_turn(completed)
+
+    def record_turn(self, completed):
+        """Adds the finished turn to the usage rollups. Accounting never fails the turn."""
+        updates = self.turn.updates(completed)
+        self.turn = None
+        if not usage.USAGE_ACCOUNTING:
+            return
+        try:
+            database.record_usage(updates)
+        except Exception as e:
+            print(f"Error recording usage: {e}")
+            metrics.incr("usage.write_errors")
+
+    def run_turn(self,_id,messages,owner_id,cancel_token=None,reply=None):
+        """The model/tool loop of process_query."""
         new_messages_for_db = [] 
-        current_conversation = messages.copy()
+        # Older turns folded into the rolling summary, stored images loaded, stale ones dropped
+        current_conversation = context.build(context.fit(
+            _id, owner_id, messages, lambda previous, transcript: summarize(previous, transcript, self.turn)
+        ))
         
         while True:
             print(f"Calling Anthropic API for {_id}. Conversation length: {len(current_conversation)}")
-            response = self.generate_response(_id, current_conversation, owner_id)
-
-            # --- Construct Assistant Message ---
-            # Start with role, get text content later
-            assistant_message_content = []
-            stop_reason = response.stop_reason
-            
-            # Extract text content if present
-            text_content = "".join([block.text for block in response.content if block.type == 'text'])
-            if text_content:
-                assistant_message_content.append({"type": "text", "text": text_content})
-
-            # Store the full assistant message structure (including potential tool_use later)
-            assistant_msg_to_save = {
-                "role": "assistant",
-                "content": assistant_message_content # Start with text, add tool_use if needed
-            }
-            
-            # --- Check for Tool Use ---
-            tool_use_blocks = [block for block in response.content if block.type == 'tool_use']
+            response = self.generate_response(_id, current_conversation, owner_id, cancel_token, reply)
+            assistant_msg_to_save, tool_use_blocks, should_save_messages = self.build_assistant_message(_id, response)
 
             if not tool_use_blocks:
                  # If no tool use, just save the text response and finish
@@ -369,59 +625,14 @@ class llm:
             else:
                 # --- Handle Tool Use ---
                 print(f"Anthropic response for {_id}: Tool use required ({len(tool_use_blocks)} tools).")
-                # Flag to determine if messages related to this tool call should be saved
-                should_save_messages = False 
-                # Add the raw tool_use blocks to the assistant message content
-                for tool_use in tool_use_blocks:
-                     func_call = {
-                         "type": "tool_use",
-                         "id": tool_use.id,
-                         "name": tool_use.name,
-                         "input": tool_use.input
-                     }
-                     assistant_message_content.append(func_call)
-                     print(tool_use.name)
-                     # Set flag if 'check_availablity' is used
-                     if tool_use.name in ["check_availablity","book_appointment","reschedule_appointment","cancel_appointment","get_user_appointments"]:
-                         should_save_messages = True # Rename flag for clarity
-                
                 current_conversation.append(assistant_msg_to_save) # Add assistant msg with tool_use to current state
                 new_messages_for_db.append(assistant_msg_to_save) # Add to messages to be returned (always)
 
-                # --- Prepare Tool Results ---
-                tool_results_content = []
-                for tool_use in tool_use_blocks:
-                    # Create the adapter object to mimic the old structure for function_call
-                    # The arguments need to be a JSON string for the existing function_call
-                    shim_arguments_json = json.dumps(tool_use.input)
-                    adapter = SimpleNamespace(
-                        function=SimpleNamespace(
-                            name=tool_use.name,
-                            arguments=shim_arguments_json
-                        )
-                    )
-                    
-                    print(f"Calling function: {tool_use.name} with input: {tool_use.input}")
-                    # Call the original function_call with the adapter
-                    function_response_data = self.function_call(adapter, _id, owner_id)
-                    # Extract the string response content
-                    function_response_content = str(function_response_data.get("function_response", "")) # Ensure string
-                    print(f"Extracted function response content: '{function_response_content}'") # <-- Print extracted content
-                    
-                    # Append the result in Anthropic's tool_result format
-                    func_response = {
-                        "type": "tool_result",
-                        "tool_use_id": tool_use.id,
-                        "content": function_response_content
-                    }
-                    tool_results_content.append(func_response)
-                
-                # Create the user message containing all tool results
-                tool_results_msg = {
-                    "role": "user", # Use 'user' role for tool results per Anthropic spec
-                    "content": tool_results_content 
-                }
-                                
+                if cancel_token is not None and cancel_token.is_cancelled():
+                    metrics.incr("llm.aborted_tool_calls", len(tool_use_blocks))
+                    raise Cancelled(cancel_token.reason)
+
+                tool_results_msg = self.run_tools(tool_use_blocks, _id, owner_id, cancel_token)
                 current_conversation.append(tool_results_msg) # Add tool results message to conversation state
                 new_messages_for_db.append(tool_results_msg) # Add tool results message to the list for return (always)
 
@@ -434,6 +645,10 @@ class llm:
                     database.add_message(_id,[tool_results_msg],owner_id)
                 else:
                     print(f"Skipping save for assistant tool request and tool results for {_id} ('check_availablity' not called).")
+
+                # Tools after the cancellation were skipped; the ones before it are saved above
+                if cancel_token is not None:
+                    cancel_token.raise_if_cancelled()
                 
                 # Continue the loop to send results back to the model
                 print(f"Looping back to Anthropic API for {_id} with tool results.")
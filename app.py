@@ -1,23 +1,79 @@
 import json
+from functools import wraps
 from flask import Flask, request, jsonify
 from flask_cors import CORS, cross_origin
 import os
 from dotenv import load_dotenv
-from message_manager import process_messages
+from message_manager import process_messages, resume_pending_batches
 import threading
 import time
 import database
 import actions
 import dashboard
+import dispatcher
+import ingest_log
+import metrics
+import owner_config
+import sessions
+import tool_registry
+import usage
 
 # Load environment variables
 load_dotenv(override=True)
 
 app = Flask(__name__)
 cors = CORS(app)
-# Add at the top of app.py
-processed_message_ids = {}
-MESSAGE_EXPIRY = 60  # seconds to remember processed messages
+REPLAY_INTERVAL = 30  # seconds between sweeps of the ingestion log
+REPLAY_AFTER = 60  # entries still unfinished after this many seconds are resubmitted
+
+def consume_notification(entry_id):
+    """Consumer stage: claims a logged webhook body and drains it into message_manager."""
+    body = ingest_log.claim(entry_id)
+    if body is None:
+        return # Already finished or being handled by another worker
+
+    try:
+        notification = json.loads(body)
+    except json.JSONDecodeError as e:
+        print(f"Discarding ingested entry {entry_id} with invalid JSON: {e}")
+        ingest_log.complete(entry_id)
+        return
+    print(f"Processing ingested notification {entry_id}: {body.decode('utf-8', 'replace')}")
+
+    try:
+        # Only messaging notifications are handled; duplicates are dropped per message mid
+        if any(entry.get("messaging") for entry in notification.get("entry", [])):
+            process_messages(notification)
+        ingest_log.complete(entry_id)
+    except Exception as e:
+        print(f"Error processing ingested notification {entry_id}: {e}")
+        ingest_log.release(entry_id)
+
+def replay_ingest_log():
+    """Re-arms owed batches on boot, then keeps resubmitting entries that never finished."""
+    try:
+        resume_pending_batches()
+    except Exception as e:
+        print(f"Error resuming pending batches: {e}")
+
+    older_than = 0 # On boot everything left in the log is replayed
+    last_compaction = 0
+    while True:
+        try:
+            for entry_id in ingest_log.unfinished(older_than=older_than):
+                if not webhook_dispatcher.submit(entry_id):
+                    break
+            if time.time() - last_compaction > 3600:
+                print(f"Compacted {ingest_log.compact()} finished or failed ingestion log entries.")
+                last_compaction = time.time()
+        except Exception as e:
+            print(f"Error replaying ingestion log: {e}")
+        older_than = REPLAY_AFTER
+        time.sleep(REPLAY_INTERVAL)
+
+# Bounded worker pool that drains the ingestion log into process_messages
+webhook_dispatcher = dispatcher.Dispatcher("webhook", consume_notification)
+threading.Thread(target=replay_ingest_log, name="ingest-replay", daemon=True).start()
 
 @app.route("/")
 def hello_world():
@@ -32,37 +88,20 @@ def privacy_policy():
 @app.route("/webhook", methods = ["GET", "POST"])
 def webhook():
     if request.method == "POST":
+        # Shed load while every worker is busy and the queue is full: Meta redelivers later
+        if webhook_dispatcher.overflow == "reject" and webhook_dispatcher.saturated():
+            metrics.incr("webhook.rejected")
+            return "Busy", 503
+
+        # Persist the raw body before acknowledging; parsing happens in the consumer stage
         try:
-            notification = request.get_json()
-            print(json.dumps(notification, indent=4))
-            
-            # Check if this is a messaging notification
-            is_message = notification["entry"][0].get("messaging", None)
-            if is_message is not None:
-                # Extract message ID for deduplication
-                message_id = notification["entry"][0]["time"]
-                
-                # Check if we've already processed this message
-                current_time = time.time()
-                if message_id in processed_message_ids:
-                    print(f"Skipping duplicate message: {message_id}")
-                    return "OK", 200
-                
-                # Mark this message as processed
-                processed_message_ids[message_id] = current_time
-                
-                # Clean up old message IDs
-                for mid in list(processed_message_ids.keys()):
-                    if current_time - processed_message_ids[mid] > MESSAGE_EXPIRY:
-                        del processed_message_ids[mid]
-                
-                # Process the message
-                thread = threading.Thread(target=process_messages, args=(notification,))
-                thread.start()
-            
+            entry_id = ingest_log.append(request.get_data())
         except Exception as e:
-           print("Error:", e)
-        
+            print("Error writing to ingestion log:", e)
+            return "Busy", 503
+
+        # If the pool filled up since the check above, the entry stays in the log and the replay sweep picks it up
+        webhook_dispatcher.submit(entry_id)
         return "OK", 200
     
     if request.method == "GET":
@@ -79,6 +118,12 @@ def webhook():
 def health_check():
     return jsonify({'status': 'healthy'}), 200
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return jsonify({'message': "Not found"}), 404
+    return jsonify(metrics.snapshot()), 200
+
 @app.route("/signup",methods=['POST'])
 def signup():
     if request.method == "POST":
@@ -106,44 +151,29 @@ def login():
             return jsonify({'stats':'logged in','user':response}), 200
         return jsonify({"message":'Invalid credentials!'}), 400
 
-@app.route('/dashboard', methods=['GET'])
-def dash():
-    if request.method == "GET":
-        # Get Authorization header
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
+def requires_session(view):
+    """Authenticates the Bearer cookie (cached, see sessions.py) and passes its account to the view as `user`."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cookie = sessions.bearer_token(request.headers.get('Authorization'))
+        if cookie is None:
             return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        user = authentication.login(cookie=cookie)
+        user = sessions.authenticate(cookie)
         if user is None:
             return jsonify({'message': "wrong credentials"}), 400
+        return view(user, *args, **kwargs)
+    return wrapper
 
-        user_id = user["_id"]
-        access_token = user["access_token"]
-        
-        if user:
-            response = dashboard.dashboard_stats(user_id,access_token)
-            # print('this is the response:',response)
-            return jsonify({'data': response}), 200
-
-        return jsonify({'message': "Access Token Expired!"}), 400
+@app.route('/dashboard', methods=['GET'])
+@requires_session
+def dash(user):
+    response = dashboard.dashboard_stats(user["_id"],user["access_token"])
+    # print('this is the response:',response)
+    return jsonify({'data': response}), 200
 
 @app.route('/switch', methods=['POST'])
-def switch():
-    
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'message': "Missing or invalid Authorization header"}), 400
-        
-    cookie = auth_header.split(' ')[1] 
-    
-    authentication = database.auth()
-    user = authentication.login(cookie=cookie)
-    if user is None:
-        return jsonify({'message': "wrong credentials"}), 400
+@requires_session
+def switch(user):
     owner_id = user["_id"]
     body = request.get_json()
     customer_id = body["userId"]
@@ -151,135 +181,86 @@ def switch():
     database.set_user_active(customer_id,is_enabled,owner_id)
     
     return jsonify({'message': "updated"}), 200
-
+
 @app.route('/turn', methods=['POST'])
-def turn():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({'message': "Missing or invalid Authorization header"}), 400
-        
-    cookie = auth_header.split(' ')[1] 
-    
-    authentication = database.auth()
-    user = authentication.login(cookie=cookie)
-    if user is None:
-        return jsonify({'message': "wrong credentials"}), 400
+@requires_session
+def turn(user):
     owner_id = user["_id"]
     body = request.get_json()
     is_enabled = body["is_enabled"]
     database.turn_bot(owner_id,is_enabled)
+    owner_config.invalidate(owner_id)
     return jsonify({'message': "updated"}), 200
-
-@app.route('/delete_customer',methods=['POST'])
-def cust():
-    if request.method == "POST":
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        user = authentication.login(cookie=cookie)
-        if user is None:
-            return jsonify({'message': "wrong credentials"}), 400
 
-        user_id = user["_id"]
-        access_token = user["access_token"]
-        
-        body = request.get_json()
-        _id = body.get("_id")
-        owner_id = body.get("owner_id") 
-        if user:
-            database.delete_customer(_id,owner_id) 
-            pass
-            return jsonify({'message': f"{_id} deleted!"}), 200
-        
-        return jsonify({'message': "couldnt delete the user"}), 400
+@app.route('/delete_customer',methods=['POST'])
+@requires_session
+def cust(user):
+    body = request.get_json()
+    _id = body.get("_id")
+    owner_id = body.get("owner_id") 
+    database.delete_customer(_id,owner_id) 
+    return jsonify({'message': f"{_id} deleted!"}), 200
 
 @app.route('/business_data',methods=['GET'])
-def deta():
-    if request.method == "GET":
-        # Get Authorization header
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        user = authentication.login(cookie=cookie)
-        if user is None:
-            return jsonify({'message': "wrong credentials"}), 400
-
-        owner_id = user["_id"]
-        
-        business_data,active = database.get_business_data(owner_id)
-
-        return jsonify({'data': business_data,"active":active}), 200
+@requires_session
+def deta(user):
+    owner_id = user["_id"]
+    business_data,active = database.get_business_data(owner_id)
+    return jsonify({'data': business_data,"active":active}), 200
 
 @app.route('/save_business_data',methods=['POST'])
-def data():
-    if request.method == "POST":
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        user = authentication.login(cookie=cookie)
-        if user is None:
-            return jsonify({'message': "wrong credentials"}), 400
-
-        owner_id = user["_id"]
-        body = request.get_json()
-        business_data = body.get("business_data")
-        database.set_dataset(int(owner_id),business_data)
-        return jsonify({'message': "Business data saved!"}), 200
+@requires_session
+def data(user):
+    owner_id = user["_id"]
+    body = request.get_json()
+    business_data = body.get("business_data")
+    database.set_dataset(int(owner_id),business_data)
+    owner_config.invalidate(owner_id)
+    tool_registry.invalidate(owner_id)
+    return jsonify({'message': "Business data saved!"}), 200
 
 @app.route('/get_notifications',methods=['GET'])
-def get_notifications():
-    if request.method == "GET":
-        # Get Authorization header
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        print("sending")
-        user = authentication.login(cookie=cookie)
-        if user is None:
-            return jsonify({'message': "wrong credentials"}), 400
-        owner_id = user.get("_id")
-        notificaitons = database.get_notifications(owner_id)
-        return jsonify({'notifications': notificaitons}), 200
+@requires_session
+def get_notifications(user):
+    owner_id = user.get("_id")
+    notificaitons = database.get_notifications(owner_id)
+    return jsonify({'notifications': notificaitons}), 200
+
+@app.route('/usage',methods=['GET'])
+@requires_session
+def get_usage(user):
+    try:
+        days = min(max(int(request.args.get("days", 7)), 1), usage.USAGE_MAX_DAYS)
+    except ValueError:
+        return jsonify({'message': "days must be a number"}), 400
+    daily, top_senders = database.get_usage(user["_id"], usage.since(days))
+    return jsonify({'usage': usage.report(daily, top_senders)}), 200
 
 @app.route('/read_notification',methods=['POST'])
-def read_notification():
-    if request.method == "POST":
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({'message': "Missing or invalid Authorization header"}), 400
-            
-        cookie = auth_header.split(' ')[1]  # Extract token after 'Bearer '
-        
-        authentication = database.auth()
-        user = authentication.login(cookie=cookie)
-        if user is None:
-            return jsonify({'message': "wrong credentials"}), 400
-
-        owner_id = user["_id"]
-        body = request.get_json()
-        notification_id = body.get("notification_id")        
-
-        database.read_notification(notification_id)
+@requires_session
+def read_notification(user):
+    body = request.get_json()
+    notification_id = body.get("notification_id")        
+    database.read_notification(notification_id)
+    return jsonify({'message': "message marked as read"}), 200
 
-        return jsonify({'message': "message marked as read"}), 200
-        
 
+@app.route('/logout',methods=['POST'])
+@requires_session
+def logout(user):
+    database.auth().logout(user["_id"])
+    sessions.invalidate_user(user["_id"])
+    return jsonify({'message': "logged out"}), 200
+
+@app.route('/change_password',methods=['POST'])
+@requires_session
+def change_password(user):
+    body = request.get_json()
+    cookie = database.auth().change_password(user["_id"],body.get("password"),body.get("new_password"))
+    if cookie is None:
+        return jsonify({'message': "wrong credentials"}), 400
+    sessions.invalidate_user(user["_id"])
+    return jsonify({'message': "password changed","cookie":cookie}), 200
     
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
@@ -0,0 +1,578 @@
+# Asyncio serving mode: the same routes as app.py on a single event loop.
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+# Batches go through the same stages as message_manager: preemption of unsent chunks,
+# per-message debounce windows that may only shorten a pending wait, streamed replies,
+# and delivery through outbound.py (its threads do the Graph API sends).
+import asyncio
+import json
+import os
+import time
+import traceback
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import ai
+import async_clients as aio
+import cancellation
+import context
+import dashboard
+import debounce
+import dedup
+import dispatcher
+import faq
+import ingest_log
+import message_manager
+import metrics
+import outbound
+import owner_config
+import retry
+import sessions
+import tool_registry
+import usage
+from coordination import COORDINATION_BACKEND, coordinator
+
+REPLAY_INTERVAL = 30 # seconds between sweeps of the ingestion log
+REPLAY_AFTER = 60 # entries still unfinished after this many seconds are resubmitted
+WEBHOOK_CONCURRENCY = int(os.getenv("ASGI_WEBHOOK_CONCURRENCY", 64)) # logged webhook bodies consumed at once
+# Consumers running or waiting for a slot, like the threaded path's webhook pool plus its queue
+WEBHOOK_MAX_CONSUMERS = WEBHOOK_CONCURRENCY + dispatcher.DISPATCH_QUEUE_SIZE
+
+# --- Per-sender batching state ---
+# Shared with the threaded path through the coordinator; only the timer tasks are local
+BatchTimer = namedtuple("BatchTimer", ["deadline", "task"]) # deadline in loop.time()
+batch_timers = {} # sender_id -> BatchTimer of the task sleeping until the batch is due
+_background_tasks = set() # strong references so fire-and-forget tasks are not garbage collected
+_webhook_slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+_webhook_consumers = 0 # consume_notification tasks running or waiting for a slot
+
+metrics.register_gauge("asgi.webhook_consumers", lambda: _webhook_consumers)
+
+metrics.register_gauge("asgi.batch_timers", lambda: len(batch_timers))
+
+async def _coordinate(method, *args):
+    """Calls the coordinator, off the event loop when it talks to Mongo."""
+    if COORDINATION_BACKEND == "mongo":
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+async def _owner_config(owner_id):
+    """owner_config.get without blocking the event loop on a cache miss."""
+    config = owner_config.cached(owner_id)
+    if config is None:
+        config = owner_config.remember(owner_id, owner_config.from_document(await aio.get_owner_config(owner_id)))
+    return config
+
+async def _until_cancelled(coro, cancel_token):
+    """Awaits coro, cancelling it (and the HTTP request behind it) as soon as cancel_token fires."""
+    task = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    stop_watching = cancel_token.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if cancel_token.was_cancelled(): # Set by the callback above; no need to poll
+            raise cancellation.Cancelled(cancel_token.reason)
+        raise
+    finally:
+        stop_watching()
+
+class AsyncLLM(ai.llm):
+    """ai.llm driven by the async Anthropic client; tools still run on the default executor."""
+
+    def __init__(self, owner_id, instruction):
+        self.owner_id = owner_id
+        self.responseType = "text"
+        self.tools = ai.tools
+        self.instruction = instruction
+        self.client = aio.anthropic_client()
+
+    async def astream_response(self, messages, reply, streamed):
+        """Async counterpart of ai.llm.stream_response, delivering text to reply as it is generated."""
+        started = time.time()
+        first_block_seen = False
+        reply.start()
+        async with self.client.messages.stream(**self.request_kwargs(messages)) as stream:
+            async for event in stream:
+                if event.type == "content_block_start" and not first_block_seen:
+                    first_block_seen = True
+                    metrics.observe("llm.first_token_seconds", time.time() - started)
+                if event.type == "text":
+                    streamed[0] += len(event.text)
+                    reply.feed(event.text)
+                elif event.type == "content_block_stop" and event.content_block.type == "text":
+                    reply.end_text()
+            response = await stream.get_final_message()
+        reply.finish()
+        return response
+
+    async def agenerate_response(self, _id, messages, owner_id, cancel_token, reply=None):
+        async def attempt():
+            # Polling the token may read Mongo (coordinator.has_newer), so not on the loop
+            await asyncio.to_thread(cancel_token.raise_if_cancelled)
+            started = time.time()
+            streamed = [0] # characters already streamed, for the abort metrics
+            if reply is not None:
+                call = self.astream_response(messages, reply, streamed)
+            else:
+                call = self.client.messages.create(**self.request_kwargs(messages))
+            try:
+                response = await _until_cancelled(call, cancel_token)
+            except cancellation.Cancelled:
+                self.record_abort(started, streamed[0])
+                raise
+            self.record_usage(response, started)
+            return response
+
+        try:
+            return await retry.acall(attempt, tokens=context.estimate_tokens(messages))
+        except (cancellation.Cancelled, retry.RetryLater):
+            raise
+        except Exception as e:
+            print(f"Anthropic API call failed for {_id}: {e}")
+            traceback.print_exc()
+            raise
+
+    async def aprocess_query(self, _id, messages, owner_id, cancel_token, reply=None):
+        """Same cancellation, streaming and usage accounting as ai.llm.process_query."""
+        self.turn = usage.Turn(owner_id, _id)
+        completed = False
+        try:
+            new_messages = await self.arun_turn(_id, messages, owner_id, cancel_token, reply)
+            completed = True
+            return new_messages
+        finally:
+            await self.arecord_turn(completed)
+
+    async def arecord_turn(self, completed):
+        updates = self.turn.updates(completed)
+        self.turn = None
+        if not usage.USAGE_ACCOUNTING:
+            return
+        try:
+            await aio.record_usage(updates)
+        except Exception as e:
+            print(f"Error recording usage: {e}")
+            metrics.incr("usage.write_errors")
+
+    async def arun_turn(self, _id, messages, owner_id, cancel_token, reply=None):
+        new_messages_for_db = []
+        current_conversation = await asyncio.to_thread(lambda: context.build(context.fit(
+            _id, owner_id, messages, lambda previous, transcript: ai.summarize(previous, transcript, self.turn)
+        )))
+        while True:
+            print(f"Calling Anthropic API for {_id}. Conversation length: {len(current_conversation)}")
+            response = await self.agenerate_response(_id, current_conversation, owner_id, cancel_token, reply)
+            assistant_msg_to_save, tool_use_blocks, should_save_messages = self.build_assistant_message(_id, response)
+            current_conversation.append(assistant_msg_to_save)
+            new_messages_for_db.append(assistant_msg_to_save)
+            if not tool_use_blocks:
+                break
+
+            if await asyncio.to_thread(cancel_token.is_cancelled):
+                metrics.incr("llm.aborted_tool_calls", len(tool_use_blocks))
+                raise cancellation.Cancelled(cancel_token.reason)
+            tool_results_msg = await asyncio.to_thread(self.run_tools, tool_use_blocks, _id, owner_id, cancel_token)
+            current_conversation.append(tool_results_msg)
+            new_messages_for_db.append(tool_results_msg)
+            if should_save_messages:
+                await aio.append_messages(_id, [assistant_msg_to_save, tool_results_msg], owner_id)
+            await asyncio.to_thread(cancel_token.raise_if_cancelled)
+        return new_messages_for_db
+
+# --- Batching ---
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def _arm_batch(sender_id, owner_id, delay):
+    """Sets the deadline for a batch whose timer the caller has claimed from the coordinator."""
+    async def fire():
+        await asyncio.sleep(delay)
+        await process_message_batch(sender_id, owner_id)
+    batch_timers[sender_id] = BatchTimer(asyncio.get_running_loop().time() + delay, _spawn(fire()))
+
+def _advance_batch(sender_id, owner_id, delay):
+    """
+    Moves this process's pending batch timer for sender_id earlier (never later), like
+    batch_scheduler.advance in message_manager. Returns True if it moved.
+    """
+    timer = batch_timers.get(sender_id)
+    if timer is None or timer.deadline <= asyncio.get_running_loop().time() + delay:
+        return False
+    # Still sleeping: process_message_batch drops the entry before its first await
+    timer.task.cancel()
+    _arm_batch(sender_id, owner_id, delay)
+    return True
+
+async def process_message_batch(sender_id, owner_id):
+    """Async counterpart of message_manager.process_message_batch."""
+    batch_timers.pop(sender_id, None)
+    lease = await _coordinate(coordinator.try_begin, sender_id)
+    if lease is None:
+        return
+    started_at = time.time()
+    cancel_token = cancellation.CancellationToken(
+        check=lambda: coordinator.has_newer(sender_id, lease), poll_interval=message_manager.CANCEL_POLL_INTERVAL
+    )
+    cancellation.register(sender_id, cancel_token)
+    reply = outbound.ReplyStream(sender_id) if message_manager.STREAM_REPLIES else None
+
+    ai_generated_messages = []
+    retry_later = None
+    try:
+        owner_id_str = str(owner_id)
+        final_conversation_history = await aio.get_conversation(sender_id, owner_id_str)
+
+        # Short DB history: sync from the Instagram API first, as the threaded path does
+        if len(final_conversation_history) < 4:
+            api_conversation_messages = await aio.get_user_conversation(sender_id)
+            if api_conversation_messages and len(api_conversation_messages) > len(final_conversation_history):
+                formatted_api_messages = await asyncio.to_thread(
+                    message_manager.format_api_messages, api_conversation_messages, sender_id, owner_id_str
+                )
+                if formatted_api_messages and await aio.set_conversation(sender_id, owner_id_str, formatted_api_messages):
+                    final_conversation_history = formatted_api_messages
+
+        config = await _owner_config(owner_id_str)
+        if await aio.check_user_active(sender_id, owner_id_str) and config.active:
+            faq_answer = None
+            if final_conversation_history and faq.FAQ_FAST_PATH:
+                faq_answer = await asyncio.to_thread(faq.answer, owner_id_str, sender_id, final_conversation_history)
+            if faq_answer is not None:
+                ai_generated_messages = [faq_answer]
+            elif final_conversation_history:
+                llm = AsyncLLM(owner_id_str, config.instruction)
+                ai_generated_messages = await llm.aprocess_query(sender_id, final_conversation_history, owner_id_str, cancel_token, reply)
+        else:
+            print(f"User {sender_id} or Bot ({owner_id_str}) is not active. Skipping AI processing.")
+    except cancellation.Cancelled as e:
+        print(f"Aborted processing for {sender_id}: {e}")
+        ai_generated_messages = []
+    except retry.RetryLater as e:
+        print(f"Deferring batch for {sender_id}: {e}")
+        retry_later = e
+        ai_generated_messages = []
+    except Exception as e:
+        print(f"Error during processing/syncing for {sender_id}: {e}\n{traceback.format_exc()}")
+        ai_generated_messages = []
+    finally:
+        cancellation.unregister(sender_id, cancel_token)
+        should_reschedule = await _coordinate(coordinator.finish, sender_id, lease)
+        if not should_reschedule and retry_later is not None:
+            # Still owed: the ingestion log keeps it and the batch runs again later
+            if await _coordinate(coordinator.claim_timer, sender_id, retry_later.delay):
+                _arm_batch(sender_id, owner_id, retry_later.delay)
+        elif not should_reschedule:
+            reply_texts = message_manager.user_facing_content(ai_generated_messages)
+            if reply is not None and reply.delivered:
+                print(f"Reply to {sender_id} was streamed ({reply.delivered} chunks).")
+            elif reply_texts:
+                # Like the threaded path, only the final text is sent
+                outbound.deliver(sender_id, reply_texts[-1])
+            await asyncio.to_thread(ingest_log.forget_batch, sender_id, owner_id, started_at)
+        else:
+            print(f"New message arrived for {sender_id} during processing. Discarding response and rescheduling.")
+            _arm_batch(sender_id, owner_id, 0.1)
+
+async def _save_batch(_id, owner_id, batch):
+    if not batch["messages"] or await aio.append_messages(_id, batch["messages"], owner_id):
+        batch["saved"] = True
+        await asyncio.to_thread(dedup.record, batch["mids"])
+        return
+    raise RuntimeError(f"Failed to save {len(batch['messages'])} message(s) for {_id}")
+
+async def _record_user_messages(sender, owner_id, batch):
+    # Same order as message_manager: save, then count, then claim the timer
+    await _save_batch(sender, owner_id, batch)
+    await _coordinate(coordinator.touch, sender)
+    cancellation.cancel(sender)
+    outbound.preempt(sender)
+    await asyncio.to_thread(ingest_log.remember_batch, sender, owner_id)
+    typical_gap = await asyncio.to_thread(debounce.learn, sender, owner_id, time.time())
+    window = debounce.choose_window(batch["messages"], typical_gap)
+    if await _coordinate(coordinator.claim_timer, sender, window):
+        print(f"Starting {window:.1f}s batch timer for {sender}")
+        _arm_batch(sender, owner_id, window)
+    elif _advance_batch(sender, owner_id, window):
+        print(f"Moved batch timer for {sender} to {window:.1f}s from now.")
+
+async def consume_notification(entry_id):
+    """Consumer stage for one logged webhook body, mirroring app.consume_notification."""
+    body = await asyncio.to_thread(ingest_log.claim, entry_id)
+    if body is None:
+        return
+    try:
+        notification = json.loads(body)
+    except json.JSONDecodeError as e:
+        print(f"Discarding ingested entry {entry_id} with invalid JSON: {e}")
+        await asyncio.to_thread(ingest_log.complete, entry_id)
+        return
+
+    user_batches, owner_batches = {}, {}
+    failed = 0
+    try:
+        if any(entry.get("messaging") for entry in notification.get("entry", [])):
+            # Parsing may download attachments, so it runs off the event loop
+            user_batches, owner_batches = await asyncio.to_thread(message_manager.collect_events, notification)
+            # Each group on its own, as in message_manager.process_messages
+            for (recipient_user_id, owner_id), batch in owner_batches.items():
+                try:
+                    await _save_batch(recipient_user_id, owner_id, batch)
+                except Exception as e:
+                    print(f"Error saving owner messages for {recipient_user_id}: {e}")
+                    failed += 1
+            for (sender, owner_id), batch in user_batches.items():
+                try:
+                    await _record_user_messages(sender, owner_id, batch)
+                except Exception as e:
+                    print(f"Error recording messages of {sender}: {e}")
+                    failed += 1
+    except Exception as e:
+        print(f"Error processing ingested notification {entry_id}: {e}")
+        failed += 1
+    if not failed:
+        await asyncio.to_thread(ingest_log.complete, entry_id)
+        return
+    # The replay must not drop the groups that were not saved as duplicates
+    await asyncio.to_thread(message_manager.forget_unsaved, owner_batches, user_batches)
+    await asyncio.to_thread(ingest_log.release, entry_id)
+
+def _webhook_saturated():
+    return _webhook_consumers >= WEBHOOK_MAX_CONSUMERS
+
+def _consume_later(entry_id):
+    """Spawns a consumer for a logged entry unless WEBHOOK_MAX_CONSUMERS are pending. Returns True if spawned."""
+    global _webhook_consumers
+    if _webhook_saturated():
+        return False
+    _webhook_consumers += 1
+
+    async def consume():
+        global _webhook_consumers
+        try:
+            async with _webhook_slots:
+                await consume_notification(entry_id)
+        finally:
+            _webhook_consumers -= 1
+    _spawn(consume())
+    return True
+
+async def replay_ingest_log():
+    for sender_id, owner_id in await asyncio.to_thread(ingest_log.take_pending_batches):
+        await asyncio.to_thread(ingest_log.remember_batch, sender_id, owner_id)
+        if await _coordinate(coordinator.claim_timer, sender_id, debounce.BATCH_WINDOW):
+            _arm_batch(sender_id, owner_id, debounce.BATCH_WINDOW)
+
+    older_than = 0
+    last_compaction = 0
+    while True:
+        try:
+            for entry_id in await asyncio.to_thread(ingest_log.unfinished, older_than=older_than):
+                if not _consume_later(entry_id):
+                    break # Saturated; the next sweep picks the rest up
+            if time.time() - last_compaction > 3600:
+                print(f"Compacted {await asyncio.to_thread(ingest_log.compact)} finished or failed ingestion log entries.")
+                last_compaction = time.time()
+        except Exception as e:
+            print(f"Error replaying ingestion log: {e}")
+        older_than = REPLAY_AFTER
+        await asyncio.sleep(REPLAY_INTERVAL)
+
+# --- Routes ---
+async def _authenticate(request):
+    """Returns (user, None) for a valid Bearer cookie, otherwise (None, error_response)."""
+    cookie = sessions.bearer_token(request.headers.get('Authorization'))
+    if cookie is None:
+        return None, JSONResponse({'message': "Missing or invalid Authorization header"}, status_code=400)
+    user = sessions.get(cookie)
+    if user is None:
+        user = sessions.remember(cookie, await aio.login(cookie=cookie))
+    if user is None:
+        return None, JSONResponse({'message': "wrong credentials"}, status_code=400)
+    return user, None
+
+async def hello_world(request):
+    return HTMLResponse("<p>Hello, World!</p>")
+
+async def privacy_policy(request):
+    with open("./privacy_policy.html", "rb") as file:
+        return HTMLResponse(file.read())
+
+async def webhook(request):
+    if request.method == "POST":
+        # Shed load like app.webhook: Meta redelivers later
+        if dispatcher.DISPATCH_OVERFLOW == "reject" and _webhook_saturated():
+            metrics.incr("webhook.rejected")
+            return PlainTextResponse("Busy", status_code=503)
+        try:
+            entry_id = await asyncio.to_thread(ingest_log.append, await request.body())
+        except Exception as e:
+            print("Error writing to ingestion log:", e)
+            return PlainTextResponse("Busy", status_code=503)
+        # If saturated meanwhile, the entry stays in the log and the replay sweep picks it up
+        _consume_later(entry_id)
+        return PlainTextResponse("OK")
+
+    hub_challenge = request.query_params.get("hub.challenge")
+    if hub_challenge:
+        return PlainTextResponse(hub_challenge)
+    return HTMLResponse("<p>This is GET Request, Hello Webhook!</p>")
+
+async def health_check(request):
+    return JSONResponse({'status': 'healthy'})
+
+async def get_metrics(request):
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return JSONResponse({'message': "Not found"}, status_code=404)
+    return JSONResponse(metrics.snapshot())
+
+async def signup(request):
+    creds = await request.json()
+    await aio.signup(creds.get("_id"), creds.get("email"), creds.get("password"), creds.get("access_token"))
+    return JSONResponse({'stats': 'signed up'})
+
+async def login(request):
+    creds = await request.json()
+    user = await aio.login(username=creds.get("username"), password=creds.get("password"))
+    if user:
+        response = {"_id": user["_id"], "username": user["username"], "cookie": user["cookie"]}
+        return JSONResponse({'stats': 'logged in', 'user': response})
+    return JSONResponse({"message": 'Invalid credentials!'}, status_code=400)
+
+async def dash(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    # dashboard_stats mixes file caches, Graph API and Mongo reads; keep it off the loop
+    response = await asyncio.to_thread(dashboard.dashboard_stats, user["_id"], user["access_token"])
+    return Response(json.dumps({'data': response}, default=str), media_type="application/json")
+
+async def switch(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    await aio.set_user_active(body["userId"], body["is_enabled"], user["_id"])
+    return JSONResponse({'message': "updated"})
+
+async def turn(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    await aio.turn_bot(user["_id"], body["is_enabled"])
+    owner_config.invalidate(user["_id"])
+    return JSONResponse({'message': "updated"})
+
+async def cust(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    _id = body.get("_id")
+    await aio.delete_customer(_id, body.get("owner_id"))
+    return JSONResponse({'message': f"{_id} deleted!"})
+
+async def deta(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    business_data, active = await aio.get_business_data(user["_id"])
+    return JSONResponse({'data': business_data, "active": active})
+
+async def data(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    await aio.set_dataset(int(user["_id"]), body.get("business_data"))
+    owner_config.invalidate(user["_id"])
+    tool_registry.invalidate(user["_id"])
+    return JSONResponse({'message': "Business data saved!"})
+
+async def get_notifications(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    notifications = await aio.get_notifications(user.get("_id"))
+    return JSONResponse({'notifications': notifications})
+
+async def read_notification(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    await aio.read_notification(body.get("notification_id"))
+    return JSONResponse({'message': "message marked as read"})
+
+async def get_usage(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    try:
+        days = min(max(int(request.query_params.get("days", 7)), 1), usage.USAGE_MAX_DAYS)
+    except ValueError:
+        return JSONResponse({'message': "days must be a number"}, status_code=400)
+    daily, top_senders = await aio.get_usage(user["_id"], usage.since(days))
+    return JSONResponse({'usage': usage.report(daily, top_senders)})
+
+async def logout(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    await aio.logout(user["_id"])
+    sessions.invalidate_user(user["_id"])
+    return JSONResponse({'message': "logged out"})
+
+async def change_password(request):
+    user, error = await _authenticate(request)
+    if error:
+        return error
+    body = await request.json()
+    cookie = await aio.change_password(user["_id"], body.get("password"), body.get("new_password"))
+    if cookie is None:
+        return JSONResponse({'message': "wrong credentials"}, status_code=400)
+    sessions.invalidate_user(user["_id"])
+    return JSONResponse({'message': "password changed", "cookie": cookie})
+
+@asynccontextmanager
+async def lifespan(app):
+    replay_task = asyncio.create_task(replay_ingest_log())
+    yield
+    replay_task.cancel()
+    await aio.close()
+
+routes = [
+    Route("/", hello_world),
+    Route("/privacy_policy", privacy_policy),
+    Route("/webhook", webhook, methods=["GET", "POST"]),
+    Route("/health", health_check),
+    Route("/metrics", get_metrics),
+    Route("/signup", signup, methods=["POST"]),
+    Route("/login", login, methods=["POST"]),
+    Route("/dashboard", dash),
+    Route("/switch", switch, methods=["POST"]),
+    Route("/turn", turn, methods=["POST"]),
+    Route("/delete_customer", cust, methods=["POST"]),
+    Route("/business_data", deta),
+    Route("/save_business_data", data, methods=["POST"]),
+    Route("/get_notifications", get_notifications),
+    Route("/read_notification", read_notification, methods=["POST"]),
+    Route("/usage", get_usage),
+    Route("/logout", logout, methods=["POST"]),
+    Route("/change_password", change_password, methods=["POST"]),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import os
+import time
+
+import anthropic
+import httpx
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+
+import database
+import graph_api
+import usage
+
+load_dotenv(override=True)
+
+MONGO_URL = os.getenv('MONGO_URL')
+API_KEY = os.getenv("AI_API_KEY")
+# httpcore's pool does O(connections) work per request, so large concurrency is spread
+# over several small pools instead of one big one
+CLIENT_SHARDS = int(os.getenv("ASYNC_CLIENT_SHARDS", 8))
+CONNECTIONS_PER_SHARD = 64
+
+# Clients are bound to the running event loop, so they are created lazily inside it
+_mongo = None
+_http = None
+_anthropic = None
+
+def db():
+    global _mongo
+    if _mongo is None:
+        _mongo = AsyncMongoClient(MONGO_URL)
+    return _mongo['BeautySalonChats']
+
+def http():
+    global _http
+    if _http is None:
+        # Same timeouts as graph_api.client; connection failures are retried (never a sent POST)
+        _http = httpx.AsyncClient(
+            timeout=httpx.Timeout(graph_api.GRAPH_READ_TIMEOUT, connect=graph_api.GRAPH_CONNECT_TIMEOUT),
+            transport=httpx.AsyncHTTPTransport(
+                retries=graph_api.GRAPH_RETRIES, limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+            ),
+        )
+    return _http
+
+def anthropic_client():
+    """Returns one of CLIENT_SHARDS AsyncAnthropic clients, round-robin."""
+    global _anthropic
+    if _anthropic is None:
+        limits = httpx.Limits(max_connections=CONNECTIONS_PER_SHARD, max_keepalive_connections=CONNECTIONS_PER_SHARD)
+        _anthropic = itertools.cycle([
+            # max_retries=0: retry.acall owns retries, shared with the threaded path
+            anthropic.AsyncAnthropic(api_key=API_KEY, max_retries=0, http_client=anthropic.DefaultAsyncHttpxClient(limits=limits))
+            for _ in range(CLIENT_SHARDS)
+        ])
+    return next(_anthropic)
+
+async def close():
+    global _mongo, _http, _anthropic
+    if _http is not None:
+        await _http.aclose()
+    if _anthropic is not None:
+        for _ in range(CLIENT_SHARDS):
+            await next(_anthropic).close()
+    if _mongo is not None:
+        await _mongo.close()
+    _mongo = _http = _anthropic = None
+
+# --- Mongo (async mirror of database.py) ---
+async def get_conversation(_id, owner_id):
+    user = await db()['users'].find_one({"_id": _id, "owner_id": owner_id})
+    return user.get("conversation", []) if user else []
+
+async def append_messages(_id, messages, owner_id):
+    """Appends a batch of messages to a user's conversation with a single write (no read-back)."""
+    if not messages:
+        return False
+    try:
+        await db()['users'].update_one(
+            {"_id": _id, "owner_id": owner_id},
+            {
+                "$push": {"conversation": {"$each": messages}},
+                "$setOnInsert": {"active": True, "owner_id": owner_id}
+            },
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        print(f"Error appending {len(messages)} messages for user {_id}: {e}")
+        return False
+
+async def set_conversation(_id, owner_id, messages):
+    try:
+        await db()['users'].update_one(
+            {"_id": _id, "owner_id": owner_id},
+            {
+                "$set": {"conversation": messages},
+                "$unset": {"summary": "", "summary_upto": ""},
+                "$setOnInsert": {"active": True, "owner_id": owner_id}
+            },
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        print(f"Error in set_conversation for user {_id}: {e}")
+        return False
+
+async def check_user_active(_id, owner_id):
+    user = await db()['users'].find_one({"_id": _id, "owner_id": owner_id}, {"active": 1})
+    return user.get("active", True)
+
+async def check_bot_active(_id):
+    bot = await db()['data'].find_one({"_id": int(_id)}, {"active": 1})
+    return bot.get("active", True)
+
+async def get_owner_config(owner_id):
+    return await db()['data'].find_one({"_id": int(owner_id)}, {"instruction": 1, "dataset": 1, "active": 1, "_id": 0})
+
+async def get_instruction(owner_id):
+    instruction_entry = await db()['data'].find_one({"_id": int(owner_id)}, {"instruction": 1, "_id": 0})
+    return instruction_entry.get("instruction") if instruction_entry else None
+
+async def set_user_active(_id, enabled, owner_id):
+    await db()['users'].update_one({"_id": _id}, {"$set": {"active": enabled}})
+
+async def turn_bot(_id, enabled):
+    await db()['data'].update_one({"_id": int(_id)}, {"$set": {"active": enabled}}, upsert=True)
+
+async def delete_customer(_id, owner_id):
+    await db()['users'].delete_one({"_id": _id, "owner_id": owner_id})
+
+async def get_business_data(_id):
+    data = await db()['data'].find_one({"_id": int(_id)})
+    return data["dataset"], data["active"]
+
+async def set_dataset(_id, dataset):
+    await db()['data'].update_one({"_id": int(_id)}, {"$set": {"dataset": dataset}}, upsert=True)
+
+_usage_index_ready = False
+
+async def record_usage(updates):
+    for collection, query, update in updates:
+        await db()[collection].update_one(query, update, upsert=True)
+
+async def get_usage(owner_id, first_day):
+    global _usage_index_ready
+    if not _usage_index_ready:
+        await db()[usage.DAILY].create_index([("owner_id", 1), ("day", 1)])
+        await db()[usage.SENDERS].create_index([("owner_id", 1), ("day", 1)])
+        _usage_index_ready = True
+    daily = await db()[usage.DAILY].find({"owner_id": str(owner_id), "day": {"$gte": first_day}}).to_list(None)
+    cursor = await db()[usage.SENDERS].aggregate(usage.top_senders_pipeline(owner_id, first_day))
+    return daily, await cursor.to_list(None)
+
+async def get_notifications(_id):
+    notis = []
+    async for notification in db()['notifications'].find({"owner_id": _id}):
+        notification["_id"] = str(notification.get("_id"))
+        notis.append(notification)
+    return notis
+
+async def read_notification(_id):
+    await db()['notifications'].update_one({"_id": ObjectId(_id)}, {"$set": {"viewed": True}})
+
+async def login(cookie=None, username=None, password=None):
+    if username is None and cookie is not None:
+        return await db()['creds'].find_one({"cookie": cookie})
+    return await db()['creds'].find_one({"username": username, "password": password})
+
+async def signup(_id, username, password, access_token):
+    # Cookie generation stays in one place
+    await asyncio.to_thread(database.auth().signup, _id, username, password, access_token)
+
+async def logout(_id):
+    await asyncio.to_thread(database.auth().logout, _id)
+
+async def change_password(_id, password, new_password):
+    return await asyncio.to_thread(database.auth().change_password, _id, password, new_password)
+
+# --- Instagram Graph API (async mirror of actions.py) ---
+# Replies are not sent from here: both serving modes deliver them through outbound.py
+async def get_user_conversation(user_id):
+    """Fetches a user's conversation (oldest first), or None on error."""
+    access_token = os.environ.get("long_access_token")
+    if not access_token:
+        print("Error: Long-lived access token not found in environment variables.")
+        return None
+
+    url = graph_api.client.url("me/conversations")
+    params = {
+        "platform": "instagram",
+        "fields": "participants,message,messages{created_time,from,message,reactions,shares,attachments}",
+        "access_token": access_token,
+        "user_id": user_id
+    }
+    started = time.time()
+    try:
+        response = await http().get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        graph_api.client.record("conversations", started, False)
+    except httpx.HTTPError as e:
+        graph_api.client.record("conversations", started, True)
+        print(f"Error fetching conversation for user_id {user_id}: {e}")
+        return None
+
+    if data and data.get("data"):
+        conversation_thread = data["data"][0]
+        if "messages" in conversation_thread and "data" in conversation_thread["messages"]:
+            return conversation_thread["messages"]["data"][::-1]
+    return []
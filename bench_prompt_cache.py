@@ -0,0 +1,96 @@
+"""
+Replays a recorded workload against the model with prompt caching off and on and
+reports time to first token, token counts and cost for both.
+
+A workload is a JSON list of stored conversations (message lists as kept in
+Users.conversation). Record one from Mongo first:
+
+  python bench_prompt_cache.py --owner OWNER_ID --record --limit 20
+
+then replay it (this makes real, billed API calls: two per customer turn):
+
+  python bench_prompt_cache.py --owner OWNER_ID
+
+Each conversation is replayed turn by turn: the call for a turn sends the
+conversation up to that customer message, so later turns can reuse the prefix
+cached by earlier ones as live traffic would. Only the first model call of each
+turn is made; tools are not executed.
+"""
+import argparse
+import json
+import time
+
+import ai
+import context
+import database
+import metrics
+import usage
+
+def record(owner_id, limit, path):
+    users = database.Users.find(
+        {"owner_id": owner_id, "conversation.1": {"$exists": True}}, {"conversation": 1}
+    ).sort("last_message_at", -1).limit(limit)
+    workload = [user["conversation"] for user in users]
+    with open(path, "w") as f:
+        json.dump(workload, f, default=str)
+    print(f"Recorded {len(workload)} conversations to {path}")
+
+def _turn_prefixes(conversation):
+    """The prefix of the conversation ending at each customer message, in order."""
+    return [conversation[:index + 1] for index, message in enumerate(conversation) if context.is_customer_turn(message)]
+
+def replay(llm, workload, caching):
+    llm.prompt_cache = caching
+    calls = []
+    for conversation in workload:
+        for prefix in _turn_prefixes(conversation):
+            started = time.time()
+            first_token = None
+            with llm.client.messages.stream(**llm.request_kwargs(context.build(prefix))) as stream:
+                for event in stream:
+                    if first_token is None and event.type == "content_block_start":
+                        first_token = time.time() - started
+                tokens = usage.tokens_of(stream.get_final_message().usage)
+            calls.append({"first_token": first_token if first_token is not None else time.time() - started, **tokens})
+    return calls
+
+def _summary(calls, input_price, output_price):
+    first_tokens = sorted(call["first_token"] for call in calls)
+    totals = {key: sum(call[key] for call in calls) for key in usage.TOKEN_FIELDS}
+    cost = usage.cost(totals, input_price, output_price)
+    return metrics.percentile(first_tokens, 50), metrics.percentile(first_tokens, 95), totals, cost
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--owner", required=True, help="owner whose instruction (and conversations, with --record) are used")
+    parser.add_argument("--workload", default="prompt_cache_workload.json")
+    parser.add_argument("--record", action="store_true", help="record a workload from Mongo instead of replaying one")
+    parser.add_argument("--limit", type=int, default=20, help="conversations to record")
+    parser.add_argument("--input-price", type=float, default=usage.LLM_INPUT_PRICE, help="USD per million input tokens")
+    parser.add_argument("--output-price", type=float, default=usage.LLM_OUTPUT_PRICE, help="USD per million output tokens")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.owner, args.limit, args.workload)
+        return
+
+    with open(args.workload) as f:
+        workload = json.load(f)
+    llm = ai.llm(args.owner)
+    rows = [(label, replay(llm, workload, caching)) for label, caching in (("off", False), ("on", True))]
+
+    print(f"{len(workload)} conversations, {len(rows[0][1])} calls per mode, model {ai.ModelName}")
+    print(f"{'caching':<9}{'TTFT p50':>10}{'TTFT p95':>10}{'input':>10}{'cache rd':>10}{'cache wr':>10}{'output':>10}{'cost $':>10}")
+    costs = []
+    for label, calls in rows:
+        p50, p95, totals, cost = _summary(calls, args.input_price, args.output_price)
+        costs.append(cost)
+        print(
+            f"{label:<9}{p50:>10.2f}{p95:>10.2f}{totals['input_tokens']:>10}{totals['cache_read_tokens']:>10}"
+            f"{totals['cache_write_tokens']:>10}{totals['output_tokens']:>10}{cost:>10.4f}"
+        )
+    if costs[0]:
+        print(f"Caching changes cost by {100 * (costs[1] - costs[0]) / costs[0]:+.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Cost of waiting on a slow upstream with threads versus asyncio tasks.
+
+This is a model of the two serving modes, not a benchmark of them: it does not run
+message_manager, asgi.py, Mongo or the outbound stage. It holds N concurrent
+conversations that each wait on a local fake LLM endpoint (it answers after --latency
+seconds):
+
+  threaded: one OS thread per conversation doing a blocking `requests` call, which is
+            what a batch on message_manager's batch pool holds during a model call.
+  asyncio:  one task per conversation on a single event loop using httpx, which is
+            what a batch of the asgi.py serving mode holds during a model call.
+
+Usage: python bench_serving.py --conversations 500 --latency 2
+(raise `ulimit -n` for more than ~900 conversations).
+"""
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import threading
+import time
+
+import httpx
+import requests
+
+CONNECTIONS_PER_SHARD = 64
+
+async def _fake_upstream(reader, writer, latency):
+    """Minimal HTTP/1.1 server that replies with a small JSON body after `latency` seconds."""
+    try:
+        while True:
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in headers.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            if length:
+                await reader.readexactly(length)
+            await asyncio.sleep(latency)
+            body = b'{"content":[{"type":"text","text":"ok"}]}'
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+def _serve_upstream(latency, port_queue):
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(
+        lambda r, w: _fake_upstream(r, w, latency), "127.0.0.1", 0, backlog=4096
+    ))
+    port_queue.put(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+def _start_upstream(latency):
+    """Runs the fake upstream in its own process so it does not compete for our GIL."""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_upstream, args=(latency, port_queue), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get()}/v1/messages"
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_threaded(url, conversations):
+    peak_threads = 0
+    errors = []
+
+    def conversation():
+        try:
+            requests.post(url, json={"messages": []}, timeout=120).json()
+        except Exception as e:
+            errors.append(e)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=conversation) for _ in range(conversations)]
+    for thread in threads:
+        thread.start()
+        peak_threads = max(peak_threads, threading.active_count())
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, peak_threads, len(errors)
+
+async def _bench_async(url, conversations):
+    errors = 0
+    # Same sharding as async_clients: many small pools instead of one large quadratic one
+    limits = httpx.Limits(max_connections=CONNECTIONS_PER_SHARD, max_keepalive_connections=CONNECTIONS_PER_SHARD)
+    shards = max(1, -(-conversations // CONNECTIONS_PER_SHARD))
+    clients = [httpx.AsyncClient(limits=limits, timeout=120) for _ in range(shards)]
+
+    async def conversation(client):
+        nonlocal errors
+        try:
+            (await client.post(url, json={"messages": []})).json()
+        except Exception:
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation(clients[i % shards]) for i in range(conversations)))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.aclose()
+    return elapsed, threading.active_count(), errors
+
+def _run_mode(mode, url, conversations, result_queue):
+    """Runs one mode in a fresh process so peak RSS is attributed to that mode only."""
+    rss_before = _max_rss_mb()
+    if mode == "asyncio":
+        elapsed, threads, errors = asyncio.run(_bench_async(url, conversations))
+    else:
+        elapsed, threads, errors = bench_threaded(url, conversations)
+    result_queue.put((mode, elapsed, threads, errors, _max_rss_mb() - rss_before))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=2.0, help="simulated LLM latency in seconds")
+    args = parser.parse_args()
+
+    upstream, url = _start_upstream(args.latency)
+    rows = []
+    result_queue = multiprocessing.Queue()
+    for mode in ("threaded", "asyncio"):
+        process = multiprocessing.Process(target=_run_mode, args=(mode, url, args.conversations, result_queue))
+        process.start()
+        rows.append(result_queue.get())
+        process.join()
+    upstream.terminate()
+
+    print(f"{args.conversations} concurrent conversations, {args.latency:.1f}s simulated LLM latency")
+    print(f"{'mode':<10}{'wall s':>10}{'conv/s':>10}{'threads':>10}{'errors':>8}{'+RSS MB':>10}")
+    for mode, elapsed, threads, errors, rss in rows:
+        print(f"{mode:<10}{elapsed:>10.2f}{args.conversations / elapsed:>10.1f}{threads:>10}{errors:>8}{rss:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import os
+import tempfile
+from dotenv import load_dotenv
+
+import metrics
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "gridfs").lower() # "gridfs" (shared by all workers) or "local" (a directory)
+BLOB_DIR = os.getenv("BLOB_DIR", "blobs") # root directory of the local backend
+BLOB_CACHE_TTL = 3600 # seconds a loaded blob is kept in memory
+BLOB_CACHE_MAX = 64 # loaded blobs kept (base64 of a downscaled image is a few hundred KB)
+# ---------------------
+
+# Blobs are content-addressed: the id is the sha256 of the bytes, so storing the same
+# image twice is a no-op and a stored blob never changes (cached copies never go stale)
+_loaded = TTLCache(BLOB_CACHE_TTL, BLOB_CACHE_MAX)
+
+def blob_id(data):
+    return hashlib.sha256(data).hexdigest()
+
+class LocalBlobs:
+    """Blobs as files under `root`, fanned out by the first two hex digits of their id."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, _id):
+        return os.path.join(self.root, _id[:2], _id)
+
+    def put(self, _id, data, media_type):
+        path = self._path(_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a concurrent reader never sees a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, _id):
+        try:
+            with open(self._path(_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+class GridFSBlobs:
+    """Blobs in a GridFS bucket of the app database, with the content hash as the file id."""
+
+    def __init__(self, db):
+        import gridfs
+        self._fs = gridfs.GridFS(db, collection="blobs")
+        self._errors = gridfs.errors
+
+    def put(self, _id, data, media_type):
+        if self._fs.exists(_id):
+            return
+        try:
+            self._fs.put(data, _id=_id, content_type=media_type)
+        except self._errors.FileExists:
+            pass # Stored by another worker meanwhile
+
+    def get(self, _id):
+        try:
+            return self._fs.get(_id).read()
+        except self._errors.NoFile:
+            return None
+
+def _create():
+    if BLOB_BACKEND == "local":
+        return LocalBlobs(BLOB_DIR)
+    if BLOB_BACKEND != "gridfs":
+        print(f"Unknown BLOB_BACKEND '{BLOB_BACKEND}', using GridFS.")
+    import database
+    return GridFSBlobs(database.db)
+
+store = _create()
+
+def put(data, media_type):
+    """Stores bytes and returns a reference to keep in a conversation instead of the data."""
+    _id = blob_id(data)
+    store.put(_id, data, media_type)
+    metrics.incr("blobs.stored_bytes", len(data))
+    return {"type": "blob", "media_type": media_type, "blob_id": _id}
+
+def load_base64(ref):
+    """The base64 data of a blob reference, or None if the blob is missing."""
+    _id = ref["blob_id"]
+    data = _loaded.get(_id)
+    if data is not None:
+        metrics.incr("blobs.cache_hits")
+        return data
+    raw = store.get(_id)
+    if raw is None:
+        print(f"Blob {_id} is missing from the {BLOB_BACKEND} store.")
+        metrics.incr("blobs.missing")
+        return None
+    metrics.incr("blobs.loaded_bytes", len(raw))
+    data = base64.b64encode(raw).decode("utf-8")
+    _loaded.set(_id, data)
+    return data
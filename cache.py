@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Thread-safe mapping whose entries expire `ttl` seconds after they were last set.
+
+    Entries live in an OrderedDict in expiry order (every set moves the key to the
+    end), so expiring is a pop from the front and costs amortized O(1) per entry.
+    When `max_entries` is reached the oldest entry is evicted to keep memory bounded.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+
+    def _insert(self, key, value, now):
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            item = self._data.get(key)
+            return item[1] if item is not None else default
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            self._insert(key, value, now)
+
+    def add(self, key, value=True):
+        """Stores key only if it is not already present. Returns True if it was added."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._data:
+                return False
+            self._insert(key, value, now)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item is not None else default
+
+    def pop_where(self, predicate):
+        """Removes every entry whose value matches predicate (O(n), for rare invalidations)."""
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items() if predicate(value)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def pop_keys_where(self, predicate):
+        """Removes every entry whose key matches predicate (O(n), for rare invalidations)."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._data)
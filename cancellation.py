@@ -0,0 +1,106 @@
+import threading
+import time
+
+class Cancelled(Exception):
+    """Raised inside a batch when a newer message made its work obsolete."""
+
+class CancellationToken:
+    """
+    Thread-safe flag that tells a running batch to stop.
+
+    `cancel()` sets it and runs the registered callbacks right away (e.g. closing an
+    in-flight HTTP stream). `check`, if given, is an extra predicate polled at most every
+    `poll_interval` seconds by is_cancelled(); it lets a batch notice messages that were
+    recorded by another worker process.
+    """
+
+    def __init__(self, check=None, poll_interval=0):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._check = check
+        self._poll_interval = poll_interval
+        self._last_poll = 0
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error in cancellation callback: {e}")
+
+    def is_cancelled(self):
+        if self._event.is_set():
+            return True
+        now = time.monotonic()
+        if self._check is not None and now - self._last_poll >= self._poll_interval:
+            self._last_poll = now
+            try:
+                if self._check():
+                    self.cancel("newer message recorded elsewhere")
+            except Exception as e:
+                print(f"Error polling cancellation check: {e}")
+        return self._event.is_set()
+
+    def was_cancelled(self):
+        """True if cancel() was called; unlike is_cancelled() it never polls `check`."""
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.is_cancelled():
+            raise Cancelled(self.reason)
+
+    def sleep(self, seconds):
+        """Sleeps like time.sleep but raises Cancelled as soon as the token is cancelled."""
+        deadline = time.monotonic() + seconds
+        while True:
+            self.raise_if_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Wake up now and then so a `check` predicate is still polled
+            self._event.wait(min(remaining, self._poll_interval or remaining))
+
+    def on_cancel(self, callback):
+        """Runs callback when the token is cancelled (now, if it already is). Returns a function that unregisters it."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+# --- Tokens of the batches running in this process, by sender ---
+_active = {}
+_active_lock = threading.Lock()
+
+def register(sender_id, token):
+    """Makes token cancellable through cancel(sender_id) until it is unregistered."""
+    with _active_lock:
+        _active[sender_id] = token
+
+def unregister(sender_id, token):
+    with _active_lock:
+        if _active.get(sender_id) is token:
+            del _active[sender_id]
+
+def cancel(sender_id, reason="newer message"):
+    """Cancels the batch running for sender_id in this process, if any. Returns True if there was one."""
+    with _active_lock:
+        token = _active.get(sender_id)
+    if token is None:
+        return False
+    token.cancel(reason)
+    return True
@@ -0,0 +1,178 @@
+import json
+import os
+from dotenv import load_dotenv
+
+import blobstore
+import database
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+CONTEXT_IMAGE_TURNS = int(os.getenv("CONTEXT_IMAGE_TURNS", 3)) # customer turns whose images are sent to the model
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 12000)) # tokens of verbatim history before old turns are summarized
+CONTEXT_KEEP_TOKENS = int(os.getenv("CONTEXT_KEEP_TOKENS", 6000)) # tokens of verbatim history left after summarizing
+CONTEXT_MIN_TURNS = int(os.getenv("CONTEXT_MIN_TURNS", 4)) # customer turns always kept verbatim
+# ---------------------
+
+IMAGE_PLACEHOLDER = "[The customer sent an image here]"
+SUMMARY_HEADER = "[Summary of the earlier conversation]"
+CHARS_PER_TOKEN = 4 # rough estimate for English chat text
+IMAGE_TOKENS = 1600 # a downscaled image (see images.py) costs up to about this many
+TOOL_RESULT_CHARS = 300 # tool output kept per result in the summarizer's transcript
+
+def is_customer_turn(message):
+    """A user message written by the customer (not a tool_result message)."""
+    if message.get("role") != "user":
+        return False
+    content = message.get("content")
+    if not isinstance(content, list):
+        return True
+    return any(isinstance(part, dict) and part.get("type") in ("text", "image") for part in content)
+
+def _resolve(part):
+    """The model-ready form of an image part, or None if its image is gone."""
+    source = part.get("source") or {}
+    if source.get("type") != "blob":
+        return part # Inline base64 (stored before the blob store) or a URL source
+    data = blobstore.load_base64(source)
+    if data is None:
+        return None
+    return {"type": "image", "source": {"type": "base64", "media_type": source["media_type"], "data": data}}
+
+def build(conversation, image_turns=CONTEXT_IMAGE_TURNS):
+    """
+    Builds the messages sent to the model from a stored conversation. Image parts hold
+    blob references (see blobstore.py); those in the last `image_turns` customer turns are
+    loaded now, older ones are replaced by a short text note so the model still knows an
+    image was there without paying for it again on every call. Returns a new list; the
+    stored conversation is not modified.
+    """
+    turns_seen = 0
+    first_image_index = len(conversation)
+    for index in range(len(conversation) - 1, -1, -1):
+        if turns_seen >= image_turns:
+            break
+        if is_customer_turn(conversation[index]):
+            turns_seen += 1
+            first_image_index = index
+
+    messages = []
+    dropped = 0
+    for index, message in enumerate(conversation):
+        content = message.get("content")
+        if not isinstance(content, list) or not any(isinstance(part, dict) and part.get("type") == "image" for part in content):
+            messages.append(message)
+            continue
+        parts = []
+        for part in content:
+            if not (isinstance(part, dict) and part.get("type") == "image"):
+                parts.append(part)
+                continue
+            resolved = _resolve(part) if index >= first_image_index else None
+            if resolved is None:
+                dropped += 1
+                parts.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+            else:
+                parts.append(resolved)
+        messages.append({**message, "content": parts})
+
+    if dropped:
+        metrics.incr("context.images_dropped", dropped)
+    return messages
+
+def estimate_tokens(messages):
+    """Approximate input tokens of stored messages, without calling the API."""
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content or []:
+            kind = part.get("type")
+            if kind == "image":
+                tokens += IMAGE_TOKENS
+            elif kind == "text":
+                tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+            else:
+                tokens += len(json.dumps(part, default=str)) // CHARS_PER_TOKEN
+    return tokens
+
+def _cut_point(conversation, start):
+    """
+    Where the verbatim part should begin: the earliest customer turn after `start` that
+    keeps at most CONTEXT_KEEP_TOKENS (but always the last CONTEXT_MIN_TURNS turns).
+    Cutting only before a customer turn never separates a tool_use from its tool_result.
+    """
+    cut = start
+    tokens = 0
+    turns = 0
+    for index in range(len(conversation) - 1, start - 1, -1):
+        tokens += estimate_tokens([conversation[index]])
+        if is_customer_turn(conversation[index]):
+            turns += 1
+            if turns > CONTEXT_MIN_TURNS and tokens > CONTEXT_KEEP_TOKENS:
+                break
+            cut = index
+    return cut
+
+def _transcript(messages):
+    """Plain-text rendering of stored messages for the summarizer."""
+    lines = []
+    for message in messages:
+        speaker = "Customer" if message.get("role") == "user" else "Assistant"
+        content = message.get("content")
+        if isinstance(content, str):
+            lines.append(f"{speaker}: {content}")
+            continue
+        for part in content or []:
+            kind = part.get("type")
+            if kind == "text":
+                lines.append(f"{speaker}: {part.get('text', '')}")
+            elif kind == "image":
+                lines.append(f"{speaker}: [image]")
+            elif kind == "tool_use":
+                lines.append(f"Assistant used {part.get('name')} with {json.dumps(part.get('input'), default=str)}")
+            elif kind == "tool_result":
+                lines.append(f"Tool result: {str(part.get('content'))[:TOOL_RESULT_CHARS]}")
+    return "\n".join(lines)
+
+def fit(_id, owner_id, conversation, summarize):
+    """
+    Keeps the history sent to the model within CONTEXT_TOKEN_BUDGET. Turns before the
+    stored `summary_upto` index are represented by the stored rolling summary only.
+    When the verbatim rest grows past the budget, the oldest of it is folded into the
+    summary with `summarize(previous_summary, transcript)` until CONTEXT_KEEP_TOKENS
+    remain, so the summary is recomputed once per (budget - keep) tokens of new
+    conversation rather than every turn. Returns the messages to send: the summary
+    leads the first kept message.
+    """
+    summary, upto = database.get_summary(_id, owner_id)
+    if upto >= len(conversation) or (upto and not is_customer_turn(conversation[upto])):
+        summary, upto = None, 0 # The stored conversation no longer matches the summary
+
+    if estimate_tokens(conversation[upto:]) > CONTEXT_TOKEN_BUDGET:
+        cut = _cut_point(conversation, upto)
+        if cut > upto:
+            try:
+                summary = summarize(summary, _transcript(conversation[upto:cut]))
+                database.set_summary(_id, owner_id, summary, cut)
+                print(f"Summarized messages {upto}-{cut} of {_id}'s conversation.")
+                metrics.incr("context.summaries")
+                upto = cut
+            except Exception as e:
+                # Send the longer history this time and try again next turn
+                print(f"Error summarizing conversation of {_id}: {e}")
+                metrics.incr("context.summary_errors")
+
+    messages = conversation[upto:]
+    metrics.observe("context.history_tokens", estimate_tokens(messages))
+    if not summary or not messages:
+        return messages
+    first = messages[0]
+    content = first.get("content")
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    lead = {"type": "text", "text": f"{SUMMARY_HEADER}\n{summary}"}
+    return [{**first, "content": [lead] + list(content or [])}] + messages[1:]
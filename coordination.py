@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import metrics
+from sender_state import SenderRegistry
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+COORDINATION_BACKEND = os.getenv("COORDINATION_BACKEND", "memory").lower() # "memory" (one process) or "mongo" (shared by all workers)
+COORDINATION_LEASE = int(os.getenv("COORDINATION_LEASE", 300)) # seconds a worker may hold a sender before others take over
+TIMER_GRACE = 30 # seconds a claimed batch timer may run late before another worker can claim a new one
+STATE_TTL = 7 * 24 * 60 * 60 # idle sender state is dropped from Mongo after this many seconds
+# ---------------------
+
+# A running batch: `baseline` is the sender's message counter when processing began,
+# `token` identifies the holder of the Mongo lease (None in-process)
+Lease = namedtuple("Lease", ["baseline", "token"])
+
+class InProcessCoordinator:
+    """
+    Per-sender batching state held in this process. Correct for a single worker only:
+    a second process would keep its own copy and answer the same sender again.
+
+    Every sender has a message counter (bumped by `touch`), an optional batch timer
+    and at most one running batch. All transitions are atomic:
+      claim_timer  -> True if the caller should arm the (only) batch timer
+      try_begin    -> a Lease if the caller may process the sender now, else None
+      has_newer    -> True if messages were counted since the lease began
+      finish       -> True if messages arrived meanwhile and the batch must be rerun
+                      (a timer is then already claimed for the caller)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Bounded: idle senders are evicted, pending or running ones never are
+        self._senders = SenderRegistry("senders")
+        self.active = 0 # batches this process is running right now
+
+    def touch(self, sender_id):
+        with self._lock:
+            state = self._senders.obtain(sender_id)
+            state.seq += 1
+            return state.seq
+
+    def claim_timer(self, sender_id, delay):
+        with self._lock:
+            state = self._senders.obtain(sender_id)
+            if state.busy:
+                return False
+            state.timer_armed = True
+            return True
+
+    def try_begin(self, sender_id):
+        with self._lock:
+            state = self._senders.obtain(sender_id)
+            state.timer_armed = False
+            if state.processing:
+                return None
+            state.processing = True
+            self.active += 1
+            return Lease(state.seq, None)
+
+    def has_newer(self, sender_id, lease):
+        """True if messages were counted for the sender after the batch holding `lease` began."""
+        with self._lock:
+            state = self._senders.get(sender_id)
+            return state is not None and state.seq > lease.baseline
+
+    def finish(self, sender_id, lease):
+        with self._lock:
+            state = self._senders.obtain(sender_id)
+            state.processing = False
+            self.active -= 1
+            if state.seq > lease.baseline:
+                state.timer_armed = True
+                return True
+            return False
+
+class MongoCoordinator:
+    """
+    The same state machine as InProcessCoordinator, kept in one `batch_state` document
+    per sender so that any number of worker processes (or machines) can share it:
+
+      {_id: sender_id, seq: <message counter>, timer_until: <ts>, lease_until: <ts>, lease_owner: <token>}
+
+    Each transition is a single conditional update, so two workers can never both hold a
+    sender. A worker that dies mid-batch loses its lease after COORDINATION_LEASE seconds and
+    one that dies with a timer armed loses the claim after the batch window plus TIMER_GRACE.
+    """
+
+    def __init__(self, collection):
+        self._state = collection
+        self._index_ready = False
+        self.active = 0
+
+    def _ensure_index(self):
+        if not self._index_ready:
+            self._state.create_index("updated_at", expireAfterSeconds=STATE_TTL)
+            self._index_ready = True
+
+    def _claim(self, query, update):
+        """Conditional upsert: returns the updated document, or None if the condition did not hold."""
+        try:
+            return self._state.find_one_and_update(query, update, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # The sender's document exists but did not match the condition
+            return None
+
+    def touch(self, sender_id):
+        self._ensure_index()
+        doc = self._state.find_one_and_update(
+            {"_id": sender_id},
+            {"$inc": {"seq": 1}, "$set": {"updated_at": datetime.now(tz=timezone.utc)}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return doc["seq"]
+
+    def claim_timer(self, sender_id, delay):
+        now = time.time()
+        return self._claim(
+            {"_id": sender_id, "lease_until": {"$not": {"$gt": now}}, "timer_until": {"$not": {"$gt": now}}},
+            {"$set": {"timer_until": now + delay + TIMER_GRACE}}
+        ) is not None
+
+    def try_begin(self, sender_id):
+        now = time.time()
+        token = uuid.uuid4().hex
+        doc = self._claim(
+            {"_id": sender_id, "lease_until": {"$not": {"$gt": now}}},
+            {
+                "$set": {"lease_until": now + COORDINATION_LEASE, "lease_owner": token, "updated_at": datetime.now(tz=timezone.utc)},
+                "$unset": {"timer_until": ""}
+            }
+        )
+        if doc is None:
+            # Another worker holds the sender and will rerun it on finish if needed. Drop our
+            # timer claim (only while that lease is still held, so a newer claim is never undone)
+            self._state.update_one({"_id": sender_id, "lease_until": {"$gt": now}}, {"$unset": {"timer_until": ""}})
+            return None
+        self.active += 1
+        return Lease(doc.get("seq", 0), token)
+
+    def has_newer(self, sender_id, lease):
+        return self._state.find_one({"_id": sender_id, "seq": {"$gt": lease.baseline}}, {"_id": 1}) is not None
+
+    def finish(self, sender_id, lease):
+        self.active -= 1
+        release = {"$unset": {"lease_until": "", "lease_owner": ""}}
+        while True:
+            # Messages arrived during the batch: hand the lease over to a rerun timer in one step
+            rerun = {"$unset": release["$unset"], "$set": {"timer_until": time.time() + TIMER_GRACE}}
+            if self._state.find_one_and_update({"_id": sender_id, "lease_owner": lease.token, "seq": {"$gt": lease.baseline}}, rerun):
+                return True
+            if self._state.update_one({"_id": sender_id, "lease_owner": lease.token, "seq": {"$not": {"$gt": lease.baseline}}}, release).matched_count:
+                return False
+            if self._state.find_one({"_id": sender_id, "lease_owner": lease.token}, {"_id": 1}) is None:
+                print(f"Lease for {sender_id} expired before the batch finished; another worker may have taken over.")
+                return False
+            # A message was counted between the two updates; try again
+
+def _create():
+    if COORDINATION_BACKEND == "mongo":
+        import database
+        return MongoCoordinator(database.batch_state)
+    if COORDINATION_BACKEND != "memory":
+        print(f"Unknown COORDINATION_BACKEND '{COORDINATION_BACKEND}', using in-process state.")
+    return InProcessCoordinator()
+
+coordinator = _create()
+
+metrics.register_gauge("coordination.active_batches", lambda: coordinator.active)
@@ -1,9 +1,10 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import os
 from dotenv import load_dotenv
 import json
 from pymongo.synchronous import database
 import actions
+import usage
 from bson import ObjectId
 from datetime import datetime
 import pytz # Add pytz import
@@ -20,10 +21,12 @@ Data = db['data']
 creds = db['creds']
 appointments = db['appointments']
 notifications = db['notifications']
+processed_messages = db['processed_messages']
+batch_state = db['batch_state']
 
 
 def reset_conversation(_id,owner_id):
-    Users.update_one({"_id":_id,"owner_id":owner_id},{"$set":{"conversation":[]}})
+    Users.update_one({"_id":_id,"owner_id":owner_id},{"$set":{"conversation":[]},"$unset":{"summary":"","summary_upto":""}})
 
 def check_user_active(_id,owner_id):
     user = Users.find_one({"_id":_id,"owner_id":owner_id})
@@ -70,6 +73,50 @@ def add_message(_id, messages, owner_id):
         # Return existing conversation or empty list on error
         return get_conversation(_id, owner_id)
     
+def append_messages(_id, messages, owner_id):
+    """Appends a batch of messages to a user's conversation with a single write (no read-back)."""
+    if not messages:
+        return False
+    try:
+        Users.update_one(
+            {"_id": _id, "owner_id": owner_id},
+            {
+                "$push": {"conversation": {"$each": messages}},
+                "$setOnInsert": {"active": True, "owner_id": owner_id}
+            },
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        print(f"Error appending {len(messages)} messages for user {_id}: {e}")
+        return False
+
+def record_message_gap(_id, owner_id, now, alpha, max_gap):
+    """
+    Updates the user's message cadence in one atomic write: the gap since their previous
+    message (epoch seconds in `last_message_at`) is folded into `cadence_gap`, an
+    exponentially weighted average, unless it is longer than max_gap. Returns cadence_gap or None.
+    """
+    gap = {"$subtract": [now, "$last_message_at"]}
+    learned = {"$add": [
+        {"$multiply": [alpha, gap]},
+        {"$multiply": [1 - alpha, {"$ifNull": ["$cadence_gap", gap]}]}
+    ]}
+    user = Users.find_one_and_update(
+        {"_id": _id, "owner_id": owner_id},
+        [{"$set": {
+            "cadence_gap": {"$cond": [
+                {"$and": [{"$gt": ["$last_message_at", None]}, {"$lte": [gap, max_gap]}]},
+                learned,
+                "$cadence_gap"
+            ]},
+            "last_message_at": now
+        }}],
+        projection={"cadence_gap": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return user.get("cadence_gap") if user else None
+
 def set_conversation(_id, owner_id, messages):
     """Replaces the entire conversation history for a user with the provided list."""
     try:
@@ -82,6 +129,8 @@ def set_conversation(_id, owner_id, messages):
             {"_id": _id, "owner_id": owner_id}, # Filter by user and owner
             {
                 "$set": {"conversation": messages},
+                # The summary described the replaced history
+                "$unset": {"summary": "", "summary_upto": ""},
                 # Set defaults only when inserting a new user during the sync
                 "$setOnInsert": {"active": True, "owner_id": owner_id}
             },
@@ -100,6 +149,16 @@ def get_conversation(_id,owner_id):
     user = Users.find_one({"_id": _id,"owner_id":owner_id})
     return user.get("conversation", []) if user else []
 
+def get_summary(_id,owner_id):
+    """The rolling summary of a conversation and how many leading messages it covers: (text, upto)."""
+    user = Users.find_one({"_id": _id,"owner_id":owner_id},{"summary":1,"summary_upto":1})
+    if not user or not user.get("summary"):
+        return None, 0
+    return user["summary"], user.get("summary_upto", 0)
+
+def set_summary(_id,owner_id,summary,upto):
+    Users.update_one({"_id": _id,"owner_id":owner_id},{"$set":{"summary":summary,"summary_upto":upto}})
+
 def set_dataset(_id,dataset):
     Data.update_one(
         {"_id":int(_id)}, 
@@ -175,6 +234,10 @@ def get_business_data(_id):
      active = data["active"]
      return dataset, active
 
+def get_owner_config(owner_id):
+    """The owner's instruction, dataset and bot-active flag in one read (see owner_config.py)."""
+    return Data.find_one({"_id":int(owner_id)}, {"instruction": 1, "dataset": 1, "active": 1, "_id": 0})
+
 def get_instruction(owner_id):
     instruction_entry = Data.find_one({"_id":int(owner_id)}, {"instruction": 1, "_id": 0})
     return instruction_entry.get("instruction") if instruction_entry else None
@@ -204,6 +267,24 @@ def read_notification(_id):
 def delete_customer(_id,owner_id):
     Users.remove({"_id":_id,"owner_id":owner_id})
 
+_usage_index_ready = False
+
+def record_usage(updates):
+    """Applies the rollup updates of a turn (see usage.Turn.updates)."""
+    for collection, query, update in updates:
+        db[collection].update_one(query, update, upsert=True)
+
+def get_usage(owner_id, first_day):
+    """An owner's daily usage documents since first_day and its costliest customers over that period."""
+    global _usage_index_ready
+    if not _usage_index_ready:
+        db[usage.DAILY].create_index([("owner_id", 1), ("day", 1)])
+        db[usage.SENDERS].create_index([("owner_id", 1), ("day", 1)])
+        _usage_index_ready = True
+    daily = list(db[usage.DAILY].find({"owner_id": str(owner_id), "day": {"$gte": first_day}}))
+    top = list(db[usage.SENDERS].aggregate(usage.top_senders_pipeline(owner_id, first_day)))
+    return daily, top
+
 class auth:
 
     def login(self,cookie=None,username=None,password=None):
@@ -217,11 +298,27 @@ class auth:
 
         return user
 
-    def signup(self,_id,username,password,access_token):
+    @staticmethod
+    def _new_cookie():
         import secrets
         import string
         alphabet = string.ascii_letters + string.digits
-        cookie = ''.join(secrets.choice(alphabet) for i in range(64))
+        return ''.join(secrets.choice(alphabet) for i in range(64))
+
+    def logout(self,_id):
+        # Cookies are long-lived, so logging out replaces it; every device has to log in again
+        creds.update_one({"_id":_id},{"$set":{"cookie":self._new_cookie()}})
+
+    def change_password(self,_id,password,new_password):
+        # Returns the new cookie, or None if the current password is wrong
+        cookie = self._new_cookie()
+        result = creds.update_one(
+            {"_id":_id,"password":password},
+            {"$set":{"password":new_password,"cookie":cookie}})
+        return cookie if result.matched_count else None
+
+    def signup(self,_id,username,password,access_token):
+        cookie = self._new_cookie()
         creds.insert_one(
             {
                 "_id":_id,
@@ -0,0 +1,52 @@
+import os
+from dotenv import load_dotenv
+
+import database
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", 10)) # seconds to wait when nothing is known about the sender
+BATCH_WINDOW_MIN = float(os.getenv("BATCH_WINDOW_MIN", 3)) # shortest wait, for messages that look complete
+BATCH_WINDOW_MAX = float(os.getenv("BATCH_WINDOW_MAX", 15)) # longest wait, for slow typists and bare images
+CADENCE_ALPHA = 0.3 # weight of the newest gap in the sender's moving average
+CADENCE_MAX_GAP = 120 # seconds; longer pauses start a new conversation turn and are not learned
+CADENCE_MULTIPLIER = 1.5 # wait this many typical gaps for a follow-up message
+COMPLETE_MESSAGE_CHARS = 15 # shorter texts are treated as fragments even with punctuation
+# ---------------------
+
+def learn(sender_id, owner_id, now):
+    """
+    Folds the gap since the sender's previous message into their cadence (an EWMA of
+    gaps, kept on the user document) and returns the typical gap in seconds, or None
+    while it is still unknown.
+    """
+    try:
+        return database.record_message_gap(sender_id, owner_id, now, CADENCE_ALPHA, CADENCE_MAX_GAP)
+    except Exception as e:
+        print(f"Error updating message cadence for {sender_id}: {e}")
+        return None
+
+def _clamp(window):
+    return max(BATCH_WINDOW_MIN, min(BATCH_WINDOW_MAX, window))
+
+def choose_window(messages, typical_gap=None):
+    """Picks how long to wait for more messages after `messages` (the sender's latest, in order)."""
+    window = _clamp(typical_gap * CADENCE_MULTIPLIER) if typical_gap else BATCH_WINDOW
+
+    content = (messages[-1].get("content") or []) if messages else []
+    texts = [part.get("text", "") for part in content if part.get("type") == "text"]
+    text = " ".join(texts).strip()
+
+    if content and not text:
+        # A bare image is usually followed by the question about it
+        window = BATCH_WINDOW_MAX
+    elif text.endswith("?"):
+        # A question is a complete turn; the customer is waiting for the answer
+        window = BATCH_WINDOW_MIN
+    elif len(text) >= COMPLETE_MESSAGE_CHARS and text[-1] in ".!":
+        window = _clamp(window / 2)
+
+    metrics.observe("batch.window_seconds", window)
+    return window
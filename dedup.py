@@ -0,0 +1,79 @@
+import os
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from pymongo.errors import BulkWriteError
+
+import database
+import metrics
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", 3600)) # seconds a message mid is remembered in memory
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", 100000)) # hard cap on remembered mids
+DEDUP_STORE = os.getenv("DEDUP_STORE", "memory").lower() # "memory" or "mongo" (also survives restarts)
+DEDUP_PERSIST_TTL = int(os.getenv("DEDUP_PERSIST_TTL", 24 * 60 * 60)) # seconds a mid is kept in Mongo
+# ---------------------
+
+_recent = TTLCache(DEDUP_TTL, DEDUP_MAX_ENTRIES)
+_index_ready = False
+
+metrics.register_gauge("dedup.entries", lambda: len(_recent))
+metrics.register_gauge("dedup.evictions", lambda: _recent.evictions)
+
+def _ensure_index():
+    global _index_ready
+    if not _index_ready:
+        database.processed_messages.create_index("created_at", expireAfterSeconds=DEDUP_PERSIST_TTL)
+        _index_ready = True
+
+def claim(mid):
+    """
+    Marks a message mid as seen in this process. Returns True the first time a mid is
+    claimed and False for redeliveries. Events without a mid are always processed.
+    With the mongo store a mid recorded by another worker or before a restart is a
+    duplicate too; it is only recorded there once its message is saved (see record), so
+    a failure or crash before the save never turns the replay into a silent drop.
+    """
+    if not mid:
+        return True
+    if not _recent.add(mid):
+        metrics.incr("dedup.duplicates")
+        return False
+
+    if DEDUP_STORE == "mongo":
+        try:
+            if database.processed_messages.find_one({"_id": mid}, {"_id": 1}) is not None:
+                print(f"Message {mid} was already processed before a restart or by another worker.")
+                metrics.incr("dedup.duplicates")
+                return False
+        except Exception as e:
+            # Fail open: a duplicate is better than dropping a message
+            print(f"Error checking message {mid} in persistent dedup store: {e}")
+    return True
+
+def record(mids):
+    """Persists the mids of messages that were saved (a no-op for the memory store)."""
+    mids = [mid for mid in mids if mid]
+    if DEDUP_STORE != "mongo" or not mids:
+        return
+    now = datetime.now(tz=timezone.utc)
+    try:
+        _ensure_index()
+        database.processed_messages.insert_many([{"_id": mid, "created_at": now} for mid in mids], ordered=False)
+    except BulkWriteError:
+        pass # Recorded already, e.g. by a replay of the same delivery
+    except Exception as e:
+        print(f"Error recording {len(mids)} message(s) in persistent dedup store: {e}")
+
+def forget(mid):
+    """Un-marks a mid whose message was not saved so a redelivery or replay is accepted again."""
+    if not mid:
+        return
+    _recent.pop(mid)
+    if DEDUP_STORE == "mongo":
+        try:
+            database.processed_messages.delete_one({"_id": mid})
+        except Exception as e:
+            print(f"Error removing message {mid} from persistent dedup store: {e}")
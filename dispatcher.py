@@ -0,0 +1,210 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", 4)) # Fixed number of worker threads per pool
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 256)) # Max items waiting in memory
+DISPATCH_OVERFLOW = os.getenv("DISPATCH_OVERFLOW", "reject").lower() # "reject" or "spill" (to disk), see Dispatcher
+DISPATCH_SPILL_DIR = os.getenv("DISPATCH_SPILL_DIR", "spill")
+SPILL_POLL_INTERVAL = 0.5 # seconds between checks for spilled items when the queue has room
+SPILL_CLAIM_TIMEOUT = 60 # seconds after which a claimed spill file of a crashed worker is put back
+# ---------------------
+
+OVERFLOW_POLICIES = ("reject", "spill")
+
+class Dispatcher:
+    """
+    Fixed-size worker pool fed by a bounded in-memory queue.
+
+    Every submitted item is a tuple of JSON-serializable arguments that is passed
+    to `handler(*args)` on one of the workers. When the queue is full the overflow
+    policy decides whether the item is rejected (submit returns False) or written
+    to the spill directory and fed back into the queue once there is room again.
+    What a rejection means is up to the caller: the webhook route answers 503 while
+    its pool is saturated (Meta redelivers), and a scheduler retries the deadline.
+    Threads are started lazily on first use so the pool is created after a fork.
+    """
+
+    def __init__(self, name, handler, workers=None, max_queue=None, overflow=None, spill_dir=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers or DISPATCH_WORKERS
+        self.overflow = (overflow or DISPATCH_OVERFLOW).lower()
+        if self.overflow not in OVERFLOW_POLICIES:
+            print(f"Warning: Unknown overflow policy '{self.overflow}' for dispatcher {name}. Falling back to 'reject'.")
+            self.overflow = "reject"
+        self.spill_dir = os.path.join(spill_dir or DISPATCH_SPILL_DIR, name)
+        self._queue = queue.Queue(maxsize=max_queue or DISPATCH_QUEUE_SIZE)
+        self._start_lock = threading.Lock()
+        self._started_pid = None
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+
+        metrics.register_gauge(f"dispatch.{name}.queue_depth", self._queue.qsize)
+        metrics.register_gauge(f"dispatch.{name}.busy_workers", lambda: self._busy)
+        metrics.register_gauge(f"dispatch.{name}.utilization", lambda: self._busy / self.workers)
+        metrics.register_gauge(f"dispatch.{name}.spilled", self._spilled_count)
+
+    def start(self):
+        """Starts the worker (and spill drain) threads once per process."""
+        if self._started_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"{self.name}-worker-{i}", daemon=True).start()
+            if self.overflow == "spill":
+                os.makedirs(self.spill_dir, exist_ok=True)
+                threading.Thread(target=self._drain_spill, name=f"{self.name}-spill", daemon=True).start()
+            self._started_pid = os.getpid()
+            print(f"Dispatcher '{self.name}' started with {self.workers} workers (queue size {self._queue.maxsize}, overflow={self.overflow}).")
+
+    def submit(self, *args):
+        """Queues handler(*args). Returns False only if the item was rejected."""
+        self.start()
+        item = (time.time(), args)
+        try:
+            self._queue.put_nowait(item)
+            metrics.incr(f"dispatch.{self.name}.accepted")
+            return True
+        except queue.Full:
+            pass
+
+        if self.overflow == "spill" and self._spill(item):
+            metrics.incr(f"dispatch.{self.name}.spilled_total")
+            return True
+
+        print(f"Dispatcher '{self.name}' queue is full ({self._queue.maxsize}). Rejecting item.")
+        metrics.incr(f"dispatch.{self.name}.rejected")
+        return False
+
+    def saturated(self):
+        """True while the queue is full, i.e. the next submit would overflow."""
+        return self._queue.full()
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "utilization": self._busy / self.workers,
+            "spilled": self._spilled_count(),
+            "overflow": self.overflow,
+        }
+
+    def _worker(self):
+        while True:
+            enqueued_at, args = self._queue.get()
+            metrics.observe(f"dispatch.{self.name}.wait_seconds", time.time() - enqueued_at)
+            with self._busy_lock:
+                self._busy += 1
+            started = time.time()
+            try:
+                self.handler(*args)
+            except Exception as e:
+                metrics.incr(f"dispatch.{self.name}.failed")
+                print(f"Error in dispatcher '{self.name}' handler: {e}\n{traceback.format_exc()}")
+            finally:
+                metrics.observe(f"dispatch.{self.name}.run_seconds", time.time() - started)
+                with self._busy_lock:
+                    self._busy -= 1
+                self._queue.task_done()
+
+    # --- Spill to disk ---
+    def _spill(self, item):
+        enqueued_at, args = item
+        os.makedirs(self.spill_dir, exist_ok=True)
+        filename = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        path = os.path.join(self.spill_dir, filename)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump({"enqueued_at": enqueued_at, "args": list(args)}, f)
+            os.replace(path + ".tmp", path) # Atomic so the drainer never sees a partial file
+            print(f"Dispatcher '{self.name}' queue is full. Spilled item to {path}")
+            return True
+        except Exception as e:
+            print(f"Error spilling item for dispatcher '{self.name}': {e}")
+            return False
+
+    def _spilled_files(self):
+        try:
+            return sorted(f for f in os.listdir(self.spill_dir) if f.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _spilled_count(self):
+        return len(self._spilled_files()) if self.overflow == "spill" else 0
+
+    def _drain_spill(self):
+        """Feeds spilled items (including ones left over from a previous run) back in FIFO order."""
+        while True:
+            time.sleep(SPILL_POLL_INTERVAL)
+            with self._spill_lock:
+                self._recover_claims()
+                for filename in self._spilled_files():
+                    if self._queue.full():
+                        break
+                    path = os.path.join(self.spill_dir, filename)
+                    # Other worker processes drain the same directory: whoever renames the
+                    # file first owns it (the claimed name no longer ends in .json)
+                    claimed = f"{path}.{os.getpid()}"
+                    try:
+                        os.rename(path, claimed)
+                        os.utime(claimed) # Claim time, see _recover_claims
+                    except FileNotFoundError:
+                        continue # Taken by another worker
+                    except OSError as e:
+                        print(f"Error claiming spilled item {path}: {e}")
+                        continue
+                    try:
+                        with open(claimed, "r") as f:
+                            spilled = json.load(f)
+                        self._queue.put_nowait((spilled["enqueued_at"], tuple(spilled["args"])))
+                        os.remove(claimed)
+                    except queue.Full:
+                        self._unclaim(claimed, path)
+                        break
+                    except Exception as e:
+                        print(f"Error restoring spilled item {path}: {e}")
+                        try:
+                            os.rename(claimed, path + ".bad")
+                        except OSError as e:
+                            print(f"Error setting aside spilled item {path}: {e}")
+
+    def _recover_claims(self):
+        """Puts back files claimed by a worker that died before restoring them."""
+        try:
+            filenames = os.listdir(self.spill_dir)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            base, _, pid = filename.rpartition(".")
+            if not base.endswith(".json") or not pid.isdigit():
+                continue
+            claimed = os.path.join(self.spill_dir, filename)
+            try:
+                if time.time() - os.path.getmtime(claimed) > SPILL_CLAIM_TIMEOUT:
+                    print(f"Recovering spilled item {filename} claimed by a worker that is gone.")
+                    os.rename(claimed, os.path.join(self.spill_dir, base))
+            except OSError:
+                pass # Restored or recovered by someone else meanwhile
+
+    def _unclaim(self, claimed, path):
+        """Puts a claimed file back for a later sweep (or another worker)."""
+        try:
+            os.rename(claimed, path)
+        except OSError as e:
+            print(f"Error returning spilled item {path}: {e}")
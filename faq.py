@@ -0,0 +1,231 @@
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, namedtuple
+from dotenv import load_dotenv
+
+import context
+import functions
+import metrics
+import owner_config
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+FAQ_FAST_PATH = os.getenv("FAQ_FAST_PATH", "false").lower() == "true" # answer FAQ-style messages from the dataset without a model call
+FAQ_MIN_SCORE = float(os.getenv("FAQ_MIN_SCORE", 0.75)) # share of the question the best entry must explain
+FAQ_MIN_MARGIN = float(os.getenv("FAQ_MIN_MARGIN", 0.15)) # lead over the runner-up it needs (two close entries mean an ambiguous question)
+FAQ_MAX_WORDS = 20 # longer messages usually ask more than one thing; the model answers those
+FAQ_INDEX_TTL = 3600 # seconds an owner's index is kept (it is rebuilt sooner when the dataset changes)
+FAQ_INDEX_MAX_ENTRIES = 1000 # owners whose index is kept
+# ---------------------
+
+# One answerable question. `terms` are what a question about it is matched on; a question
+# must contain one of `requires` (if any) to match, e.g. a price word for a service's price.
+Entry = namedtuple("Entry", ["key", "terms", "requires", "answer"])
+
+PRICE_TERMS = {"price", "cost", "much", "charge", "fee", "rate"}
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "am", "do", "does", "did", "you", "your", "u", "ur", "i", "me", "my", "we",
+    "it", "its", "of", "for", "with", "to", "in", "on", "at", "and", "or", "can", "could", "would", "will", "be", "get",
+    "what", "whats", "how", "hi", "hello", "hey", "please", "pls", "plz", "thanks", "thank", "there", "this", "that",
+}
+
+_indexes = TTLCache(FAQ_INDEX_TTL, FAQ_INDEX_MAX_ENTRIES) # owner_id -> (dataset, Index)
+_counts_lock = threading.Lock()
+_counts = {"hits": 0, "misses": 0}
+
+def _hit_rate():
+    with _counts_lock:
+        total = _counts["hits"] + _counts["misses"]
+        return _counts["hits"] / total if total else None
+
+metrics.register_gauge("faq.hit_rate", _hit_rate)
+
+def tokenize(text):
+    """Lowercase word stems without stopwords ("Brows?" -> "brow")."""
+    tokens = []
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode() # "ombré" -> "ombre"
+    for word in re.findall(r"[a-z0-9]+", text.replace("'", "")):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def _money(value):
+    return f"${value}" if isinstance(value, (int, float)) else str(value)
+
+def _service_answer(service):
+    answer = f"{service['name']}: {_money(service.get('price'))}."
+    if service.get("deposit"):
+        answer += f" The deposit to book is {_money(service['deposit'])}."
+    if service.get("duration"):
+        answer += f" It takes about {service['duration']}."
+    return answer
+
+def _service_entries(services):
+    entries = []
+    for service in services if isinstance(services, list) else []:
+        if isinstance(service, dict) and service.get("name") and service.get("price") is not None:
+            name = service["name"]
+            # Priced per customer (see functions.get_information), so looked up when answering
+            answer = lambda user_id, owner_id, name=name: _priced_service_answer(name, user_id, owner_id)
+            entries.append(Entry(f"services:{name}", tokenize(name), PRICE_TERMS, answer))
+    return entries
+
+def _priced_service_answer(name, user_id, owner_id):
+    services = functions.get_information("services", user_id, owner_id)
+    for service in services.get("services", []) if isinstance(services, dict) else []:
+        if service.get("name") == name:
+            return _service_answer(service)
+    return None
+
+def _contact_entries(contact):
+    if not isinstance(contact, dict):
+        return []
+    entries = []
+    if contact.get("address"):
+        entries.append(Entry("contact:address", tokenize("where located location address find directions studio salon office"), None,
+                             lambda *_: f"We're located at {contact['address']}."))
+    if contact.get("phone"):
+        entries.append(Entry("contact:phone", tokenize("phone number call text contact"), None,
+                             lambda *_: f"You can reach us at {contact['phone']}."))
+    if contact.get("website"):
+        entries.append(Entry("contact:website", tokenize("website site web page online"), None,
+                             lambda *_: f"Our website is {contact['website']}."))
+    return entries
+
+def _payment_entries(methods):
+    names = []
+    for method in methods if isinstance(methods, list) else []:
+        if isinstance(method, dict) and method.get("available", True) and method.get("name") and method["name"] not in names:
+            names.append(method["name"])
+    if not names:
+        return []
+    return [Entry("payment_informations", tokenize("pay payment method accept take card cash zelle stripe venmo"), None,
+                  lambda *_: f"We accept {', '.join(names)}.")]
+
+def _policy_entries(policy):
+    if not isinstance(policy, dict) or not isinstance(policy.get("cancellation_rescheduling"), str):
+        return []
+    return [Entry("policy:cancellation_rescheduling", tokenize("cancel cancellation policy reschedule rescheduling refund refundable move change appointment"), None,
+                  lambda *_: policy["cancellation_rescheduling"])]
+
+class Index:
+    """
+    The entries built from one owner's dataset, matched by TF-IDF: a question scores the
+    share of its (idf-weighted) words that an entry covers, so words no entry knows, like
+    "painful" or "friday", pull every score down and send the question to the model.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.terms = [set(entry.terms) | (entry.requires or set()) for entry in entries]
+        document_frequency = Counter(term for terms in self.terms for term in terms)
+        self.idf = {term: math.log(1 + len(entries) / count) for term, count in document_frequency.items()}
+        self.unknown_idf = math.log(1 + len(entries)) # as rare as a word of a single entry
+
+    def match(self, text):
+        """(entry, score, runner-up score) of the best match for text, or (None, 0, 0)."""
+        tokens = tokenize(text)
+        weights = {term: count * self.idf.get(term, self.unknown_idf) for term, count in Counter(tokens).items()}
+        total = sum(weights.values())
+        if not total:
+            return None, 0, 0
+        scores = []
+        for entry, terms in zip(self.entries, self.terms):
+            if entry.requires and not entry.requires.intersection(tokens):
+                continue
+            scores.append((sum(weight for term, weight in weights.items() if term in terms) / total, entry))
+        scores.sort(key=lambda item: item[0], reverse=True)
+        if not scores:
+            return None, 0, 0
+        return scores[0][1], scores[0][0], scores[1][0] if len(scores) > 1 else 0
+
+def build_index(dataset):
+    dataset = dataset or {}
+    entries = (
+        _service_entries(dataset.get("services"))
+        + _contact_entries(dataset.get("contact"))
+        + _payment_entries(dataset.get("payment_informations"))
+        + _policy_entries(dataset.get("policy"))
+    )
+    return Index(entries)
+
+def index_for(owner_id):
+    """The owner's index, rebuilt when owner_config hands out a different dataset."""
+    dataset = owner_config.get(owner_id).dataset
+    cached = _indexes.get(str(owner_id))
+    if cached is not None and cached[0] is dataset:
+        return cached[1]
+    index = build_index(dataset)
+    _indexes.set(str(owner_id), (dataset, index))
+    return index
+
+def pending_text(conversation):
+    """
+    The text of the customer messages after the last assistant message (the batch being
+    answered), or None if they hold anything but text: images go to the model.
+    """
+    texts = []
+    for message in reversed(conversation):
+        if message.get("role") != "user" or not context.is_customer_turn(message):
+            break
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") != "text":
+                return None
+            texts.append(part.get("text", ""))
+    return " ".join(reversed(texts)).strip() or None
+
+def _count(outcome):
+    with _counts_lock:
+        _counts[outcome] += 1
+    metrics.incr(f"faq.{outcome}")
+
+def answer(owner_id, sender_id, conversation):
+    """
+    Answers the pending customer messages from the owner's dataset when they are a short
+    question that one entry matches with high confidence. Returns the assistant message
+    to send, or None to let the model answer. Never raises.
+    """
+    started = time.time()
+    try:
+        text = pending_text(conversation)
+        if text is None or len(text.split()) > FAQ_MAX_WORDS:
+            _count("misses")
+            return None
+        entry, score, runner_up = index_for(owner_id).match(text)
+        if entry is None or score < FAQ_MIN_SCORE or score - runner_up < FAQ_MIN_MARGIN:
+            _count("misses")
+            return None
+        reply = entry.answer(sender_id, owner_id)
+        if not reply:
+            _count("misses")
+            return None
+    except Exception as e:
+        print(f"Error in FAQ fast path for {sender_id}: {e}")
+        _count("misses")
+        return None
+
+    elapsed = time.time() - started
+    _count("hits")
+    metrics.observe("faq.seconds", elapsed)
+    # What the model would have cost, from the recent turns it answered (see usage.py)
+    typical_seconds = metrics.mean("turn.seconds")
+    if typical_seconds is not None:
+        metrics.incr("faq.saved_seconds", max(0, typical_seconds - elapsed))
+    typical_cost = metrics.mean("turn.cost_usd")
+    if typical_cost is not None:
+        metrics.incr("faq.saved_cost_usd", typical_cost)
+    print(f"FAQ fast path answered {sender_id} with {entry.key} (score {score:.2f}, runner-up {runner_up:.2f}).")
+    return {"role": "assistant", "content": [{"type": "text", "text": reply}]}
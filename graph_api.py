@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+GRAPH_API_BASE = "https://graph.instagram.com"
+GRAPH_API_VERSION = os.getenv("GRAPH_API_VERSION", "v22.0") # the one version every Graph API call uses
+GRAPH_CONNECT_TIMEOUT = 5 # seconds to open a connection
+GRAPH_READ_TIMEOUT = float(os.getenv("GRAPH_READ_TIMEOUT", 20)) # seconds to wait for a response
+GRAPH_RETRIES = int(os.getenv("GRAPH_RETRIES", 2)) # retries of transient failures (see _retry)
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", 32)) # keep-alive connections per process
+# ---------------------
+
+def _retry():
+    """
+    Connection failures are retried for every method (the request never reached the
+    server). Read timeouts and 5xx are retried for GETs only: a POST that timed out may
+    have sent its message, and retrying it would send it twice.
+    """
+    return Retry(
+        total=GRAPH_RETRIES,
+        connect=GRAPH_RETRIES,
+        read=GRAPH_RETRIES,
+        status=GRAPH_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        respect_retry_after_header=True,
+        raise_on_status=False, # The caller sees the last response and handles its status
+    )
+
+class GraphAPI:
+    """
+    Instagram Graph API client: one keep-alive connection pool per process, default
+    timeouts, retries of transient failures, and latency and error counts per endpoint
+    under graph.<endpoint>.*. Thread-safe.
+    """
+
+    def __init__(self, base=GRAPH_API_BASE, version=GRAPH_API_VERSION):
+        self.base = base
+        self.version = version
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+
+    def url(self, path):
+        return f"{self.base}/{self.version}/{path.lstrip('/')}"
+
+    def session(self):
+        """The process's session (a forked worker must not share its parent's sockets)."""
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GRAPH_POOL_SIZE, max_retries=_retry())
+                session.mount("https://", adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    def record(self, endpoint, started, error):
+        """Latency and error counts of one call (also used by the async client in async_clients.py)."""
+        metrics.observe(f"graph.{endpoint}.seconds", time.time() - started)
+        metrics.incr(f"graph.{endpoint}.calls")
+        if error:
+            metrics.incr(f"graph.{endpoint}.errors")
+
+    def request(self, method, path, endpoint, **kwargs):
+        """
+        Sends a request to the versioned API path. `endpoint` names the call in metrics
+        (paths hold ids). Returns the response whatever its status; connection errors and
+        timeouts that outlast the retries raise requests.exceptions.RequestException.
+        """
+        kwargs.setdefault("timeout", (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT))
+        started = time.time()
+        try:
+            response = self.session().request(method, self.url(path), **kwargs)
+        except requests.exceptions.RequestException:
+            self.record(endpoint, started, True)
+            raise
+        self.record(endpoint, started, response.status_code >= 400)
+        return response
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request("GET", path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request("POST", path, endpoint, **kwargs)
+
+client = GraphAPI()
@@ -0,0 +1,18 @@
+# Production server: gunicorn picks this file up automatically, so `gunicorn app:app` is enough.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 120
+# app.py starts its worker pool and ingestion replay thread on import; threads do not
+# survive fork, so every worker loads the app itself
+preload_app = False
+
+if workers > 1:
+    # Workers must share the per-sender batching state and the seen message ids,
+    # otherwise two of them can answer the same customer
+    os.environ.setdefault("COORDINATION_BACKEND", "mongo")
+    os.environ.setdefault("DEDUP_STORE", "mongo")
@@ -0,0 +1,202 @@
+import hashlib
+import io
+import mimetypes
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+
+import requests
+
+import blobstore
+import metrics
+from cache import TTLCache
+
+try:
+    from PIL import Image # In requirements.txt; without it images are passed through unscaled
+except ImportError:
+    Image = None
+    print("Warning: Pillow is not installed; images are sent to the model without downscaling or re-encoding.")
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+IMAGE_FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", 10)) # seconds to connect and between received bytes
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024)) # larger downloads are abandoned
+IMAGE_FETCH_WORKERS = int(os.getenv("IMAGE_FETCH_WORKERS", 8)) # concurrent downloads
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", 2)) # processes that decode and downscale
+IMAGE_MAX_EDGE = 1568 # px; the model downsamples anything larger, so sending more only costs tokens
+IMAGE_MAX_PIXELS = 1150000 # same, for the total pixel count
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_TTL = 3600 # seconds the blob of a processed image is remembered
+IMAGE_CACHE_MAX = 4096 # blob references remembered (a few hundred bytes each)
+# ---------------------
+
+SUPPORTED_MEDIA_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+CHUNK_SIZE = 64 * 1024
+
+# Blob references of processed images, keyed by content hash of the download (the same
+# photo under different CDN URLs) and by URL
+_by_hash = TTLCache(IMAGE_CACHE_TTL, IMAGE_CACHE_MAX)
+_by_url = TTLCache(IMAGE_CACHE_TTL, IMAGE_CACHE_MAX)
+
+_fetch_pool = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
+_process_pool = None
+_process_pool_pid = None
+_process_pool_lock = threading.Lock()
+
+def _sniff_media_type(data):
+    """Media type from the file signature, or None."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def _media_type(data, content_type, url):
+    """Detects the media type from the bytes, then the Content-Type header, then the URL."""
+    media_type = _sniff_media_type(data)
+    if media_type is None and content_type and content_type.lower().startswith("image/"):
+        media_type = content_type.split(";")[0].strip().lower()
+    if media_type is None:
+        guessed_type, _ = mimetypes.guess_type(url)
+        if guessed_type and guessed_type.lower().startswith("image/"):
+            media_type = guessed_type.lower()
+    return media_type
+
+def fetch(url):
+    """Downloads an image with a timeout and a byte cap. Returns (bytes, media_type) or (None, None)."""
+    started = time.time()
+    try:
+        with requests.get(url, stream=True, timeout=IMAGE_FETCH_TIMEOUT) as response:
+            response.raise_for_status()
+            declared = int(response.headers.get("content-length") or 0)
+            if declared > IMAGE_MAX_BYTES:
+                print(f"Skipping image of {declared} bytes (cap {IMAGE_MAX_BYTES}): {url}")
+                metrics.incr("images.too_large")
+                return None, None
+            buffer = io.BytesIO()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                buffer.write(chunk)
+                if buffer.tell() > IMAGE_MAX_BYTES:
+                    print(f"Abandoned image download past {IMAGE_MAX_BYTES} bytes: {url}")
+                    metrics.incr("images.too_large")
+                    return None, None
+            data = buffer.getvalue()
+            media_type = _media_type(data, response.headers.get("content-type"), url)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching image from URL {url}: {e}")
+        metrics.incr("images.fetch_errors")
+        return None, None
+    metrics.observe("images.fetch_seconds", time.time() - started)
+    metrics.incr("images.bytes_in", len(data))
+    return data, media_type
+
+def downscale(data, media_type):
+    """
+    Shrinks an image to what the model can use and re-encodes it. Runs in the process
+    pool. Returns (bytes, media_type); the input is returned when it is already as small.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        scale = min(1.0, IMAGE_MAX_EDGE / max(width, height), (IMAGE_MAX_PIXELS / (width * height)) ** 0.5)
+        if scale >= 1.0 and media_type in SUPPORTED_MEDIA_TYPES and media_type != "image/gif":
+            return data, media_type
+        if scale < 1.0:
+            image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+        out = io.BytesIO()
+        # Alpha needs PNG; everything else (including the first frame of a GIF) becomes JPEG
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(out, format="PNG", optimize=True)
+            encoded = (out.getvalue(), "image/png")
+        else:
+            image.convert("RGB").save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            encoded = (out.getvalue(), "image/jpeg")
+    if scale >= 1.0 and len(encoded[0]) >= len(data) and media_type in SUPPORTED_MEDIA_TYPES:
+        return data, media_type
+    return encoded
+
+def _processes():
+    global _process_pool, _process_pool_pid
+    with _process_pool_lock:
+        if _process_pool is None or _process_pool_pid != os.getpid():
+            # spawn: forking a process that runs many threads is not safe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+            _process_pool_pid = os.getpid()
+        return _process_pool
+
+def _shrink(data, media_type):
+    global _process_pool
+    if Image is None:
+        metrics.incr("images.unscaled")
+        return data, media_type
+    started = time.time()
+    try:
+        data, media_type = _processes().submit(downscale, data, media_type).result()
+    except BrokenProcessPool as e:
+        print(f"Image process pool failed ({e}); recreating it and sending the original image.")
+        with _process_pool_lock:
+            _process_pool = None
+    except Exception as e:
+        print(f"Error downscaling image, sending the original: {e}")
+    metrics.observe("images.process_seconds", time.time() - started)
+    return data, media_type
+
+def to_blob(url):
+    """
+    Fetches and downscales one image and puts it in the blob store. Returns the blob
+    reference (see blobstore.put) or None. Results are shared by URL and by content.
+    """
+    cached = _by_url.get(url)
+    if cached is not None:
+        metrics.incr("images.cache_hits")
+        return cached
+
+    data, media_type = fetch(url)
+    if data is None:
+        return None
+    if media_type is None:
+        print(f"Error: Could not determine image type for URL: {url}")
+        return None
+
+    digest = hashlib.sha256(data).hexdigest()
+    ref = _by_hash.get(digest)
+    if ref is not None:
+        metrics.incr("images.dedup_hits")
+    else:
+        data, media_type = _shrink(data, media_type)
+        metrics.incr("images.bytes_out", len(data))
+        ref = blobstore.put(data, media_type)
+        _by_hash.set(digest, ref)
+    _by_url.set(url, ref)
+    return ref
+
+def to_base64(url):
+    """Like to_blob, but returns (base64_string, media_type) or (None, None), like functions.url_to_base64."""
+    ref = to_blob(url)
+    data = blobstore.load_base64(ref) if ref else None
+    if data is None:
+        return None, None
+    return data, ref["media_type"]
+
+def _to_blob_or_none(url):
+    try:
+        return to_blob(url)
+    except Exception as e:
+        print(f"Error processing image from URL {url}: {e}")
+        return None
+
+def to_blob_many(urls):
+    """Processes several images concurrently. Returns blob references (or None) in the order of `urls`."""
+    if len(urls) <= 1:
+        return [_to_blob_or_none(url) for url in urls]
+    return list(_fetch_pool.map(_to_blob_or_none, urls))
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+INGEST_LOG_PATH = os.getenv("INGEST_LOG_PATH", "ingest_log.db")
+INGEST_LOG_SYNC = os.getenv("INGEST_LOG_SYNC", "NORMAL").upper() # NORMAL survives process crashes, FULL also power loss
+CLAIM_TIMEOUT = 300 # seconds before a claimed but unfinished entry is considered abandoned
+MAX_ATTEMPTS = 3 # entries that keep failing are parked as 'failed' instead of replayed forever
+RETENTION_SECONDS = 24 * 60 * 60 # how long finished entries are kept before compaction
+FAILED_RETENTION_SECONDS = int(os.getenv("INGEST_LOG_FAILED_RETENTION", 7 * 24 * 60 * 60)) # failed entries are kept longer, for inspection
+# ---------------------
+
+_local = threading.local()
+
+def _connect():
+    """Returns this thread's connection, creating the schema on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(INGEST_LOG_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={INGEST_LOG_SYNC}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            body BLOB NOT NULL,
+            received_at REAL NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            claimed_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS entries_state ON entries (state, received_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pending_batches (
+            sender_id TEXT NOT NULL,
+            owner_id TEXT NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (sender_id, owner_id)
+        )""")
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+# --- Webhook entries ---
+def append(body):
+    """Durably appends a raw webhook body and returns its entry id."""
+    cursor = _connect().execute(
+        "INSERT INTO entries (body, received_at) VALUES (?, ?)",
+        (sqlite3.Binary(body), time.time())
+    )
+    return cursor.lastrowid
+
+def claim(entry_id):
+    """
+    Marks an entry as being processed by the caller and returns its body.
+    Returns None if the entry is finished or currently claimed by someone else.
+    """
+    now = time.time()
+    conn = _connect()
+    cursor = conn.execute(
+        """UPDATE entries SET state = 'claimed', claimed_at = ?, attempts = attempts + 1
+           WHERE id = ? AND (state = 'pending' OR (state = 'claimed' AND claimed_at < ?))""",
+        (now, entry_id, now - CLAIM_TIMEOUT)
+    )
+    if cursor.rowcount == 0:
+        return None
+    row = conn.execute("SELECT body FROM entries WHERE id = ?", (entry_id,)).fetchone()
+    return bytes(row[0]) if row else None
+
+def complete(entry_id):
+    _connect().execute("UPDATE entries SET state = 'done' WHERE id = ?", (entry_id,))
+
+def release(entry_id):
+    """Gives a claimed entry back after a failure so it is retried, up to MAX_ATTEMPTS."""
+    _connect().execute(
+        """UPDATE entries SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, claimed_at = NULL
+           WHERE id = ? AND state = 'claimed'""",
+        (MAX_ATTEMPTS, entry_id)
+    )
+
+def unfinished(older_than=0, limit=500):
+    """Ids of entries that were never fully processed (pending or abandoned claims), oldest first."""
+    now = time.time()
+    rows = _connect().execute(
+        """SELECT id FROM entries
+           WHERE received_at <= ? AND attempts < ?
+             AND (state = 'pending' OR (state = 'claimed' AND claimed_at < ?))
+           ORDER BY id LIMIT ?""",
+        (now - older_than, MAX_ATTEMPTS, now - CLAIM_TIMEOUT, limit)
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def compact():
+    """Drops finished entries past the retention window, and failed ones past theirs."""
+    now = time.time()
+    conn = _connect()
+    done = conn.execute(
+        "DELETE FROM entries WHERE state = 'done' AND received_at < ?",
+        (now - RETENTION_SECONDS,)
+    ).rowcount
+    failed = conn.execute(
+        "DELETE FROM entries WHERE state = 'failed' AND received_at < ?",
+        (now - FAILED_RETENTION_SECONDS,)
+    ).rowcount
+    if failed:
+        metrics.incr("ingest_log.pruned_failed", failed)
+    return done + failed
+
+def stats():
+    rows = _connect().execute("SELECT state, COUNT(*) FROM entries GROUP BY state").fetchall()
+    batches = _connect().execute("SELECT COUNT(*) FROM pending_batches").fetchone()[0]
+    return {"entries": {state: count for state, count in rows}, "pending_batches": batches}
+
+def failed_count():
+    """Entries parked after MAX_ATTEMPTS (poison payloads), until compaction drops them."""
+    return _connect().execute("SELECT COUNT(*) FROM entries WHERE state = 'failed'").fetchone()[0]
+
+metrics.register_gauge("ingest_log", stats)
+metrics.register_gauge("ingest_log.failed", failed_count)
+
+# --- Batches waiting for their debounce timer ---
+def remember_batch(sender_id, owner_id):
+    """Records that a reply batch is owed to sender_id so it can be re-armed after a restart."""
+    _connect().execute(
+        """INSERT INTO pending_batches (sender_id, owner_id, recorded_at) VALUES (?, ?, ?)
+           ON CONFLICT (sender_id, owner_id) DO UPDATE SET recorded_at = excluded.recorded_at""",
+        (str(sender_id), str(owner_id), time.time())
+    )
+
+def forget_batch(sender_id, owner_id, before):
+    """Clears the pending batch unless a newer message was recorded after `before` (epoch seconds)."""
+    _connect().execute(
+        "DELETE FROM pending_batches WHERE sender_id = ? AND owner_id = ? AND recorded_at <= ?",
+        (str(sender_id), str(owner_id), before)
+    )
+
+def take_pending_batches():
+    """Atomically removes and returns every (sender_id, owner_id) still owed a reply."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("SELECT sender_id, owner_id FROM pending_batches").fetchall()
+        conn.execute("DELETE FROM pending_batches")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
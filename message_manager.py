@@ -7,11 +7,19 @@ import database
 import ai
 import time
 import random
-from collections import defaultdict
-import threading
-import datetime
 import pytz
-import functions
+import images
+import ingest_log
+import dedup
+import faq
+import dispatcher
+import scheduler
+import debounce
+import cancellation
+import outbound
+import owner_config
+import retry
+from coordination import COORDINATION_BACKEND, coordinator
 import traceback # Import traceback for detailed error logging
 
 TARGET_TZ = pytz.timezone('America/New_York')
@@ -22,15 +30,14 @@ load_dotenv(override=True)
 access_token = os.environ.get("long_access_token")
 
 # --- New State Variables ---
-# Lock for each sender's state
-processing_locks = defaultdict(threading.Lock)
-# Flag indicating if process_message_batch is running for a sender
-is_processing = defaultdict(bool)
-# Timestamp of the last message received from a sender
-last_message_timestamp = defaultdict(lambda: None)
-# Active batch timers
-batch_timers = {}
-BATCH_WINDOW = 10
+# Which sender is being processed, its message counter and who owns its batch timer live in
+# the coordinator (see coordination.py), so several worker processes can share them.
+# How long to wait for follow-up messages is picked per batch, see debounce.py.
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 16)) # batches (LLM round trips) running at once in this process
+# How often a running batch asks the shared coordinator whether another worker recorded a newer message
+CANCEL_POLL_INTERVAL = 0 if COORDINATION_BACKEND == "memory" else 1.0
+# Send each sentence of a reply as soon as the model has written it instead of after the whole turn
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() == "true"
 # --- End New State Variables ---
 
 # --- Helper Function for Formatting API Messages ---
@@ -63,17 +70,14 @@ def _format_api_message(api_msg, sender_id, owner_id):
             image_url = image_data["url"]
             print(f"Processing image attachment from API history URL: {image_url}")
             try:
-                base64_data, media_type = functions.url_to_base64(image_url)
-                if base64_data and media_type:
-                    print(f"Successfully converted API image to base64. Media Type: {media_type}")
-                    content_parts.append({
-                        "type": "image",
-                        "source": {"type": "base64", "media_type": media_type, "data": base64_data}
-                    })
+                blob_ref = images.to_blob(image_url)
+                if blob_ref:
+                    print(f"Stored API image as blob {blob_ref['blob_id']}. Media Type: {blob_ref['media_type']}")
+                    content_parts.append({"type": "image", "source": blob_ref})
                 else:
-                    print(f"Failed to convert API image from URL: {image_url}")
+                    print(f"Failed to store API image from URL: {image_url}")
             except Exception as e:
-                print(f"Error converting API image URL {image_url} to base64: {e}")
+                print(f"Error storing API image URL {image_url}: {e}")
         # TODO: Handle other attachment types
 
     if content_parts and role != "unknown":
@@ -84,27 +88,72 @@ def _format_api_message(api_msg, sender_id, owner_id):
     else:
         print(f"Skipping formatting API message due to no valid content parts or unknown role: {api_msg}")
         return None
+
+def format_api_messages(api_conversation_messages, sender_id, owner_id):
+    """Formats a chronological Instagram API history into DB messages, dropping unusable ones."""
+    # Download every image of the history concurrently up front; formatting then hits the cache
+    images.to_blob_many([
+        attachment["image_data"]["url"]
+        for api_msg in api_conversation_messages
+        for attachment in api_msg.get('attachments', {}).get('data', [])
+        if (attachment.get("image_data") or {}).get("url")
+    ])
+    formatted_api_messages = []
+    for api_msg in api_conversation_messages:
+        formatted_msg = _format_api_message(api_msg, sender_id, owner_id)
+        if formatted_msg:
+            formatted_api_messages.append(formatted_msg)
+    print(f"Formatted {len(formatted_api_messages)} valid messages from API.")
+    return formatted_api_messages
+
+def user_facing_content(ai_generated_messages):
+    """Extracts the text of every assistant message that should be shown to the customer."""
+    texts = []
+    for msg in ai_generated_messages:
+        if msg.get("role") == "assistant" and msg.get("content"):
+            if isinstance(msg["content"], list):
+                text_parts = [
+                    block.get("text", "")
+                    for block in msg["content"]
+                    if isinstance(block, dict) and block.get("type") == "text"
+                ]
+                combined_text = " ".join(filter(None, text_parts)).strip()
+                if combined_text:
+                    texts.append(combined_text)
+            elif isinstance(msg["content"], str):
+                if msg["content"].strip():
+                    texts.append(msg["content"].strip())
+    return texts
 # --- End Helper Function ---
 
+def _arm_batch(sender_id, owner_id, delay):
+    """Sets the deadline for a batch whose timer the caller has claimed from the coordinator."""
+    batch_scheduler.schedule(sender_id, delay, sender_id, owner_id)
+
 def process_message_batch(sender_id, owner_id):
     """Process messages for a sender, syncing short history first, then checking active status."""
     print(f"Attempting to process batch for {sender_id}")
 
-    with processing_locks[sender_id]:
-        if sender_id in batch_timers:
-            print(f"Cleared timer reference for {sender_id}")
-            del batch_timers[sender_id]
-        if is_processing[sender_id]:
-            print(f"Warning: process_message_batch called for {sender_id} while already processing. Aborting this call.")
-            return
-        is_processing[sender_id] = True
-        start_processing_based_on_ts = last_message_timestamp[sender_id]
-        print(f"Starting processing for {sender_id}. Baseline timestamp: {start_processing_based_on_ts}")
+    lease = coordinator.try_begin(sender_id)
+    if lease is None:
+        print(f"Warning: process_message_batch called for {sender_id} while already processing. Aborting this call.")
+        return
+    started_at = time.time()
+    print(f"Starting processing for {sender_id}. Baseline message count: {lease.baseline}")
+    # Cancelled directly when this process records a newer message, and by polling otherwise
+    cancel_token = cancellation.CancellationToken(
+        check=lambda: coordinator.has_newer(sender_id, lease), poll_interval=CANCEL_POLL_INTERVAL
+    )
+
+    reply = outbound.ReplyStream(sender_id) if STREAM_REPLIES else None
 
     # --- Get DB History and Potentially Sync (BEFORE active check) ---
     ai_generated_messages = []
+    retry_later = None
     final_conversation_history = [] # This will hold the history to be used by AI if active
 
+    cancellation.register(sender_id, cancel_token)
+
     try:
         # Ensure owner_id is treated as string
         owner_id_str = str(owner_id)
@@ -130,12 +179,7 @@ def process_message_batch(sender_id, owner_id):
                     print(f"API conversation is longer ({len(api_conversation_messages)}) than DB ({len(latest_conversation_db)}). Formatting and syncing.")
 
                     # Format API Messages
-                    formatted_api_messages = []
-                    for api_msg in api_conversation_messages:
-                        formatted_msg = _format_api_message(api_msg, sender_id, owner_id_str)
-                        if formatted_msg:
-                            formatted_api_messages.append(formatted_msg)
-                    print(f"Formatted {len(formatted_api_messages)} valid messages from API.")
+                    formatted_api_messages = format_api_messages(api_conversation_messages, sender_id, owner_id_str)
 
                     if formatted_api_messages:
                         # Update Database
@@ -164,13 +208,17 @@ def process_message_batch(sender_id, owner_id):
             # final_conversation_history remains latest_conversation_db
 
         # --- Now check active status and process AI if applicable ---
-        if database.check_user_active(sender_id, owner_id_str) and database.check_bot_active(owner_id_str):
+        if database.check_user_active(sender_id, owner_id_str) and owner_config.get(owner_id_str).active:
             print(f"User {sender_id} and Bot {owner_id_str} are active.")
             # Proceed with AI processing using the determined (potentially synced) history
             if final_conversation_history:
                 print(f"Processing conversation for {sender_id}. Final length used: {len(final_conversation_history)}")
-                llm = ai.llm(owner_id_str)
-                ai_generated_messages = llm.process_query(sender_id, final_conversation_history, owner_id_str)
+                faq_answer = faq.answer(owner_id_str, sender_id, final_conversation_history) if faq.FAQ_FAST_PATH else None
+                if faq_answer is not None:
+                    ai_generated_messages = [faq_answer]
+                else:
+                    llm = ai.llm(owner_id_str)
+                    ai_generated_messages = llm.process_query(sender_id, final_conversation_history, owner_id_str, cancel_token, reply)
                 print(f"AI generated {len(ai_generated_messages)} messages for {sender_id}")
             else:
                  # This case should be rare now, only if DB was empty and sync failed/yielded nothing
@@ -179,78 +227,105 @@ def process_message_batch(sender_id, owner_id):
             # User or Bot is not active, skip AI processing
             print(f"User {sender_id} or Bot ({owner_id_str}) is not active. Skipping AI processing.")
 
+    except cancellation.Cancelled as e:
+         # A newer message arrived; the rerun below answers the whole batch
+         print(f"Aborted processing for {sender_id}: {e}")
+         ai_generated_messages = []
+    except retry.RetryLater as e:
+         # The model API is rate limited or degraded; hand the batch back instead of sleeping here
+         print(f"Deferring batch for {sender_id}: {e}")
+         retry_later = e
+         ai_generated_messages = []
     except Exception as e:
          print(f"Error during processing/syncing for {sender_id}: {e}\n{traceback.format_exc()}")
          ai_generated_messages = [] # Ensure empty on error
     finally:
-        # --- Re-acquire Lock and Check Timestamps ---
-        with processing_locks[sender_id]:
-            current_last_message_ts = last_message_timestamp[sender_id]
-            print(f"Finished processing for {sender_id}. Current last message timestamp: {current_last_message_ts}")
-
-            should_reschedule = (
-                current_last_message_ts is not None and
-                start_processing_based_on_ts is not None and
-                current_last_message_ts > start_processing_based_on_ts
-            )
-
-            if not should_reschedule:
-                print(f"No new messages arrived for {sender_id} during processing. Proceeding to send.")
-                # Process and send the response only if AI was called and generated messages
-                if ai_generated_messages:
-                     # --- REVISED LOGIC START ---
-                     user_facing_content = []
-                     for msg in ai_generated_messages:
-                         if msg.get("role") == "assistant" and msg.get("content"):
-                             if isinstance(msg["content"], list):
-                                 text_parts = [
-                                     block.get("text", "")
-                                     for block in msg["content"]
-                                     if isinstance(block, dict) and block.get("type") == "text"
-                                 ]
-                                 combined_text = " ".join(filter(None, text_parts)).strip()
-                                 if combined_text:
-                                     user_facing_content.append(combined_text)
-                             elif isinstance(msg["content"], str):
-                                 if msg["content"].strip():
-                                     user_facing_content.append(msg["content"].strip())
-
-                     print(f"Sending user_facing_content list to {sender_id}: {user_facing_content}")
-                     if user_facing_content:
-                         actions.send_text_messages(sender_id, user_facing_content)
-                     else:
-                         print(f"No user-facing text content generated by AI for {sender_id}.")
-                     # --- REVISED LOGIC END ---
-                else:
-                     # This case now covers:
-                     # 1. AI processing skipped (user/bot inactive)
-                     # 2. AI ran but generated no messages
-                     # 3. An error occurred before/during AI call
-                     print(f"No AI messages were generated or AI was skipped for {sender_id}.")
-
+        cancellation.unregister(sender_id, cancel_token)
+        # --- Release the sender and check for messages that arrived meanwhile ---
+        should_reschedule = coordinator.finish(sender_id, lease)
+        print(f"Finished processing for {sender_id}. New messages during processing: {should_reschedule}")
+
+        if not should_reschedule and retry_later is not None:
+            # Still owed: the ingestion log keeps the batch until it is answered
+            if coordinator.claim_timer(sender_id, retry_later.delay):
+                _arm_batch(sender_id, owner_id, retry_later.delay)
+
+        elif not should_reschedule:
+            print(f"No new messages arrived for {sender_id} during processing. Proceeding to send.")
+            # Process and send the response only if AI was called and generated messages
+            if ai_generated_messages:
+                 reply_texts = user_facing_content(ai_generated_messages)
+                 print(f"Sending user_facing_content list to {sender_id}: {reply_texts}")
+                 if reply is not None and reply.delivered:
+                     print(f"Reply to {sender_id} was streamed ({reply.delivered} chunks).")
+                 elif reply_texts:
+                     # Delivered in the background (typing pauses included); like
+                     # actions.send_text_messages, only the final text is sent
+                     outbound.deliver(sender_id, reply_texts[-1])
+                 else:
+                     print(f"No user-facing text content generated by AI for {sender_id}.")
             else:
-                # New message(s) arrived during processing. Discard result and reschedule.
-                print(f"New message arrived for {sender_id} during processing. Discarding response and rescheduling.")
-                if sender_id in batch_timers: # Clear any potentially conflicting timer
-                    try: batch_timers[sender_id].cancel()
-                    except Exception: pass
-                    del batch_timers[sender_id]
-
-                print(f"Scheduling immediate reprocessing for {sender_id}")
-                batch_timers[sender_id] = threading.Timer(
-                    0.1, process_message_batch, args=[sender_id, owner_id]
-                )
-                batch_timers[sender_id].start()
-
-            # Mark processing as finished for this cycle
-            is_processing[sender_id] = False
-            print(f"Set is_processing=False for {sender_id}")
-            # Lock is released automatically here
+                 # This case now covers:
+                 # 1. AI processing skipped (user/bot inactive)
+                 # 2. AI ran but generated no messages
+                 # 3. An error occurred before/during AI call
+                 print(f"No AI messages were generated or AI was skipped for {sender_id}.")
 
-def process_messages(request):
-    # Ensure owner_id is consistently treated (e.g., as string)
-    owner_id = request["entry"][0]["id"] # This is usually the Page ID / Bot Owner ID
-    messaging_event = request["entry"][0]["messaging"][0]
+            # The batch owed to this sender is settled; nothing to resume after a restart
+            ingest_log.forget_batch(sender_id, owner_id, started_at)
+
+        else:
+            # New message(s) arrived during processing. Discard result and reschedule;
+            # finish() has already claimed the timer for us
+            print(f"New message arrived for {sender_id} during processing. Discarding response and rescheduling.")
+            print(f"Scheduling immediate reprocessing for {sender_id}")
+            _arm_batch(sender_id, owner_id, 0.1)
+
+def _build_user_message(message, sender):
+    """Turns the 'message' field of an incoming messaging event into a DB message, or None."""
+    user_message = {"role": "user", "content": None}
+    msg_content_parts = [] # Build content using parts
+
+    # Handle text
+    text_content = message.get("text")
+    if text_content and text_content.strip():
+        msg_content_parts.append({"type": "text", "text": text_content.strip()})
+
+    # Handle image attachments (all of a message's images are fetched concurrently)
+    attachments = message.get("attachments", [])
+    image_urls = [
+        attachment.get("payload", {}).get("url")
+        for attachment in attachments if attachment.get("type") == "image"
+    ]
+    # Only a blob reference is saved in the conversation; context.build loads the image when it is sent
+    stored = iter(images.to_blob_many([url for url in image_urls if url]))
+    for attachment in attachments:
+        if attachment.get("type") == "image":
+            image_url = attachment.get("payload", {}).get("url")
+            if image_url:
+                print(f"Processing incoming image attachment from URL: {image_url}")
+                try:
+                    blob_ref = next(stored)
+                    if blob_ref:
+                        print(f"Stored incoming image as blob {blob_ref['blob_id']}. Media Type: {blob_ref['media_type']}")
+                        msg_content_parts.append({"type": "image", "source": blob_ref})
+                    else:
+                        print(f"Failed to store incoming image from URL: {image_url}")
+                except Exception as e:
+                     print(f"Error storing incoming image URL {image_url}: {e}")
+            else:
+                 print("Incoming image attachment found but no URL in payload.")
+        # Handle other incoming attachments if needed (e.g., shares, audio, video)
+
+    # Assign content only if parts were added
+    if msg_content_parts:
+         user_message["content"] = msg_content_parts
+         return user_message
+    print(f"No content (text/image) to save for message from {sender}")
+    return None # Don't save if no text or valid image
+
+def _collect_event(messaging_event, owner_id, user_batches, owner_batches):
+    """Sorts one messaging event into the per-sender (or per-recipient) batches of this delivery."""
     sender = messaging_event["sender"]["id"] # This is the User's ID
     receiver = messaging_event["recipient"]["id"] # This is usually the Page ID / Bot Owner ID
 
@@ -277,119 +352,165 @@ def process_messages(request):
             # Handle attachments sent by owner? Currently ignored.
             return
 
-        # Format as assistant message for the *recipient's* conversation history
-        message_to_save = {
-            "role": "assistant",
-            "content": [{"type": "text", "text": msg_text}]
-        }
-
         # Check if it's an echo of the bot's own outgoing message
         # Note: The exact structure/field for "is_echo" needs verification from Meta docs/testing
         is_echo = message_content.get("is_echo", False) # Assume boolean false if missing
-
-        if not is_echo:
-            print("Owner message is not an echo, saving to recipient's DB.")
-            # Save to the conversation history associated with the *recipient_user_id*
-            database.add_message(recipient_user_id, [message_to_save], owner_id)
-        else:
+        if is_echo:
             print("Owner message is an echo, not saving.")
+            return
+
+        mid = message_content.get("mid")
+        if not dedup.claim(mid):
+            print(f"Skipping duplicate owner message: {mid}")
+            return
+
+        # Format as assistant message for the *recipient's* conversation history
+        batch = owner_batches.setdefault((recipient_user_id, owner_id), {"messages": [], "mids": []})
+        batch["messages"].append({
+            "role": "assistant",
+            "content": [{"type": "text", "text": msg_text}]
+        })
+        batch["mids"].append(mid)
         return
 
     # Message RECEIVED BY Owner/Page (treat as 'user' message from the sender)
-    if sender != owner_id: # Redundant check given the logic flow, but explicit
-        print(f"Message received by owner ({owner_id}) from user {sender}")
-
-        # Acquire lock specific to this sender
-        with processing_locks[sender]:
-            # 1. Record the timestamp immediately
-            now_ts = datetime.datetime.now(tz=TARGET_TZ)
-            last_message_timestamp[sender] = now_ts
-            print(f"Updated last_message_timestamp for {sender} to {now_ts}")
-
-            # 2. Prepare and save the message to DB
-            message = message_obj.get("message") # Use .get for safety
-            if not message:
-                print(f"Received message object structure doesn't contain 'message' field for {sender}. Payload: {message_obj}")
-                return # Skip processing if no message content
-
-            # Ignore messages potentially marked as echoes from the user side? Unlikely but possible.
-            if message.get("is_echo", False):
-                print(f"Received echo message from user {sender}. Skipping save/processing.")
-                return
-
-            user_message = {"role": "user", "content": None}
-            msg_content_parts = [] # Build content using parts
-
-            # Handle text
-            text_content = message.get("text")
-            if text_content and text_content.strip():
-                msg_content_parts.append({"type": "text", "text": text_content.strip()})
-
-            # Handle image attachments
-            attachments = message.get("attachments", [])
-            for attachment in attachments:
-                if attachment.get("type") == "image":
-                    image_url = attachment.get("payload", {}).get("url")
-                    if image_url:
-                        print(f"Processing incoming image attachment from URL: {image_url}")
-                        try:
-                            base64_data, media_type = functions.url_to_base64(image_url)
-                            if base64_data and media_type:
-                                print(f"Successfully converted incoming image to base64. Media Type: {media_type}")
-                                msg_content_parts.append({
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": media_type,
-                                        "data": base64_data
-                                    }
-                                })
-                            else:
-                                print(f"Failed to convert incoming image from URL: {image_url}")
-                        except Exception as e:
-                             print(f"Error converting incoming image URL {image_url} to base64: {e}")
-                    else:
-                         print("Incoming image attachment found but no URL in payload.")
-                # Handle other incoming attachments if needed (e.g., shares, audio, video)
+    print(f"Message received by owner ({owner_id}) from user {sender}")
+    message = message_obj.get("message") # Use .get for safety
+    if not message:
+        print(f"Received message object structure doesn't contain 'message' field for {sender}. Payload: {message_obj}")
+        return # Skip processing if no message content
+
+    # Ignore messages potentially marked as echoes from the user side? Unlikely but possible.
+    if message.get("is_echo", False):
+        print(f"Received echo message from user {sender}. Skipping save/processing.")
+        return
 
-            # Assign content only if parts were added
-            if msg_content_parts:
-                 user_message["content"] = msg_content_parts
-            else:
-                 user_message = None # Don't save if no text or valid image
+    # Meta redelivers events it thinks we missed; the mid identifies the message itself
+    mid = message.get("mid")
+    if not dedup.claim(mid):
+        print(f"Skipping duplicate message: {mid}")
+        return
 
-            # Save the user message to DB if valid
-            if user_message:
-                print(f"Saving message for user {sender}")
-                database.add_message(sender, [user_message], owner_id)
-            else:
-                 print(f"No content (text/image) to save for message from {sender}")
-
-
-            # 3. Manage Batch Timer
-            timer_exists = sender in batch_timers and batch_timers[sender].is_alive()
-
-            # Only start a new timer if processing is NOT active and no timer is already running
-            if not is_processing[sender] and not timer_exists:
-                print(f"Starting batch timer for {sender}")
-                if sender in batch_timers: # Clear old timer ref just in case
-                    try: batch_timers[sender].cancel()
-                    except Exception: pass
-                    del batch_timers[sender]
-
-                batch_timers[sender] = threading.Timer(
-                    BATCH_WINDOW,
-                    process_message_batch,
-                    # Pass the correct sender ID (user) and owner ID (bot)
-                    args=[sender, owner_id]
-                )
-                batch_timers[sender].start()
-            elif is_processing[sender]:
-                 print(f"Processing already active for {sender}, timer not started.")
-            elif timer_exists:
-                 print(f"Timer already running for {sender}, not starting a new one.")
-
-        # Lock is released automatically here
+    # An event without usable content still (re)arms the sender's batch, as before
+    batch = user_batches.setdefault((sender, owner_id), {"messages": [], "mids": []})
+    try:
+        user_message = _build_user_message(message, sender)
+    except Exception:
+        dedup.forget(mid) # Not in any batch, so a redelivery must be accepted
+        raise
+    batch["mids"].append(mid)
+    if user_message:
+        batch["messages"].append(user_message)
+
+def _save_batch(_id, owner_id, batch):
+    """Persists one group with a single write; on failure the mids are released so Meta's redelivery is accepted."""
+    if not batch["messages"] or database.append_messages(_id, batch["messages"], owner_id):
+        batch["saved"] = True
+        dedup.record(batch["mids"])
+        return
+    raise RuntimeError(f"Failed to save {len(batch['messages'])} message(s) for {_id}")
+
+def forget_unsaved(*batch_maps):
+    """Releases the mids of every group of a delivery that was not saved, so its replay is not dropped as a duplicate."""
+    for batches in batch_maps:
+        for batch in batches.values():
+            if not batch.get("saved"):
+                for mid in batch["mids"]:
+                    dedup.forget(mid)
+
+def _record_user_messages(sender, owner_id, batch):
+    """Saves all messages a sender had in this delivery with one write and manages their batch timer."""
+    # 1. Save the messages to DB in a single bulk write. This must happen before the
+    # message is counted: a batch that starts after the count is guaranteed to see it.
+    if batch["messages"]:
+        print(f"Saving {len(batch['messages'])} message(s) for user {sender}")
+    _save_batch(sender, owner_id, batch)
+
+    # 2. Count the message; a batch already running for this sender will then rerun,
+    # so stop its model call now instead of waiting for a reply that will be discarded
+    message_count = coordinator.touch(sender)
+    print(f"Recorded message #{message_count} for {sender}")
+    if cancellation.cancel(sender):
+        print(f"Cancelled the in-flight batch for {sender}.")
+    # The rest of a reply still being typed out is outdated too; the rerun answers everything
+    outbound.preempt(sender)
+
+    # Persist that a reply is owed so the batch survives a restart before the timer fires
+    ingest_log.remember_batch(sender, owner_id)
+
+    # 3. Manage Batch Timer: only one timer per sender across all workers, and none while processing.
+    # The wait depends on the sender's usual cadence and on what they just sent.
+    typical_gap = debounce.learn(sender, owner_id, time.time())
+    window = debounce.choose_window(batch["messages"], typical_gap)
+    if coordinator.claim_timer(sender, window):
+        print(f"Starting {window:.1f}s batch timer for {sender}")
+        # Pass the correct sender ID (user) and owner ID (bot)
+        _arm_batch(sender, owner_id, window)
+    elif batch_scheduler.advance(sender, window):
+        # A follow-up that completes the turn (e.g. the actual question) may only shorten the wait
+        print(f"Moved batch timer for {sender} to {window:.1f}s from now.")
+    else:
+        print(f"Timer already running or processing already active for {sender}, timer not started.")
+
+def collect_events(request):
+    """
+    Reads every entry and messaging event of a webhook delivery. Meta coalesces
+    events under load, so events are grouped per sender (and per recipient for
+    owner messages). Returns (user_batches, owner_batches), both keyed by
+    (user_id, owner_id) with {"messages": [...], "mids": [...]} values in delivery order.
+    """
+    user_batches = {}
+    owner_batches = {}
+
+    for entry in request.get("entry", []):
+        # Ensure owner_id is consistently treated (e.g., as string)
+        owner_id = entry.get("id") # This is usually the Page ID / Bot Owner ID
+        for messaging_event in entry.get("messaging", []):
+            try:
+                _collect_event(messaging_event, owner_id, user_batches, owner_batches)
+            except Exception as e:
+                print(f"Error reading messaging event {messaging_event}: {e}")
+    return user_batches, owner_batches
+
+def process_messages(request):
+    """Ingests a webhook delivery, persisting each sender's group of events with a single write."""
+    user_batches, owner_batches = collect_events(request)
+
+    # Each group is saved (and scheduled) on its own, so one failing sender does not hold up the others
+    failed = 0
+    for (recipient_user_id, owner_id), batch in owner_batches.items():
+        print(f"Owner messages are not echoes, saving {len(batch['messages'])} to recipient {recipient_user_id}'s DB.")
+        try:
+            # Save to the conversation history associated with the *recipient_user_id*
+            _save_batch(recipient_user_id, owner_id, batch)
+        except Exception as e:
+            print(f"Error saving owner messages for {recipient_user_id}: {e}")
+            failed += 1
+
+    for (sender, owner_id), batch in user_batches.items():
+        try:
+            _record_user_messages(sender, owner_id, batch)
+        except Exception as e:
+            print(f"Error recording messages of {sender}: {e}")
+            failed += 1
+
+    if failed:
+        # The entry is released and replayed; the groups not saved must not count as seen
+        forget_unsaved(owner_batches, user_batches)
+        raise RuntimeError(f"{failed} group(s) of the delivery failed")
+
+# Due batches run on a bounded pool; all debounce deadlines share one scheduler thread
+batch_pool = dispatcher.Dispatcher("batch", process_message_batch, workers=BATCH_WORKERS)
+batch_scheduler = scheduler.Scheduler("batch", batch_pool)
+
+def resume_pending_batches():
+    """Re-arms batch timers for senders that were still owed a reply when the process stopped."""
+    for sender_id, owner_id in ingest_log.take_pending_batches():
+        # Keep the record until the resumed batch settles it
+        ingest_log.remember_batch(sender_id, owner_id)
+        if coordinator.claim_timer(sender_id, debounce.BATCH_WINDOW):
+            print(f"Resuming pending batch for {sender_id} (owner {owner_id})")
+            _arm_batch(sender_id, owner_id, debounce.BATCH_WINDOW)
 
 if __name__ == "__main__":
     # Example usage (replace with actual IDs/testing logic if needed)
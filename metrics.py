@@ -0,0 +1,90 @@
+import hmac
+import math
+import os
+import threading
+from collections import defaultdict, deque
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+SAMPLE_WINDOW = 1024 # Number of recent samples kept per latency series
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") # Bearer token for the /metrics route; unset disables it
+# ---------------------
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_samples = defaultdict(lambda: deque(maxlen=SAMPLE_WINDOW))
+_gauges = {}
+
+def incr(name, value=1):
+    """Adds value to a monotonically increasing counter."""
+    with _lock:
+        _counters[name] += value
+
+def observe(name, value):
+    """Records one sample (usually seconds) for a latency/size series."""
+    with _lock:
+        _samples[name].append(value)
+
+def register_gauge(name, fn):
+    """Registers a callable that is evaluated every time a snapshot is taken."""
+    with _lock:
+        _gauges[name] = fn
+
+def mean(name):
+    """Average of the recent samples of a series, or None if it has none."""
+    with _lock:
+        series = list(_samples.get(name, ()))
+    return sum(series) / len(series) if series else None
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list (q between 0 and 100)."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(values):
+    """Returns count/avg/p50/p95/p99/max for a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "avg": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1],
+    }
+
+def snapshot():
+    """Returns a JSON-serializable view of every counter, gauge and series."""
+    with _lock:
+        counters = dict(_counters)
+        samples = {name: list(series) for name, series in _samples.items()}
+        gauges = dict(_gauges)
+
+    gauge_values = {}
+    for name, fn in gauges.items():
+        try:
+            gauge_values[name] = fn()
+        except Exception as e:
+            print(f"Error evaluating gauge {name}: {e}")
+            gauge_values[name] = None
+
+    return {
+        "counters": counters,
+        "gauges": gauge_values,
+        "latencies": {name: summarize(values) for name, values in samples.items()},
+    }
+
+def authorized(auth_header):
+    """
+    True if an Authorization header carries METRICS_TOKEN. Snapshots hold counters of
+    every owner, so an owner's session cookie is not enough to read them.
+    """
+    if not METRICS_TOKEN or not auth_header or not auth_header.startswith("Bearer "):
+        return False
+    return hmac.compare_digest(auth_header[len("Bearer "):].encode(), METRICS_TOKEN.encode())
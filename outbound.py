@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from collections import deque
+from dotenv import load_dotenv
+
+import actions
+import dispatcher
+import metrics
+import scheduler
+from retry import TokenBucket
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 4)) # threads doing Graph API sends (typing pauses hold none)
+OUTBOUND_SENDS_PER_MINUTE = int(os.getenv("OUTBOUND_SENDS_PER_MINUTE", 1200)) # Graph API sends this process may make per minute (0 = no limit)
+# ---------------------
+
+# Delivery stage for finished replies. A reply is split into chunks that are sent one
+# at a time with a typing pause in between; the pause is a scheduler deadline rather
+# than a sleeping thread. Only one chunk per recipient is ever scheduled or in flight,
+# which keeps each recipient's chunks in order; different recipients are sent
+# concurrently, within the send budget shared by all of them.
+_lock = threading.Lock()
+_pending = {} # recipient_id -> deque of (chunk, queued_at) not sent yet
+_delivering = set() # recipients with a chunk scheduled or being sent
+_budget = TokenBucket(OUTBOUND_SENDS_PER_MINUTE) if OUTBOUND_SENDS_PER_MINUTE else None
+
+def take_send_budget():
+    """0 if a Graph API send may be made now (and takes its share of the budget), else the wait in seconds."""
+    return _budget.take(1) if _budget is not None else 0
+
+def _refund_send_budget():
+    if _budget is not None:
+        _budget.refund(1)
+
+def _oldest_pending_seconds():
+    """Age of the oldest chunk still waiting to be sent: how far delivery is behind."""
+    with _lock:
+        oldest = min((chunks[0][1] for chunks in _pending.values() if chunks), default=None)
+    return time.time() - oldest if oldest is not None else 0
+
+metrics.register_gauge("outbound.recipients", lambda: len(_delivering))
+metrics.register_gauge("outbound.pending_chunks", lambda: sum(len(chunks) for chunks in list(_pending.values())))
+metrics.register_gauge("outbound.oldest_pending_seconds", _oldest_pending_seconds)
+
+def deliver(recipient_id, message_text):
+    """Queues a reply for delivery and returns immediately."""
+    chunks = actions.prepare_chunks(message_text)
+    if not chunks:
+        print("No valid message chunks to send after combining.")
+        return
+    _enqueue(recipient_id, chunks)
+
+def _enqueue(recipient_id, chunks):
+    queued_at = time.time()
+    with _lock:
+        _pending.setdefault(recipient_id, deque()).extend((chunk, queued_at) for chunk in chunks)
+        if recipient_id in _delivering:
+            return # The running delivery picks the new chunks up in order
+        _delivering.add(recipient_id)
+    _scheduler.schedule(recipient_id, actions.typing_delay(), recipient_id)
+
+class ReplyStream:
+    """
+    Delivers a reply while the model is still generating it: text deltas go through an
+    actions.ChunkStream and every chunk that is final is queued right away.
+
+    One ReplyStream covers a whole turn (several model calls in a tool loop):
+      start()     before each call (also before a retry of the same call)
+      feed(text)  for each text delta
+      end_text()  when a text block is complete; sends the rest of it
+      finish()    when the call completed
+    Text the model writes before calling a tool ("let me check that for you") is sent
+    as well, so the customer sees something while the tool runs; the non-streaming path
+    only sends the final answer. A retried call usually regenerates the text already
+    sent, so chunks repeating what the failed attempt sent are skipped.
+    """
+
+    def __init__(self, recipient_id):
+        self.recipient_id = recipient_id
+        self.started = time.time()
+        self.delivered = 0 # chunks queued during the whole turn
+        self._chunks = actions.ChunkStream()
+        self._sent = [] # chunks of the current call already queued (across its attempts)
+        self._skip = 0
+
+    def _queue(self, chunks):
+        fresh = []
+        for chunk in chunks:
+            if self._skip < len(self._sent) and self._sent[self._skip] == chunk:
+                self._skip += 1
+                continue
+            self._skip = len(self._sent)
+            fresh.append(chunk)
+        if not fresh:
+            return
+        if not self.delivered:
+            metrics.observe("outbound.first_chunk_seconds", time.time() - self.started)
+        self._sent.extend(fresh)
+        self.delivered += len(fresh)
+        _enqueue(self.recipient_id, fresh)
+
+    def start(self):
+        self._chunks.discard()
+        self._skip = 0
+
+    def feed(self, text):
+        self._queue(self._chunks.feed(text))
+
+    def end_text(self):
+        self._queue(self._chunks.flush())
+
+    def finish(self):
+        self.end_text()
+        self._sent = []
+
+def preempt(recipient_id):
+    """Drops the chunks not sent yet to recipient_id (a chunk already being sent still goes out)."""
+    with _lock:
+        chunks = _pending.get(recipient_id)
+        dropped = len(chunks) if chunks else 0
+        if chunks:
+            chunks.clear()
+    if dropped:
+        print(f"Dropped {dropped} unsent chunk(s) for {recipient_id}; a newer message arrived.")
+        metrics.incr("outbound.preempted_chunks", dropped)
+    return dropped
+
+def _finish_if_idle(recipient_id):
+    """Ends the recipient's delivery when nothing is left. Caller holds _lock. Returns True if ended."""
+    if _pending.get(recipient_id):
+        return False
+    _pending.pop(recipient_id, None)
+    _delivering.discard(recipient_id)
+    return True
+
+def _send_next(recipient_id):
+    with _lock:
+        if _finish_if_idle(recipient_id):
+            return
+    wait = take_send_budget()
+    if wait:
+        # Over the send budget: try again once there is room, keeping the chunk first in line
+        metrics.incr("outbound.throttled")
+        _scheduler.schedule(recipient_id, wait, recipient_id)
+        return
+    with _lock:
+        preempted = _finish_if_idle(recipient_id)
+        if not preempted:
+            chunk, queued_at = _pending[recipient_id].popleft()
+    if preempted:
+        _refund_send_budget() # Nothing is sent, so other recipients keep the share
+        return
+
+    started = time.time()
+    # Typing pauses, earlier chunks of the reply and throttling: the customer waits for all of it
+    metrics.observe("outbound.queue_seconds", started - queued_at)
+    if actions.send_chunk(recipient_id, chunk) is None:
+        metrics.incr("outbound.failed_chunks")
+    else:
+        metrics.incr("outbound.sent_chunks")
+    metrics.observe("outbound.send_seconds", time.time() - started)
+
+    with _lock:
+        if _finish_if_idle(recipient_id):
+            return
+    _scheduler.schedule(recipient_id, actions.typing_delay(), recipient_id)
+
+_pool = dispatcher.Dispatcher("outbound", _send_next, workers=OUTBOUND_WORKERS)
+_scheduler = scheduler.Scheduler("outbound", _pool)
@@ -0,0 +1,50 @@
+import os
+from collections import namedtuple
+from dotenv import load_dotenv
+
+import database
+import metrics
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+OWNER_CONFIG_TTL = int(os.getenv("OWNER_CONFIG_TTL", 60)) # seconds an owner's settings are used without asking Mongo
+OWNER_CONFIG_MAX_ENTRIES = 1000 # owners whose settings are cached
+# ---------------------
+
+# The per-owner settings every batch needs, read from the owner's `data` document in one query
+OwnerConfig = namedtuple("OwnerConfig", ["instruction", "dataset", "active"])
+
+# owner_id -> OwnerConfig. The dashboard routes that change a setting invalidate the local
+# entry immediately; other worker processes pick the change up within OWNER_CONFIG_TTL.
+_configs = TTLCache(OWNER_CONFIG_TTL, OWNER_CONFIG_MAX_ENTRIES)
+
+metrics.register_gauge("owner_config.cached", lambda: len(_configs))
+
+def _key(owner_id):
+    return str(owner_id)
+
+def from_document(document):
+    document = document or {}
+    return OwnerConfig(document.get("instruction"), document.get("dataset"), document.get("active", True))
+
+def cached(owner_id):
+    """The cached settings of an owner, or None on a miss."""
+    config = _configs.get(_key(owner_id))
+    metrics.incr("owner_config.hits" if config is not None else "owner_config.misses")
+    return config
+
+def remember(owner_id, config):
+    _configs.set(_key(owner_id), config)
+    return config
+
+def get(owner_id):
+    """An owner's settings, reading Mongo only on a cache miss."""
+    config = cached(owner_id)
+    if config is None:
+        config = remember(owner_id, from_document(database.get_owner_config(owner_id)))
+    return config
+
+def invalidate(owner_id):
+    _configs.pop(_key(owner_id))
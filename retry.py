@@ -0,0 +1,264 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from dotenv import load_dotenv
+
+import anthropic
+
+import metrics
+from cancellation import Cancelled
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 4)) # tries per model call, including the first
+RETRY_BASE_DELAY = 1.0 # seconds; backoff is a random wait up to base * 2^attempt ("full jitter")
+RETRY_MAX_DELAY = 30.0 # seconds; cap of one backoff
+RETRY_INLINE_MAX = float(os.getenv("RETRY_INLINE_MAX", 5)) # longer waits hand the batch back to the scheduler instead of sleeping on a worker thread
+LLM_RPM = int(os.getenv("LLM_RPM", 0)) # requests per minute this process may send (0 = no limit)
+LLM_TPM = int(os.getenv("LLM_TPM", 0)) # input tokens per minute this process may send (0 = no limit)
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", 5)) # consecutive upstream failures that open the circuit
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", 30)) # seconds the circuit stays open before one probe call
+# ---------------------
+
+class RetryLater(Exception):
+    """
+    The call cannot be made for `delay` seconds (rate limit, open circuit or a long
+    backoff). Batch processing catches it and re-arms the batch after the delay, so no
+    worker thread sleeps through it; other callers treat it as a failure.
+    """
+
+    def __init__(self, delay, reason):
+        super().__init__(f"{reason}; retry in {delay:.1f}s")
+        self.delay = delay
+        self.reason = reason
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, up to a minute's worth. Thread-safe."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self._rate = per_minute / 60.0
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        """Takes `amount` units if available and returns 0, else returns the seconds until they will be."""
+        amount = min(amount, self.capacity) # A single request larger than the bucket must still pass eventually
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0
+            return (amount - self._tokens) / self._rate
+
+    def refund(self, amount):
+        """Gives back units taken for a call that was not made after all."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive upstream failures; while open every call is
+    refused for `cooldown` seconds. Then a single probe call is let through (half-open):
+    its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, name, failures, cooldown):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._probing else "open"
+
+    def wait_time(self):
+        """0 if a call may be made now (possibly as the probe), else seconds until one may."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if self._probing:
+                return 1.0 # Wait for the probe's outcome
+            self._probing = True
+            return 0
+
+    def abandon(self):
+        """Gives the probe slot back when the probe call was never made or was cancelled."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"Circuit '{self.name}' closed.")
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or (self._opened_at is None and self._consecutive >= self.failures):
+                print(f"Circuit '{self.name}' opened after {self._consecutive} consecutive failures.")
+                metrics.incr(f"circuit.{self.name}.opened")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+# Shared by every model call of this process
+breaker = CircuitBreaker("llm", CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+_requests = TokenBucket(LLM_RPM) if LLM_RPM else None
+_tokens = TokenBucket(LLM_TPM) if LLM_TPM else None
+_hold_lock = threading.Lock()
+_hold_until = 0 # monotonic time before which no call is made (set from a 429's retry-after)
+
+metrics.register_gauge("circuit.llm.open", lambda: 0 if breaker.state == "closed" else 1)
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass # An HTTP date; fall back to the backoff
+    return None
+
+def classify(error):
+    """
+    Returns (retryable, degraded, retry_after). `degraded` means the upstream itself is
+    failing (5xx, 529 overloaded, connection errors, timeouts) and counts against the
+    circuit; 429 is our own rate limit and does not.
+    """
+    if isinstance(error, Cancelled):
+        return False, False, None
+    if isinstance(error, anthropic.RateLimitError):
+        return True, False, _retry_after(error)
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+        return True, True, None
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code >= 500:
+            return True, True, _retry_after(error)
+        return error.status_code == 409, False, None # 409 is a retryable conflict; other 4xx are our fault
+    return False, False, None
+
+def backoff(attempt, retry_after=None):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        # Jitter on top of retry-after so the callers it was sent to do not return together
+        delay = retry_after + random.uniform(0, RETRY_BASE_DELAY)
+    return delay
+
+def _hold(seconds):
+    global _hold_until
+    with _hold_lock:
+        _hold_until = max(_hold_until, time.monotonic() + seconds)
+
+def admit(tokens):
+    """0 if a call estimated at `tokens` input tokens may be made now (and takes its budget), else the wait in seconds."""
+    wait = _hold_until - time.monotonic()
+    if wait > 0:
+        return wait
+    wait = breaker.wait_time()
+    if wait:
+        return wait
+    if _requests is not None:
+        wait = _requests.take(1)
+    if not wait and _tokens is not None:
+        wait = _tokens.take(tokens)
+        if wait and _requests is not None:
+            _requests.refund(1) # Not making the call: its request is not spent either
+    if wait:
+        breaker.abandon() # In case this call was to be the probe
+    return wait
+
+def _after_failure(error, attempt):
+    """Records a failed attempt. Returns the delay before the next one, or raises if there is none."""
+    retryable, degraded, retry_after = classify(error)
+    if isinstance(error, Cancelled):
+        breaker.abandon()
+    elif degraded:
+        breaker.failure()
+    else:
+        breaker.success() # The upstream answered (a 4xx is about the request, not its health)
+    if not retryable or attempt + 1 >= LLM_MAX_ATTEMPTS:
+        raise error
+    if retry_after is not None:
+        _hold(retry_after) # Every call of the process waits, not only this one
+    delay = backoff(attempt, retry_after)
+    metrics.incr("llm.retries")
+    print(f"Attempt {attempt + 1} failed with error during Anthropic API call: {error}. Retrying in {delay:.1f}s.")
+    return delay
+
+def call(fn, tokens=0, cancel_token=None):
+    """
+    Runs fn() (one model call) with rate limiting, the circuit breaker and jittered
+    backoff. Waits up to RETRY_INLINE_MAX are slept here; longer ones raise RetryLater.
+    """
+    attempt = 0
+    while True:
+        wait = admit(tokens)
+        if wait:
+            if wait > RETRY_INLINE_MAX:
+                metrics.incr("llm.retry_later")
+                raise RetryLater(wait, f"circuit {breaker.state}" if breaker.state != "closed" else "rate limited")
+            metrics.observe("llm.throttle_seconds", wait)
+            _sleep(wait, cancel_token)
+            continue
+        try:
+            result = fn()
+        except Exception as e:
+            delay = _after_failure(e, attempt)
+            if delay > RETRY_INLINE_MAX:
+                metrics.incr("llm.retry_later")
+                raise RetryLater(delay, f"{type(e).__name__} from the model API") from e
+            _sleep(delay, cancel_token)
+            attempt += 1
+            continue
+        breaker.success()
+        return result
+
+async def acall(fn, tokens=0, cancel_token=None):
+    """call() for coroutines. Waiting costs no thread here, so only an open circuit raises RetryLater."""
+    attempt = 0
+    while True:
+        wait = admit(tokens)
+        if wait:
+            if breaker.state != "closed" and wait > RETRY_INLINE_MAX:
+                metrics.incr("llm.retry_later")
+                raise RetryLater(wait, f"circuit {breaker.state}")
+            metrics.observe("llm.throttle_seconds", wait)
+            await asyncio.sleep(wait)
+            continue
+        try:
+            result = await fn()
+        except Exception as e:
+            await asyncio.sleep(_after_failure(e, attempt))
+            attempt += 1
+            continue
+        breaker.success()
+        return result
+
+def _sleep(seconds, cancel_token):
+    if cancel_token is None:
+        time.sleep(seconds)
+    else:
+        cancel_token.sleep(seconds)
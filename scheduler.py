@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+
+import metrics
+
+# --- Configuration ---
+RETRY_DELAY = 1.0 # seconds before a deadline rejected by a full worker pool is tried again
+# ---------------------
+
+class Scheduler:
+    """
+    A single thread that owns every keyed deadline of one kind, e.g. the debounce
+    timer of each sender, instead of one threading.Timer (and OS thread) per key.
+
+    Deadlines live in a heap. Resetting or cancelling a key only replaces its entry in
+    `_deadlines`; the stale heap entry is skipped when it surfaces (lazy deletion) and the
+    heap is rebuilt when stale entries dominate. A due key is handed to `pool` (a
+    Dispatcher) so handler code never runs on the scheduler thread.
+    """
+
+    def __init__(self, name, pool, retry_delay=RETRY_DELAY):
+        self.name = name
+        self.pool = pool
+        self.retry_delay = retry_delay
+        self._heap = [] # (deadline, seq, key)
+        self._deadlines = {} # key -> (deadline, seq, args)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._started_pid = None
+
+        metrics.register_gauge(f"scheduler.{name}.pending", self.pending)
+
+    def start(self):
+        """Starts the scheduler thread once per process (so it also exists after a fork)."""
+        if self._started_pid == os.getpid():
+            return
+        with self._cond:
+            if self._started_pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name=f"{self.name}-scheduler", daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def schedule(self, key, delay, *args):
+        """Arms (or resets) the deadline for key: pool.submit(*args) runs `delay` seconds from now."""
+        self.start()
+        deadline = time.monotonic() + delay
+        with self._cond:
+            seq = next(self._seq)
+            self._deadlines[key] = (deadline, seq, args)
+            heapq.heappush(self._heap, (deadline, seq, key))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._compact()
+            # Wake the thread only if this deadline is now the earliest one
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def advance(self, key, delay):
+        """Moves a pending deadline for key earlier (never later). Returns True if it moved."""
+        deadline = time.monotonic() + delay
+        with self._cond:
+            current = self._deadlines.get(key)
+            if current is None or current[0] <= deadline:
+                return False
+            seq = next(self._seq)
+            self._deadlines[key] = (deadline, seq, current[2])
+            heapq.heappush(self._heap, (deadline, seq, key))
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+            return True
+
+    def cancel(self, key):
+        """Drops the deadline for key. Returns True if one was pending."""
+        with self._cond:
+            return self._deadlines.pop(key, None) is not None
+
+    def pending(self):
+        with self._cond:
+            return len(self._deadlines)
+
+    def _compact(self):
+        self._heap = [(deadline, seq, key) for key, (deadline, seq, _) in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def _pop_due(self):
+        """Waits for the earliest live deadline and removes it. Returns (key, deadline, args)."""
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, seq, key = self._heap[0]
+                current = self._deadlines.get(key)
+                if current is None or current[1] != seq:
+                    heapq.heappop(self._heap) # Reset or cancelled since it was pushed
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                del self._deadlines[key]
+                return key, deadline, current[2]
+
+    def _run(self):
+        while True:
+            key, deadline, args = self._pop_due()
+            metrics.observe(f"scheduler.{self.name}.lateness_seconds", time.monotonic() - deadline)
+            try:
+                accepted = self.pool.submit(*args)
+            except Exception as e:
+                print(f"Error submitting due deadline {key} of scheduler '{self.name}': {e}\n{traceback.format_exc()}")
+                accepted = False
+            if accepted:
+                metrics.incr(f"scheduler.{self.name}.fired")
+            else:
+                # The pool is saturated; keep the deadline instead of losing the batch
+                metrics.incr(f"scheduler.{self.name}.deferred")
+                with self._cond:
+                    if key not in self._deadlines:
+                        seq = next(self._seq)
+                        self._deadlines[key] = (time.monotonic() + self.retry_delay, seq, args)
+                        heapq.heappush(self._heap, (self._deadlines[key][0], seq, key))
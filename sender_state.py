@@ -0,0 +1,80 @@
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+SENDER_STATE_TTL = int(os.getenv("SENDER_STATE_TTL", 3600)) # seconds an idle sender's state is kept
+SENDER_STATE_MAX = int(os.getenv("SENDER_STATE_MAX", 50000)) # cap on tracked senders (busy ones are never evicted)
+# ---------------------
+
+class SenderState:
+    """Batching state of one sender: ~100 bytes instead of an entry in several dicts."""
+    __slots__ = ("seq", "timer_armed", "processing", "last_seen")
+
+    def __init__(self):
+        self.seq = 0 # messages counted so far
+        self.timer_armed = False # a batch deadline is pending
+        self.processing = False # a batch is running
+        self.last_seen = 0.0
+
+    @property
+    def busy(self):
+        return self.timer_armed or self.processing
+
+class SenderRegistry:
+    """
+    Per-sender states in least-recently-used order. Idle senders are evicted after
+    `ttl` seconds, and the oldest idle ones beyond `max_entries`; a sender whose batch
+    is pending or running is never evicted, so its counter cannot be reset under it.
+    Eviction runs on every lookup, so expired senders go away even when no new ones
+    arrive; it stops at the first live entry, so a lookup stays cheap.
+    Not thread-safe: callers serialize access with their own lock.
+    """
+
+    def __init__(self, name, ttl=SENDER_STATE_TTL, max_entries=SENDER_STATE_MAX):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._states = OrderedDict()
+
+        metrics.register_gauge(f"{name}.tracked", lambda: len(self._states))
+        metrics.register_gauge(f"{name}.evictions", lambda: self.evictions)
+
+    def get(self, sender_id):
+        """Returns the sender's state without creating or refreshing it, or None."""
+        self._evict(time.monotonic(), keep=None)
+        return self._states.get(sender_id)
+
+    def obtain(self, sender_id):
+        """Returns the sender's state (creating it) and marks it as recently used."""
+        now = time.monotonic()
+        state = self._states.get(sender_id)
+        if state is None:
+            state = self._states[sender_id] = SenderState()
+        else:
+            self._states.move_to_end(sender_id)
+        state.last_seen = now
+        self._evict(now, keep=sender_id)
+        return state
+
+    def _evict(self, now, keep):
+        # Each entry is looked at most once per call; busy ones are moved out of the way
+        for _ in range(len(self._states)):
+            sender_id, state = next(iter(self._states.items()))
+            expired = now - state.last_seen > self.ttl
+            if not expired and len(self._states) <= self.max_entries:
+                break
+            if state.busy or sender_id == keep:
+                self._states.move_to_end(sender_id)
+                continue
+            del self._states[sender_id]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._states)
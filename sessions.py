@@ -0,0 +1,62 @@
+import os
+from dotenv import load_dotenv
+
+import database
+import metrics
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+SESSION_TTL = int(os.getenv("SESSION_TTL", 300)) # seconds a resolved cookie is trusted without asking Mongo
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000)) # hard cap on cached sessions
+# ---------------------
+
+# The fields of a creds document the authenticated routes use. Only these are cached (and
+# handed to the routes), so the password is never held in memory for the whole TTL.
+SESSION_FIELDS = ("_id", "username", "access_token")
+
+# cookie -> session (SESSION_FIELDS of the creds document). Logout and password changes
+# invalidate the local entries immediately; other worker processes drop theirs within SESSION_TTL.
+_sessions = TTLCache(SESSION_TTL, SESSION_MAX_ENTRIES)
+_index_ready = False
+
+metrics.register_gauge("sessions.cached", lambda: len(_sessions))
+
+def _ensure_index():
+    global _index_ready
+    if not _index_ready:
+        database.creds.create_index("cookie")
+        _index_ready = True
+
+def bearer_token(auth_header):
+    """Extracts the cookie from an 'Authorization: Bearer <cookie>' header, or None."""
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.split(' ')[1]
+
+def get(cookie):
+    """Returns the cached session for a cookie, or None on a miss."""
+    user = _sessions.get(cookie)
+    metrics.incr("sessions.hits" if user is not None else "sessions.misses")
+    return user
+
+def remember(cookie, user):
+    """Caches the session of a creds document (or None) and returns it."""
+    if user is None:
+        return None
+    session = {field: user.get(field) for field in SESSION_FIELDS}
+    _sessions.set(cookie, session)
+    return session
+
+def authenticate(cookie):
+    """Resolves a cookie to its session, reading Mongo only on a cache miss."""
+    user = get(cookie)
+    if user is None:
+        _ensure_index()
+        user = remember(cookie, database.auth().login(cookie=cookie))
+    return user
+
+def invalidate_user(user_id):
+    """Forgets every cached session of an account (after logout or a password change)."""
+    return _sessions.pop_where(lambda user: user["_id"] == user_id)
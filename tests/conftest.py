@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules live at the repository root and read their settings from the environment
+# at import time; these are the ones without a default.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("Temperature", "0.5")
+os.environ.setdefault("ModelName", "test-model")
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:1/?serverSelectionTimeoutMS=100")
@@ -0,0 +1,53 @@
+import pytest
+
+import actions
+
+REPLIES = [
+    "Hi! Our classic set is $120 and takes about two hours. Would you like to book?",
+    "Sure.\nWe have Monday at 10am, Tuesday at 2pm and Friday at 11am open.\nWhich works best?",
+    "Thank you so much! 😊 See you soon. ✨",
+    "You can book here: [our booking page](https://example.com/book) and pay the deposit with Zelle.",
+    "Ok. Yes. Great. The deposit is $30 and goes toward the total price of the service.",
+    "Our address is 12 Main St. Parking is behind the building! Text us at www.example.com if lost",
+    "no punctuation at all in this reply",
+    "",
+]
+
+
+def streamed(text, piece):
+    stream = actions.ChunkStream()
+    chunks = []
+    for start in range(0, len(text), piece):
+        chunks.extend(stream.feed(text[start:start + piece]))
+    return chunks + stream.flush()
+
+
+@pytest.mark.parametrize("text", REPLIES)
+@pytest.mark.parametrize("piece", [1, 2, 3, 7, 16, 1000])
+def test_chunk_stream_matches_prepare_chunks(text, piece):
+    assert streamed(text, piece) == actions.prepare_chunks(text)
+
+
+def test_short_chunks_are_combined():
+    assert actions.prepare_chunks("Ok. Sounds good, we will see you on Monday then.") == [
+        "Ok. Sounds good, we will see you on Monday then."
+    ]
+
+
+def test_markdown_links_become_text_and_url():
+    [chunk] = actions.prepare_chunks("Book at [our page](https://example.com/book)")
+    assert chunk == "Book at our page https://example.com/book"
+
+
+def test_feed_only_returns_final_chunks():
+    stream = actions.ChunkStream()
+    first = "This first sentence is long enough to be sent on its own. "
+    assert stream.feed(first + "The second one") == [first.strip()]
+    assert stream.flush() == ["The second one"]
+
+
+def test_discard_drops_unsent_text():
+    stream = actions.ChunkStream()
+    stream.feed("A partial sentence that was never fin")
+    stream.discard()
+    assert stream.flush() == []
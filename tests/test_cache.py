@@ -0,0 +1,70 @@
+from cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def cache_with_clock(monkeypatch, ttl=10, max_entries=100):
+    clock = Clock()
+    monkeypatch.setattr("cache.time.monotonic", clock)
+    return TTLCache(ttl, max_entries), clock
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    cache, clock = cache_with_clock(monkeypatch)
+    cache.set("a", 1)
+    clock.now += 9.9
+    assert cache.get("a") == 1
+    clock.now += 0.2
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert len(cache) == 0
+
+
+def test_set_renews_expiry(monkeypatch):
+    cache, clock = cache_with_clock(monkeypatch)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    clock.now += 5
+    cache.set("a", 3)
+    clock.now += 6
+    assert cache.get("a") == 3
+    assert cache.get("b") is None
+
+
+def test_max_entries_evicts_oldest(monkeypatch):
+    cache, _ = cache_with_clock(monkeypatch, max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.get("a") is None
+    assert (cache.get("b"), cache.get("c")) == (2, 3)
+    assert cache.evictions == 1
+
+
+def test_add_only_when_absent(monkeypatch):
+    cache, clock = cache_with_clock(monkeypatch)
+    assert cache.add("mid")
+    assert not cache.add("mid")
+    clock.now += 11
+    assert cache.add("mid") # Expired, so it is new again
+
+
+def test_pop_and_invalidation(monkeypatch):
+    cache, _ = cache_with_clock(monkeypatch)
+    cache.set(("o1", "x"), {"_id": "o1"})
+    cache.set(("o2", "x"), {"_id": "o2"})
+    cache.set(("o1", "y"), {"_id": "o1"})
+    assert cache.pop(("o2", "x")) == {"_id": "o2"}
+    assert cache.pop(("o2", "x")) is None
+    assert cache.pop_where(lambda value: value["_id"] == "o1") == 2
+    assert len(cache) == 0
+    cache.set(("o1", "z"), 1)
+    cache.set(("o3", "z"), 1)
+    assert cache.pop_keys_where(lambda key: key[0] == "o1") == 1
+    assert ("o3", "z") in cache
@@ -0,0 +1,91 @@
+import pytest
+
+import context
+import database
+
+
+def customer(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def assistant(text):
+    return {"role": "assistant", "content": [{"type": "text", "text": text}]}
+
+
+def tool_result():
+    return {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "ok"}]}
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """The summary fit() finds in the database, and the ones it stores."""
+    state = {"summary": None, "upto": 0, "saved": []}
+    monkeypatch.setattr(database, "get_summary", lambda _id, owner_id: (state["summary"], state["upto"]))
+    monkeypatch.setattr(database, "set_summary", lambda _id, owner_id, summary, upto: state["saved"].append((summary, upto)))
+    return state
+
+
+def no_summarize(previous, transcript):
+    raise AssertionError("summarize should not be called")
+
+
+def test_summary_leads_first_kept_message(stored):
+    conversation = [customer("hi"), assistant("hello"), customer("price?"), assistant("$50")]
+    stored["summary"], stored["upto"] = "Asked about brows.", 2
+    messages = context.fit("u", "o", conversation, no_summarize)
+    assert len(messages) == 2
+    assert messages[0]["content"][0]["text"] == f"{context.SUMMARY_HEADER}\nAsked about brows."
+    assert messages[0]["content"][1:] == conversation[2]["content"]
+    assert messages[1] == conversation[3]
+
+
+@pytest.mark.parametrize("upto", [4, 5])
+def test_summary_at_or_past_the_end_is_ignored(stored, upto):
+    # e.g. after set_conversation or a truncation left fewer messages than the summary covers
+    conversation = [customer("hi"), assistant("hello"), customer("price?"), assistant("$50")]
+    stored["summary"], stored["upto"] = "Stale.", upto
+    assert context.fit("u", "o", conversation, no_summarize) == conversation
+
+
+def test_summary_not_at_a_customer_turn_is_ignored(stored):
+    conversation = [customer("book"), assistant("ok"), tool_result(), assistant("done")]
+    stored["summary"], stored["upto"] = "Stale.", 2
+    assert context.fit("u", "o", conversation, no_summarize) == conversation
+
+
+def test_empty_conversation(stored):
+    stored["summary"], stored["upto"] = "Stale.", 0
+    assert context.fit("u", "o", [], no_summarize) == []
+
+
+def test_folds_old_turns_past_the_budget(stored, monkeypatch):
+    monkeypatch.setattr(context, "CONTEXT_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(context, "CONTEXT_KEEP_TOKENS", 40)
+    monkeypatch.setattr(context, "CONTEXT_MIN_TURNS", 1)
+    conversation = []
+    for turn in range(6):
+        conversation += [customer(f"question {turn} " + "x" * 80), assistant("answer " + "y" * 80)]
+    transcripts = []
+
+    def summarize(previous, transcript):
+        transcripts.append((previous, transcript))
+        return "Summary."
+
+    messages = context.fit("u", "o", conversation, summarize)
+    [(summary, cut)] = stored["saved"]
+    assert summary == "Summary."
+    assert context.is_customer_turn(conversation[cut])
+    assert transcripts[0][0] is None and "question 0" in transcripts[0][1]
+    assert len(messages) == len(conversation) - cut
+    assert context.estimate_tokens(conversation[cut:]) <= context.CONTEXT_TOKEN_BUDGET
+
+
+def test_summarize_error_sends_full_history(stored, monkeypatch):
+    monkeypatch.setattr(context, "CONTEXT_TOKEN_BUDGET", 10)
+
+    def summarize(previous, transcript):
+        raise RuntimeError("model down")
+
+    conversation = [customer("a" * 100), assistant("b" * 100)] * 6
+    assert context.fit("u", "o", conversation, summarize) == conversation
+    assert stored["saved"] == []
@@ -0,0 +1,82 @@
+import json
+import os
+
+import pytest
+
+import faq
+
+INFO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "info.json")
+
+
+@pytest.fixture(scope="module")
+def index():
+    with open(INFO_PATH) as f:
+        return faq.build_index(json.load(f))
+
+
+def customer(text):
+    return {"role": "user", "content": [{"type": "text", "text": text}]}
+
+
+def confident(index, text):
+    """The key of the entry answer() would use for text, or None if it defers to the model."""
+    entry, score, runner_up = index.match(text)
+    if entry is None or score < faq.FAQ_MIN_SCORE or score - runner_up < faq.FAQ_MIN_MARGIN:
+        return None
+    return entry.key
+
+
+@pytest.mark.parametrize("text, key", [
+    ("How much are nano brows?", "services:NANO BROWS BY TONY"),
+    ("what's your address", "contact:address"),
+    ("Where are you located?", "contact:address"),
+    ("what is your phone number", "contact:phone"),
+    ("What payment methods do you accept?", "payment_informations"),
+    ("what's your cancellation policy", "policy:cancellation_rescheduling"),
+])
+def test_faq_questions_match_one_entry(index, text, key):
+    assert confident(index, text) == key
+
+
+@pytest.mark.parametrize("text", [
+    "Is nano brows painful?", # A service, but not its price
+    "Can I come friday at 3pm?",
+    "I sent the deposit, can you confirm my appointment",
+    "hi",
+])
+def test_other_messages_go_to_the_model(index, text):
+    assert confident(index, text) is None
+
+
+def test_price_entries_require_a_price_word(index):
+    entry, score, _ = index.match("nano brows")
+    assert entry is None or not entry.key.startswith("services:")
+
+
+def test_tokenize_strips_stopwords_plurals_and_accents():
+    assert faq.tokenize("What are the prices for Ombré Brows?") == ["price", "ombre", "brow"]
+
+
+def test_pending_text_is_the_batch_after_the_last_reply():
+    conversation = [customer("hi"), {"role": "assistant", "content": "hello"}, customer("what's your"), customer("address?")]
+    assert faq.pending_text(conversation) == "what's your address?"
+
+
+def test_pending_text_with_an_image_defers_to_the_model():
+    image = {"role": "user", "content": [{"type": "image", "source": {}}, {"type": "text", "text": "price?"}]}
+    assert faq.pending_text([image]) is None
+
+
+def test_answer_replies_only_above_the_thresholds(index, monkeypatch):
+    monkeypatch.setattr(faq, "index_for", lambda owner_id: index)
+    reply = faq.answer("owner", "sender", [customer("What's your phone number?")])
+    assert reply == {"role": "assistant", "content": [{"type": "text", "text": "You can reach us at +17278880088."}]}
+
+    monkeypatch.setattr(faq, "FAQ_MIN_SCORE", 1.01)
+    assert faq.answer("owner", "sender", [customer("What's your phone number?")]) is None
+
+
+def test_answer_skips_long_messages(index, monkeypatch):
+    monkeypatch.setattr(faq, "index_for", lambda owner_id: index)
+    text = "what is your phone number " + "and also " * faq.FAQ_MAX_WORDS
+    assert faq.answer("owner", "sender", [customer(text)]) is None
@@ -0,0 +1,83 @@
+import pytest
+
+import ingest_log
+
+
+@pytest.fixture(autouse=True)
+def log(tmp_path, monkeypatch):
+    """A fresh log file; connections are per thread, so the cached one is dropped too."""
+    monkeypatch.setattr(ingest_log, "INGEST_LOG_PATH", str(tmp_path / "ingest_log.db"))
+    monkeypatch.setattr(ingest_log._local, "conn", None, raising=False)
+    yield
+    ingest_log._local.conn = None
+
+
+def test_claim_returns_body_once():
+    entry_id = ingest_log.append(b'{"entry": []}')
+    assert ingest_log.claim(entry_id) == b'{"entry": []}'
+    assert ingest_log.claim(entry_id) is None # Claimed by us, not abandoned yet
+
+
+def test_completed_entries_are_not_replayed():
+    entry_id = ingest_log.append(b"{}")
+    ingest_log.claim(entry_id)
+    ingest_log.complete(entry_id)
+    assert ingest_log.unfinished() == []
+    assert ingest_log.claim(entry_id) is None
+
+
+def test_unclaimed_and_released_entries_are_replayed():
+    first = ingest_log.append(b"1")
+    second = ingest_log.append(b"2")
+    ingest_log.claim(second)
+    assert ingest_log.unfinished() == [first]
+    ingest_log.release(second)
+    assert ingest_log.unfinished() == [first, second]
+
+
+def test_abandoned_claims_are_replayed(monkeypatch):
+    entry_id = ingest_log.append(b"{}")
+    ingest_log.claim(entry_id)
+    monkeypatch.setattr(ingest_log, "CLAIM_TIMEOUT", -1)
+    assert ingest_log.unfinished() == [entry_id]
+    assert ingest_log.claim(entry_id) == b"{}"
+
+
+def test_replay_waits_for_older_than():
+    ingest_log.append(b"{}")
+    assert ingest_log.unfinished(older_than=60) == []
+
+
+def test_entries_fail_after_max_attempts():
+    entry_id = ingest_log.append(b"poison")
+    for _ in range(ingest_log.MAX_ATTEMPTS):
+        assert ingest_log.claim(entry_id) == b"poison"
+        ingest_log.release(entry_id)
+    assert ingest_log.unfinished() == []
+    assert ingest_log.failed_count() == 1
+
+
+def test_compact_drops_old_done_and_failed_entries(monkeypatch):
+    done = ingest_log.append(b"done")
+    ingest_log.claim(done)
+    ingest_log.complete(done)
+    failed = ingest_log.append(b"failed")
+    for _ in range(ingest_log.MAX_ATTEMPTS):
+        ingest_log.claim(failed)
+        ingest_log.release(failed)
+    pending = ingest_log.append(b"pending")
+
+    assert ingest_log.compact() == 0 # All inside their retention windows
+    monkeypatch.setattr(ingest_log, "RETENTION_SECONDS", -1)
+    assert ingest_log.compact() == 1
+    monkeypatch.setattr(ingest_log, "FAILED_RETENTION_SECONDS", -1)
+    assert ingest_log.compact() == 1
+    assert ingest_log.stats()["entries"] == {"pending": 1}
+    assert ingest_log.unfinished() == [pending]
+
+
+def test_pending_batches_survive_until_settled():
+    ingest_log.remember_batch("sender", "owner")
+    ingest_log.forget_batch("sender", "owner", before=0) # A newer message was recorded after `before`
+    assert ingest_log.take_pending_batches() == [("sender", "owner")]
+    assert ingest_log.take_pending_batches() == []
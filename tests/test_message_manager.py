@@ -0,0 +1,56 @@
+import pytest
+
+import database
+import dedup
+import message_manager
+
+
+def delivery(*senders):
+    """A webhook body with one text message from each sender to owner 'owner'."""
+    return {"entry": [{"id": "owner", "messaging": [
+        {"sender": {"id": sender}, "recipient": {"id": "owner"}, "message": {"mid": f"mid-{sender}", "text": "hi"}}
+        for sender in senders
+    ]}]}
+
+
+@pytest.fixture
+def saves(monkeypatch):
+    """Saves per sender; senders listed in `failing` fail to save. Scheduling is left out."""
+    state = {"saved": [], "failing": set()}
+
+    def append_messages(_id, messages, owner_id):
+        if _id in state["failing"]:
+            return False
+        state["saved"].append(_id)
+        return True
+
+    monkeypatch.setattr(database, "append_messages", append_messages)
+    monkeypatch.setattr(message_manager, "_record_user_messages",
+                        lambda sender, owner_id, batch: message_manager._save_batch(sender, owner_id, batch))
+    monkeypatch.setattr(dedup, "DEDUP_STORE", "memory")
+    for sender in ("a", "b", "c"):
+        dedup.forget(f"mid-{sender}")
+    return state
+
+
+def test_replay_after_a_failed_group_saves_the_rest(saves):
+    saves["failing"] = {"b"}
+    with pytest.raises(RuntimeError):
+        message_manager.process_messages(delivery("a", "b", "c"))
+
+    saves["failing"] = set()
+    message_manager.process_messages(delivery("a", "b", "c")) # The ingestion log's replay
+    assert sorted(saves["saved"]) == ["a", "b", "c"] # 'a' once: it was saved the first time
+
+
+def test_redelivery_of_saved_messages_is_dropped(saves):
+    message_manager.process_messages(delivery("a"))
+    message_manager.process_messages(delivery("a"))
+    assert saves["saved"] == ["a"]
+
+
+def test_a_failing_group_does_not_hold_up_the_others(saves):
+    saves["failing"] = {"a"}
+    with pytest.raises(RuntimeError):
+        message_manager.process_messages(delivery("a", "b", "c"))
+    assert saves["saved"] == ["b", "c"]
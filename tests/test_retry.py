@@ -0,0 +1,128 @@
+import pytest
+
+import retry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("retry.time.monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def budgets(monkeypatch, clock):
+    """Installs fresh RPM/TPM buckets and breaker; returns a function that sets the limits."""
+    monkeypatch.setattr(retry, "_hold_until", 0)
+    monkeypatch.setattr(retry, "breaker", retry.CircuitBreaker("test", failures=2, cooldown=10))
+
+    def install(rpm, tpm):
+        monkeypatch.setattr(retry, "_requests", retry.TokenBucket(rpm) if rpm else None)
+        monkeypatch.setattr(retry, "_tokens", retry.TokenBucket(tpm) if tpm else None)
+    return install
+
+
+def test_token_bucket_refills_at_its_rate(clock):
+    bucket = retry.TokenBucket(60) # one per second
+    assert bucket.take(60) == 0
+    assert bucket.take(1) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.take(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.take(1) == 0
+
+
+def test_token_bucket_lets_oversized_requests_through(clock):
+    bucket = retry.TokenBucket(10)
+    assert bucket.take(50) == 0 # Capped at the capacity
+    assert bucket.take(1) > 0
+
+
+def test_token_bucket_refund_is_capped(clock):
+    bucket = retry.TokenBucket(10)
+    bucket.refund(5)
+    assert bucket.take(10) == 0
+    assert bucket.take(1) > 0
+
+
+def test_admit_takes_from_both_buckets(budgets):
+    budgets(rpm=2, tpm=1000)
+    assert retry.admit(400) == 0
+    assert retry._requests._tokens == pytest.approx(1)
+    assert retry._tokens._tokens == pytest.approx(600)
+
+
+def test_admit_refunds_the_request_when_tokens_refuse(budgets):
+    budgets(rpm=2, tpm=1000)
+    assert retry.admit(900) == 0
+    assert retry.admit(900) > 0
+    assert retry._requests._tokens == pytest.approx(1) # Only the admitted call was counted
+    assert retry.admit(50) == 0
+
+
+def test_admit_waits_for_a_rate_limit_hold(budgets, clock):
+    budgets(rpm=0, tpm=0)
+    retry._hold(5)
+    assert retry.admit(1) == pytest.approx(5)
+    clock.now += 5
+    assert retry.admit(1) == 0
+
+
+def test_circuit_opens_and_lets_one_probe_through(budgets, clock):
+    budgets(rpm=0, tpm=0)
+    retry.breaker.failure()
+    assert retry.admit(1) == 0
+    retry.breaker.failure()
+    assert retry.breaker.state == "open"
+    assert retry.admit(1) == pytest.approx(10)
+    clock.now += 10
+    assert retry.admit(1) == 0 # The probe
+    assert retry.breaker.state == "half-open"
+    assert retry.admit(1) > 0 # Everyone else waits for its outcome
+    retry.breaker.success()
+    assert retry.admit(1) == 0
+
+
+def test_refused_probe_gives_its_slot_back(budgets, clock):
+    budgets(rpm=1, tpm=0)
+    retry.breaker.failure()
+    retry.breaker.failure()
+    clock.now += 10
+    assert retry.admit(1) == 0 # Probe admitted; the RPM bucket is now empty
+    retry.breaker.abandon()
+    assert retry.admit(1) > 0 # Refused by the RPM bucket...
+    assert retry.breaker.state == "open" # ...so it did not keep the probe slot
+
+
+def test_call_retries_then_raises_fatal_errors(budgets, monkeypatch):
+    budgets(rpm=0, tpm=0)
+    monkeypatch.setattr(retry, "_sleep", lambda seconds, cancel_token: None)
+    attempts = []
+
+    class Overloaded(Exception):
+        pass
+
+    monkeypatch.setattr(retry, "classify", lambda error: (isinstance(error, Overloaded), True, None))
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise Overloaded()
+        return "ok"
+
+    assert retry.call(flaky) == "ok"
+    assert len(attempts) == 2
+
+    def fatal():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        retry.call(fatal)
@@ -0,0 +1,44 @@
+from sender_state import SenderRegistry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def registry_with_clock(monkeypatch, ttl=10, max_entries=100):
+    clock = Clock()
+    monkeypatch.setattr("sender_state.time.monotonic", clock)
+    return SenderRegistry("test_senders", ttl=ttl, max_entries=max_entries), clock
+
+
+def test_idle_senders_expire_on_touch_of_a_known_sender(monkeypatch):
+    registry, clock = registry_with_clock(monkeypatch)
+    registry.obtain("a")
+    registry.obtain("b")
+    clock.now += 11
+    registry.obtain("b")
+    assert registry.get("a") is None
+    assert len(registry) == 1
+    assert registry.evictions == 1
+
+
+def test_idle_senders_expire_on_get(monkeypatch):
+    registry, clock = registry_with_clock(monkeypatch)
+    registry.obtain("a")
+    clock.now += 11
+    assert registry.get("b") is None
+    assert len(registry) == 0
+
+
+def test_busy_senders_are_never_evicted(monkeypatch):
+    registry, clock = registry_with_clock(monkeypatch, max_entries=1)
+    registry.obtain("a").processing = True
+    registry.obtain("b")
+    clock.now += 11
+    registry.obtain("c")
+    assert registry.get("a") is not None
+    assert registry.get("b") is None
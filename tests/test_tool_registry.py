@@ -0,0 +1,153 @@
+import threading
+import time
+
+import pytest
+
+import tool_registry
+from cancellation import CancellationToken
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "date": {"type": "string"},
+        "count": {"type": "integer"},
+        "price": {"type": "number"},
+        "service": {"type": "string", "enum": ["brows", "lashes"]},
+    },
+    "required": ["date"],
+}
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(tool_registry, "_tools", {})
+    monkeypatch.setattr(tool_registry, "_caches", {})
+
+
+def echo(args, user_id, owner_id):
+    return ",".join(f"{key}={args[key]!r}" for key in sorted(args))
+
+
+def test_schemas_in_registration_order():
+    tool_registry.register("b", "second", SCHEMA, echo)
+    tool_registry.register("a", "first", SCHEMA, echo)
+    assert [schema["name"] for schema in tool_registry.schemas()] == ["b", "a"]
+
+
+def test_only_read_only_tools_may_time_out():
+    with pytest.raises(ValueError):
+        tool_registry.register("book", "", SCHEMA, echo, timeout=5)
+
+
+@pytest.mark.parametrize("args, error", [
+    ({}, "missing required argument(s): date"),
+    ({"date": None}, "missing required argument(s): date"),
+    ({"date": 5}, "argument 'date' must be of type string"),
+    ({"date": "today", "count": "two"}, "argument 'count' must be of type integer"),
+    ({"date": "today", "price": True}, "argument 'price' must be of type number"),
+    ({"date": "today", "service": "nails"}, "argument 'service' must be one of ['brows', 'lashes']"),
+    ("today", "arguments must be an object"),
+])
+def test_invalid_arguments_are_error_results(args, error):
+    tool_registry.register("tool", "", SCHEMA, echo)
+    assert tool_registry.dispatch("tool", args, "u", "o") == (f"error: {error}", True)
+
+
+def test_numbers_sent_as_strings_are_coerced():
+    tool_registry.register("tool", "", SCHEMA, echo)
+    content, is_error = tool_registry.dispatch("tool", {"date": "today", "count": "2", "price": "49.5"}, "u", "o")
+    assert (content, is_error) == ("count=2,date='today',price=49.5", False)
+
+
+def test_unknown_tool_and_tool_errors():
+    def fails(args, user_id, owner_id):
+        raise tool_registry.ToolError("no such appointment")
+
+    tool_registry.register("tool", "", SCHEMA, fails)
+    assert tool_registry.dispatch("missing", {}, "u", "o") == ("unknown tool: missing", True)
+    assert tool_registry.dispatch("tool", {"date": "x"}, "u", "o") == ("error: no such appointment", True)
+
+
+def test_slow_read_only_tool_times_out():
+    release = threading.Event()
+    tool_registry.register("slow", "", SCHEMA, lambda *_: release.wait(5), read_only=True, timeout=0.05)
+    try:
+        assert tool_registry.dispatch("slow", {"date": "x"}, "u", "o") == ("error: slow timed out, try again later", True)
+    finally:
+        release.set()
+
+
+def test_cached_results_per_owner_until_invalidated():
+    calls = []
+
+    def count(args, user_id, owner_id):
+        calls.append(owner_id)
+        return f"{owner_id}:{len(calls)}"
+
+    tool_registry.register("examples", "", SCHEMA, count, read_only=True,
+                           cache=tool_registry.CachePolicy(ttl=60, per_user=False))
+    assert tool_registry.dispatch("examples", {"date": "x"}, "u1", "o1") == ("o1:1", False)
+    assert tool_registry.dispatch("examples", {"date": "x"}, "u2", "o1") == ("o1:1", False)
+    assert tool_registry.dispatch("examples", {"date": "x"}, "u1", "o2") == ("o2:2", False)
+    tool_registry.invalidate("o1")
+    assert tool_registry.dispatch("examples", {"date": "x"}, "u1", "o1") == ("o1:3", False)
+    assert tool_registry.dispatch("examples", {"date": "x"}, "u1", "o2") == ("o2:2", False)
+
+
+def register_read_write():
+    tool_registry.register("read", "", SCHEMA, echo, read_only=True)
+    tool_registry.register("write", "", SCHEMA, echo)
+
+
+def test_groups_keep_side_effecting_calls_alone():
+    register_read_write()
+    calls = ["read", "read", "write", "read", "unknown", "write", "write", "read", "read"]
+    groups = tool_registry._groups(calls, lambda name: name)
+    assert groups == [["read", "read"], ["write"], ["read"], ["unknown"], ["write"], ["write"], ["read", "read"]]
+
+
+def test_run_keeps_call_order_and_runs_reads_concurrently():
+    register_read_write()
+    both_running = threading.Barrier(2, timeout=2)
+    events = []
+
+    def execute(call):
+        name, index = call
+        if name == "read":
+            both_running.wait() # Deadlocks unless the two reads run at the same time
+        events.append(index)
+        return index
+
+    calls = [("write", 0), ("read", 1), ("read", 2), ("write", 3)]
+    assert tool_registry.run(calls, execute, lambda call: call[0]) == [0, 1, 2, 3]
+    assert events[0] == 0 and events[-1] == 3
+
+
+def test_run_skips_groups_after_cancellation():
+    register_read_write()
+    token = CancellationToken()
+    ran = []
+
+    def execute(call):
+        ran.append(call)
+        if call == "write":
+            token.cancel("newer message")
+        return call
+
+    results = tool_registry.run(["read", "write", "write", "read"], execute, lambda call: call,
+                                token, lambda call: f"skipped {call}")
+    assert results == ["read", "write", "skipped write", "skipped read"]
+    assert ran == ["read", "write"]
+
+
+def test_run_raises_the_first_error():
+    register_read_write()
+
+    def execute(call):
+        if call == "write":
+            raise RuntimeError("booking failed")
+        time.sleep(0.01)
+        return call
+
+    with pytest.raises(RuntimeError):
+        tool_registry.run(["read", "write", "read"], execute, lambda call: call)
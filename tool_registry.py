@@ -0,0 +1,185 @@
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dotenv import load_dotenv
+
+import metrics
+from cache import TTLCache
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+TOOL_WORKERS = int(os.getenv("TOOL_WORKERS", 8)) # read-only tool calls running at once in this process
+TOOL_CACHE_MAX_ENTRIES = 1000 # cached results kept per cached tool
+# ---------------------
+
+# One tool the model may call.
+# schema: the tool definition sent to the model (name, description, input_schema)
+# handler: handler(args, user_id, owner_id) -> text for the model; raises ToolError for an error result
+# read_only: no side effects another call of the same turn could observe, so it may run
+#   concurrently with other read-only calls
+# timeout: seconds before the model gets an error result instead (read-only tools only: a
+#   booking that is still running must not be reported as failed)
+# cache: a CachePolicy, or None to run the handler on every call
+Tool = namedtuple("Tool", ["name", "schema", "handler", "read_only", "timeout", "cache"])
+
+# ttl: seconds a result is reused for the same arguments
+# per_user: results differ per customer (keyed by customer and owner, otherwise by owner only)
+CachePolicy = namedtuple("CachePolicy", ["ttl", "per_user"])
+
+class ToolError(Exception):
+    """An error the model should see (and can correct), e.g. a missing argument."""
+
+_tools = {} # name -> Tool, in registration order
+_caches = {} # name -> TTLCache of results
+_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+# Handlers with a timeout run here, so waiting for one never occupies a slot of _pool it needs
+_timed_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool-timed")
+
+_TYPES = {
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+    "object": dict,
+    "array": list,
+}
+
+def register(name, description, input_schema, handler, read_only=False, timeout=None, cache=None):
+    if timeout is not None and not read_only:
+        raise ValueError(f"Tool {name}: only read-only tools may time out")
+    schema = {"name": name, "description": description, "input_schema": input_schema}
+    _tools[name] = Tool(name, schema, handler, read_only, timeout, cache)
+    if cache is not None:
+        _caches[name] = TTLCache(cache.ttl, TOOL_CACHE_MAX_ENTRIES)
+    return _tools[name]
+
+def schemas():
+    """The tool definitions for the model, in registration order."""
+    return [tool.schema for tool in _tools.values()]
+
+def is_read_only(name):
+    """Unknown tools are treated as side-effecting."""
+    tool = _tools.get(name)
+    return tool is not None and tool.read_only
+
+def _coerce(value, kind):
+    """A value of JSON schema type `kind`, accepting numbers sent as strings; raises ValueError."""
+    if kind in ("number", "integer") and isinstance(value, str):
+        try:
+            value = float(value) if kind == "number" else int(value)
+        except ValueError:
+            raise ValueError(f"must be of type {kind}") from None
+    expected = _TYPES.get(kind)
+    if expected is None:
+        return value
+    # bool is an int subclass but never a valid number
+    if not isinstance(value, expected) or (isinstance(value, bool) and kind != "boolean"):
+        raise ValueError(f"must be of type {kind}")
+    return value
+
+def validate(tool, args):
+    """
+    Checks the model's arguments against the tool's input_schema (required properties,
+    types and enums) and returns a copy to hand to the handler. Raises ToolError.
+    """
+    if not isinstance(args, dict):
+        raise ToolError("arguments must be an object")
+    schema = tool.schema["input_schema"]
+    properties = schema.get("properties", {})
+    missing = [key for key in schema.get("required", []) if args.get(key) is None]
+    if missing:
+        raise ToolError(f"missing required argument(s): {', '.join(missing)}")
+    validated = dict(args)
+    for key, value in args.items():
+        spec = properties.get(key)
+        if spec is None or value is None:
+            continue
+        try:
+            validated[key] = _coerce(value, spec.get("type"))
+        except ValueError as e:
+            raise ToolError(f"argument '{key}' {e}") from None
+        if "enum" in spec and validated[key] not in spec["enum"]:
+            raise ToolError(f"argument '{key}' must be one of {spec['enum']}")
+    return validated
+
+def _run_handler(tool, args, user_id, owner_id):
+    """The handler's text for the model (a handler that returns nothing gives an empty result)."""
+    if tool.timeout is None:
+        result = tool.handler(args, user_id, owner_id)
+    else:
+        future = _timed_pool.submit(tool.handler, args, user_id, owner_id)
+        try:
+            result = future.result(timeout=tool.timeout)
+        except FutureTimeout:
+            metrics.incr(f"tools.{tool.name}.timeouts")
+            raise ToolError(f"{tool.name} timed out, try again later") from None
+    return "" if result is None else str(result)
+
+def dispatch(name, args, user_id, owner_id):
+    """
+    Validates and runs one tool call. Returns (content, is_error): errors the model can act
+    on (unknown tool, bad arguments, ToolError, timeout) come back as error results.
+    """
+    tool = _tools.get(name)
+    if tool is None:
+        return f"unknown tool: {name}", True
+    try:
+        args = validate(tool, args)
+        cache = _caches.get(name)
+        if cache is None:
+            return _run_handler(tool, args, user_id, owner_id), False
+        key = (str(owner_id), str(user_id) if tool.cache.per_user else None, json.dumps(args, sort_keys=True, default=str))
+        content = cache.get(key)
+        if content is not None:
+            metrics.incr(f"tools.{name}.cache_hits")
+            return content, False
+        content = _run_handler(tool, args, user_id, owner_id)
+        cache.set(key, content)
+        return content, False
+    except ToolError as e:
+        metrics.incr(f"tools.{name}.errors")
+        return f"error: {e}", True
+
+def invalidate(owner_id):
+    """Drops the cached results of an owner (after their business data changed)."""
+    owner = str(owner_id)
+    for cache in _caches.values():
+        cache.pop_keys_where(lambda key: key[0] == owner)
+
+def _groups(calls, name_of):
+    """
+    Splits calls (in the model's order) into groups that run one after another: each run
+    of consecutive read-only calls is one group, each side-effecting call is a group of its
+    own. A read-only call after a booking therefore still sees the booking.
+    """
+    groups = []
+    for call in calls:
+        if groups and is_read_only(name_of(call)) and is_read_only(name_of(groups[-1][0])):
+            groups[-1].append(call)
+        else:
+            groups.append([call])
+    return groups
+
+def run(calls, execute, name_of, cancel_token=None, skip=None):
+    """
+    Runs execute(call) for every call and returns the results in the order of `calls`.
+    Read-only calls of a group run concurrently on the tool pool. The first error in call
+    order is raised; other calls of its group that already started still finish.
+    Once cancel_token fires, the groups that have not started are not run: their calls get
+    skip(call) instead, so the results of the groups that did run can still be saved.
+    """
+    results = []
+    for index, group in enumerate(_groups(calls, name_of)):
+        if index and cancel_token is not None and cancel_token.is_cancelled():
+            metrics.incr("tools.skipped_calls", len(calls) - len(results))
+            results.extend(skip(call) for call in calls[len(results):])
+            break
+        if len(group) == 1:
+            results.append(execute(group[0]))
+            continue
+        metrics.incr("tools.concurrent_calls", len(group))
+        futures = [_pool.submit(execute, call) for call in group]
+        results.extend(future.result() for future in futures)
+    return results
@@ -0,0 +1,146 @@
+import datetime
+import os
+import time
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv(override=True)
+
+# --- Configuration ---
+USAGE_ACCOUNTING = os.getenv("USAGE_ACCOUNTING", "true").lower() == "true" # roll turn usage up in Mongo
+LLM_INPUT_PRICE = float(os.getenv("LLM_INPUT_PRICE", 3.0)) # USD per million input tokens
+LLM_OUTPUT_PRICE = float(os.getenv("LLM_OUTPUT_PRICE", 15.0)) # USD per million output tokens
+USAGE_SAMPLES = 2000 # per-turn latency and cost samples kept per owner per day for percentiles
+USAGE_TOP_SENDERS = 10 # customers listed by cost in a usage report
+USAGE_MAX_DAYS = 90 # longest period a usage report may cover
+# ---------------------
+
+# Multipliers of the input price for cached input (Anthropic pricing, 5 minute cache)
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+DAILY = "usage_daily" # one document per owner per day: totals and per-turn samples
+SENDERS = "usage_senders" # one document per owner, customer and day: totals only
+
+def cost(tokens, input_price=None, output_price=None):
+    """USD cost of a dict of TOKEN_FIELDS counts."""
+    input_price = LLM_INPUT_PRICE if input_price is None else input_price
+    output_price = LLM_OUTPUT_PRICE if output_price is None else output_price
+    return (
+        tokens["input_tokens"] * input_price
+        + tokens["cache_write_tokens"] * input_price * CACHE_WRITE_PRICE
+        + tokens["cache_read_tokens"] * input_price * CACHE_READ_PRICE
+        + tokens["output_tokens"] * output_price
+    ) / 1_000_000
+
+def tokens_of(usage):
+    """TOKEN_FIELDS counts of an Anthropic response's usage (input_tokens excludes cached input)."""
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+    }
+
+def today():
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+class Turn:
+    """Tokens, latency and tool iterations of one turn: every model call of one process_query."""
+
+    def __init__(self, owner_id, sender_id):
+        self.owner_id = str(owner_id)
+        self.sender_id = str(sender_id)
+        self.started = time.time()
+        self.calls = 0
+        self.tool_iterations = 0
+        self.tokens = dict.fromkeys(TOKEN_FIELDS, 0)
+        self.model_seconds = []
+
+    def add_call(self, usage, seconds):
+        self.calls += 1
+        self.model_seconds.append(seconds)
+        if usage is not None:
+            for field, value in tokens_of(usage).items():
+                self.tokens[field] += value
+
+    def add_tool_iteration(self):
+        self.tool_iterations += 1
+
+    def updates(self, completed):
+        """
+        The Mongo updates (collection, filter, update) that add this turn to the daily
+        rollups. Turn latency is sampled for completed turns only; tokens and cost of
+        cancelled or failed turns were still paid for and are counted.
+        """
+        seconds = time.time() - self.started
+        turn_cost = cost(self.tokens)
+        metrics.observe("turn.cost_usd", turn_cost)
+        metrics.observe("turn.tool_iterations", self.tool_iterations)
+        if completed:
+            metrics.observe("turn.seconds", seconds)
+
+        day = today()
+        totals = {
+            **self.tokens,
+            "turns": 1,
+            "completed_turns": 1 if completed else 0,
+            "calls": self.calls,
+            "tool_iterations": self.tool_iterations,
+            "model_seconds_total": sum(self.model_seconds),
+            "cost_usd": turn_cost,
+        }
+        samples = {"turn_cost_usd": [turn_cost], "model_seconds": self.model_seconds}
+        if completed:
+            samples["turn_seconds"] = [seconds]
+        push = {name: {"$each": values, "$slice": -USAGE_SAMPLES} for name, values in samples.items() if values}
+
+        daily_update = {"$setOnInsert": {"owner_id": self.owner_id, "day": day}, "$inc": totals}
+        if push:
+            daily_update["$push"] = push
+        return [
+            (DAILY, {"_id": f"{self.owner_id}:{day}"}, daily_update),
+            (SENDERS, {"_id": f"{self.owner_id}:{self.sender_id}:{day}"}, {
+                "$setOnInsert": {"owner_id": self.owner_id, "sender_id": self.sender_id, "day": day},
+                "$inc": totals,
+            }),
+        ]
+
+def since(days):
+    """The first day (ISO date) of a report covering the last `days` days, today included."""
+    return (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=days - 1)).isoformat()
+
+def _totals(doc):
+    return {key: doc.get(key, 0) for key in TOKEN_FIELDS + ("turns", "completed_turns", "calls", "tool_iterations", "cost_usd")}
+
+def top_senders_pipeline(owner_id, first_day):
+    """Aggregation over SENDERS: the customers of an owner that cost the most since first_day."""
+    return [
+        {"$match": {"owner_id": str(owner_id), "day": {"$gte": first_day}}},
+        {"$group": {"_id": "$sender_id", **{key: {"$sum": f"${key}"} for key in _totals({})}}},
+        {"$sort": {"cost_usd": -1}},
+        {"$limit": USAGE_TOP_SENDERS},
+    ]
+
+def report(daily_docs, top_senders):
+    """
+    The usage report of one owner: per day the totals and percentiles of turn latency,
+    model call latency and turn cost (from DAILY documents), plus the customers that
+    cost the most over the period (from top_senders_pipeline).
+    """
+    days = []
+    for doc in sorted(daily_docs, key=lambda doc: doc["day"]):
+        days.append({
+            "day": doc["day"],
+            **_totals(doc),
+            "turn_seconds": metrics.summarize(doc.get("turn_seconds", [])),
+            "model_seconds": metrics.summarize(doc.get("model_seconds", [])),
+            "turn_cost_usd": metrics.summarize(doc.get("turn_cost_usd", [])),
+        })
+    return {
+        "days": days,
+        "cost_usd": sum(day["cost_usd"] for day in days),
+        "top_senders": [{"sender_id": doc["_id"], **_totals(doc)} for doc in top_senders],
+    }